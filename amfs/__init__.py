@@ -16,6 +16,48 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'amfs.sqlite'),
+        DATABASE_BATCH_SIZE=50,
+        DATABASE_TIMEOUT=30,
+        DATABASE_POOL_SIZE=8,
+        DATABASE_PRAGMAS={
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64 * 1024,
+            'temp_store': 'MEMORY',
+            'foreign_keys': 'ON',
+        },
+        BLOB_STORE=os.path.join(app.instance_path, 'blobs'),
+        BLOB_INLINE_LIMIT=4096,
+        BLOB_COMPRESSION=6,
+        BLOB_SWEEP_GRACE=60 * 60,
+        SOURCE_PATTERNS=["*.java"],
+        COMPILE_CACHE=os.path.join(app.instance_path, 'compile-cache'),
+        COMPILE_CACHE_SIZE=512 * 1024 * 1024,
+        COMPILE_CACHE_AGE=7 * 24 * 60 * 60,
+        SOLUTION_CACHE=os.path.join(app.instance_path, 'solution-cache'),
+        SOLUTION_CACHE_SIZE=64 * 1024 * 1024,
+        SOLUTION_CACHE_AGE=7 * 24 * 60 * 60,
+        OUTPUT_LIMIT=64 * 1024,
+        ERROR_LIMIT=16 * 1024,
+        FAIL_FAST=True,
+        LIMIT_CPU_TIME=None,
+        LIMIT_MEMORY=None,
+        LIMIT_PROCESSES=None,
+        LIMIT_FILE_SIZE=None,
+        JVM_WARM=False,
+        JVM_CACHE=os.path.join(app.instance_path, 'jvm'),
+        JVM_CDS=True,
+        RENDER_WORKERS=os.cpu_count() or 1,
+        PLAGIARISM_BACKEND="moss",
+        PLAGIARISM_WORKERS=os.cpu_count() or 1,
+        PLAGIARISM_TIMEOUT=60,
+        PLAGIARISM_RETRIES=3,
+        PLAGIARISM_BACKOFF=2,
+        MOSS_SERVER="moss.stanford.edu",
+        MOSS_PORT=7690,
+        SIMILARITY_INDEX=True,
+        SIMILARITY_THRESHOLD=0.5,
     )
 
     if test_config is None:
@@ -0,0 +1,328 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+
+def file_digest(path: Path) -> str:
+    """
+    Calculates the SHA-256 digest of a file.
+
+    Args:
+        path: Path to the file
+
+    Returns:
+        Hexadecimal digest of the file contents
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_digest(directory: Path, patterns: [str]) -> str:
+    """
+    Calculates a digest over all source files in a directory, including their relative paths.
+
+    Args:
+        directory: Directory containing the source files
+        patterns: Wildcard patterns matching source files, e.g. "*.java"
+
+    Returns:
+        Hexadecimal digest of the source files
+    """
+    sources = sorted({path for pattern in patterns for path in directory.rglob(pattern)
+                      if path.is_file()})
+    h = hashlib.sha256()
+    for path in sources:
+        h.update(path.relative_to(directory).as_posix().encode())
+        h.update(b'\0')
+        h.update(file_digest(path).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def snapshot(directory: Path) -> dict[str, tuple[int, int]]:
+    """
+    Records modification time and size of every file in a directory.
+
+    Args:
+        directory: Directory to be recorded
+
+    Returns:
+        A dictionary mapping relative file paths to (mtime in ns, size)
+    """
+    files = {}
+    for path in directory.rglob('*'):
+        if path.is_file():
+            stat = path.stat()
+            files[path.relative_to(directory).as_posix()] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+class CompileCache:
+    """
+    Content-addressed cache of compilation results.
+
+    Each entry is keyed by the digest of the submission sources plus the compile command, and
+    holds the build artifacts produced by the compiler together with the compilation result.
+
+    Attributes:
+        cache_dir: Directory holding all cache entries
+        max_size: Maximum total size of all entries in bytes
+        max_age: Maximum time in seconds an entry is kept since it was last used
+    """
+    def __init__(
+            self,
+            cache_dir: str,
+            max_size: int,
+            max_age: float
+    ):
+        """
+        Initiates a compilation cache.
+
+        Args:
+            cache_dir: Directory holding all cache entries
+            max_size: Maximum total size of all entries in bytes
+            max_age: Maximum time in seconds an entry is kept since it was last used
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(digest: str, compile_command: str) -> str:
+        """
+        Generates the cache key of a compilation.
+
+        Args:
+            digest: Digest of the submission sources
+            compile_command: Compilation command for marking
+
+        Returns:
+            The cache key
+        """
+        return hashlib.sha256(f"{digest}\0{compile_command}".encode()).hexdigest()
+
+    def restore(self, key: str, directory: Path) -> dict | None:
+        """
+        Restores the build artifacts of a cached compilation into the submission directory.
+
+        Args:
+            key: Cache key of the compilation
+            directory: Submission directory to restore the artifacts into
+
+        Returns:
+            The recorded compilation result with its code and output, otherwise None
+        """
+        entry = self.cache_dir / key
+        try:
+            with open(entry / "result.json") as f:
+                result = json.load(f)
+            for name in result['artifacts']:
+                target = directory / name
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(entry / "files" / name, target)
+            os.utime(entry / "result.json")
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return result
+
+    def store(
+            self,
+            key: str,
+            directory: Path,
+            before: dict[str, tuple[int, int]],
+            code: int,
+            output: str
+    ) -> None:
+        """
+        Stores the artifacts created or modified by a compilation, along with its result.
+
+        Args:
+            key: Cache key of the compilation
+            directory: Submission directory that has been compiled
+            before: Snapshot of the submission directory taken before compilation
+            code: Result code of the compilation
+            output: Output recorded for the compilation
+
+        Returns:
+            None
+        """
+        entry = self.cache_dir / key
+        if entry.exists():
+            return
+
+        artifacts = [name for name, state in snapshot(directory).items()
+                     if before.get(name) != state]
+        staging = Path(tempfile.mkdtemp(dir=self.cache_dir, prefix=".staging-"))
+        try:
+            for name in artifacts:
+                target = staging / "files" / name
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(directory / name, target)
+            with open(staging / "result.json", 'w') as f:
+                json.dump({'code': code, 'output': output, 'artifacts': artifacts}, f)
+            os.rename(staging, entry)
+        except OSError:
+            # Another worker stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def evict(self) -> None:
+        """
+        Removes entries unused for longer than the maximum age, then the least recently used
+        entries until the cache fits in the maximum size.
+
+        Returns:
+            None
+        """
+        now = time.time()
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            staging = entry.name.startswith(".staging-")
+            try:
+                last_used = (entry if staging else entry / "result.json").stat().st_mtime
+            except OSError:
+                last_used = 0
+            if now - last_used > self.max_age:
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+            if staging:
+                # Entries being written by another worker are left alone
+                continue
+            size = sum(path.stat().st_size for path in entry.rglob('*') if path.is_file())
+            entries.append((last_used, size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+class SolutionCache:
+    """
+    Persistent cache of sample solution outputs.
+
+    Each entry is keyed by the digest of the solution sources, the commands and the test input,
+    and holds the stdout generated by the sample solution.
+
+    Attributes:
+        cache_dir: Directory holding all cache entries
+        max_size: Maximum total size of all entries in bytes
+        max_age: Maximum time in seconds an entry is kept since it was last used
+    """
+    def __init__(
+            self,
+            cache_dir: str,
+            max_size: int,
+            max_age: float
+    ):
+        """
+        Initiates a sample solution cache.
+
+        Args:
+            cache_dir: Directory holding all cache entries
+            max_size: Maximum total size of all entries in bytes
+            max_age: Maximum time in seconds an entry is kept since it was last used
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(digest: str, compile_command: str, execute_command: str, test_input: str) -> str:
+        """
+        Generates the cache key of a sample solution output.
+
+        Args:
+            digest: Digest of the solution sources
+            compile_command: Compilation command for marking
+            execute_command: Execution command for marking
+            test_input: stdin of the test case
+
+        Returns:
+            The cache key
+        """
+        input_digest = hashlib.sha256((test_input or '').encode()).hexdigest()
+        return hashlib.sha256(
+            f"{digest}\0{compile_command}\0{execute_command}\0{input_digest}".encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """
+        Loads a cached sample solution output.
+
+        Args:
+            key: Cache key of the output
+
+        Returns:
+            The cached output, otherwise None
+        """
+        try:
+            with open(self.cache_dir / key, encoding='utf-8', newline='') as f:
+                output = f.read()
+            os.utime(self.cache_dir / key)
+        except OSError:
+            return None
+
+        return output
+
+    def put(self, key: str, output: str) -> None:
+        """
+        Stores a sample solution output.
+
+        Args:
+            key: Cache key of the output
+            output: stdout generated by the sample solution
+
+        Returns:
+            None
+        """
+        fd, staging = tempfile.mkstemp(dir=self.cache_dir, prefix=".staging-")
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(output)
+        os.replace(staging, self.cache_dir / key)
+
+    def evict(self) -> None:
+        """
+        Removes entries unused for longer than the maximum age, then the least recently used
+        entries until the cache fits in the maximum size.
+
+        Returns:
+            None
+        """
+        now = time.time()
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                entry.unlink(missing_ok=True)
+            elif not entry.name.startswith(".staging-"):
+                # Entries being written by another worker are left alone
+                entries.append((stat.st_mtime, stat.st_size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            entry.unlink(missing_ok=True)
+            total -= size
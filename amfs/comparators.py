@@ -0,0 +1,171 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+"""
+
+import math
+import re
+from abc import ABC, abstractmethod
+from typing import Iterator
+
+# Non-whitespace tokens of an output
+TOKEN = re.compile(r"\S+")
+
+
+class Comparator(ABC):
+    """
+    Incremental comparison of an output stream against the expected output. The stream is fed
+    in parts as it is read, so that a mismatch is known as soon as the output diverges.
+
+    Attributes:
+        expected: The expected output
+        matched: Whether the stream matches the expected output so far
+    """
+    def __init__(self, expected: str):
+        """
+        Initiates a comparison against the expected output.
+
+        Args:
+            expected: The expected output
+        """
+        self.expected = expected
+        self.matched = True
+
+    @abstractmethod
+    def feed(self, text: str) -> bool:
+        """
+        Compares the next part of the stream.
+
+        Args:
+            text: Decoded text following the parts already compared
+
+        Returns:
+            Whether the stream still matches the expected output
+        """
+
+    @abstractmethod
+    def result(self) -> bool:
+        """
+        Concludes the comparison once the stream is closed.
+
+        Returns:
+            Whether the whole stream matches the expected output
+        """
+
+
+class ExactComparator(Comparator):
+    """
+    Comparison requiring the output to be identical to the expected output.
+    """
+    def __init__(self, expected: str):
+        super().__init__(expected)
+        self._offset = 0
+
+    def feed(self, text: str) -> bool:
+        if self.matched and text:
+            end = self._offset + len(text)
+            self.matched = self.expected[self._offset:end] == text
+            self._offset = end
+        return self.matched
+
+    def result(self) -> bool:
+        return self.matched and self._offset == len(self.expected)
+
+
+class WhitespaceComparator(Comparator):
+    """
+    Comparison of the output and the expected output token by token, ignoring the amount and
+    kind of whitespace between tokens.
+    """
+    # Extra characters a token may have over its expected token before it is a mismatch
+    slack = 0
+
+    def __init__(self, expected: str):
+        super().__init__(expected)
+        self._tokens: Iterator[str] = (m.group() for m in TOKEN.finditer(expected))
+        self._next = next(self._tokens, None)
+        self._pending = ""
+
+    def _equal(self, token: str, expected: str) -> bool:
+        """
+        Compares a token of the output against the expected token.
+        """
+        return token == expected
+
+    def _compare(self, token: str) -> bool:
+        """
+        Compares the next complete token of the output.
+        """
+        if self._next is None or not self._equal(token, self._next):
+            return False
+        self._next = next(self._tokens, None)
+        return True
+
+    def feed(self, text: str) -> bool:
+        if not self.matched or not text:
+            return self.matched
+
+        tokens = (self._pending + text).split()
+        # The last token may continue in the next part, unless whitespace follows it
+        self._pending = "" if text[-1].isspace() or not tokens else tokens.pop()
+        self.matched = all(self._compare(token) for token in tokens)
+        if self.matched and self._pending:
+            # A token longer than any acceptable one is a mismatch already
+            self.matched = (self._next is not None
+                            and len(self._pending) <= len(self._next) + self.slack)
+        return self.matched
+
+    def result(self) -> bool:
+        if self.matched and self._pending:
+            self.matched = self._compare(self._pending)
+            self._pending = ""
+        return self.matched and self._next is None
+
+
+class FloatComparator(WhitespaceComparator):
+    """
+    Comparison of the output and the expected output token by token like
+    WhitespaceComparator, where numeric tokens are equal within a tolerance.
+
+    Attributes:
+        tolerance: Maximum absolute or relative difference between numeric tokens
+    """
+    slack = 64
+
+    def __init__(self, expected: str, tolerance: float):
+        super().__init__(expected)
+        self.tolerance = tolerance
+
+    def _equal(self, token: str, expected: str) -> bool:
+        if token == expected:
+            return True
+        try:
+            return math.isclose(float(token), float(expected),
+                                rel_tol=self.tolerance, abs_tol=self.tolerance)
+        except ValueError:
+            return False
+
+
+# Comparison modes available for marking
+MODES = ("exact", "whitespace", "float")
+
+
+def create(mode: str, expected: str, tolerance: float = 1e-6) -> Comparator:
+    """
+    Creates a comparator of the specified mode.
+
+    Args:
+        mode: One of "exact", "whitespace" and "float"
+        expected: The expected output
+        tolerance: Maximum absolute or relative difference between numbers in "float" mode
+
+    Returns:
+        The comparator
+    """
+    if mode == "whitespace":
+        return WhitespaceComparator(expected)
+    if mode == "float":
+        return FloatComparator(expected, tolerance)
+    return ExactComparator(expected)
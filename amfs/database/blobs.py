@@ -0,0 +1,160 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from typing import Container
+
+
+class BlobStore:
+    """
+    Content-addressed store of large texts, such as test inputs and program outputs, kept on
+    disk next to the database.
+
+    Each blob is stored once under the SHA-256 digest of its text, which is the reference kept
+    in the database. Texts shorter than the inline limit are not worth a file of their own and
+    are meant to stay in the database.
+
+    Attributes:
+        blob_dir: Directory holding all blobs
+        inline_limit: Maximum length of texts kept inline in the database
+        compression: zlib compression level of blobs, 0 to store them uncompressed
+    """
+    def __init__(
+            self,
+            blob_dir: str,
+            inline_limit: int,
+            compression: int
+    ):
+        """
+        Initiates a blob store.
+
+        Args:
+            blob_dir: Directory holding all blobs
+            inline_limit: Maximum length of texts kept inline in the database
+            compression: zlib compression level of blobs, 0 to store them uncompressed
+        """
+        self.blob_dir = Path(blob_dir)
+        self.inline_limit = inline_limit
+        self.compression = compression
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, ref: str, compressed: bool) -> Path:
+        """
+        Locates a blob, sharded by the first two characters of its reference.
+
+        Args:
+            ref: Reference of the blob
+            compressed: Whether the blob is compressed
+
+        Returns:
+            Path to the blob
+        """
+        return self.blob_dir / ref[:2] / (f"{ref}.z" if compressed else ref)
+
+    def split(self, text: str | None) -> tuple[str | None, str | None]:
+        """
+        Decides where a text is kept, storing it as a blob if it exceeds the inline limit.
+
+        Args:
+            text: Text to be kept
+
+        Returns:
+            A tuple of the inline text and the blob reference, one of which is None
+        """
+        if text is None or len(text) <= self.inline_limit:
+            return text, None
+        return None, self.put(text)
+
+    def join(self, text: str | None, ref: str | None) -> str | None:
+        """
+        Recovers a text kept by split.
+
+        Args:
+            text: Inline text
+            ref: Blob reference
+
+        Returns:
+            The original text
+        """
+        return text if ref is None else self.get(ref)
+
+    def put(self, text: str) -> str:
+        """
+        Stores a text as a blob, unless a blob with the same content already exists.
+
+        Args:
+            text: Text to be stored
+
+        Returns:
+            Reference of the blob
+        """
+        data = text.encode('utf-8')
+        ref = hashlib.sha256(data).hexdigest()
+        for path in (self._path(ref, True), self._path(ref, False)):
+            try:
+                # Marks the blob as just stored, so that a sweep does not take it as unused
+                # before the row referencing it is committed
+                os.utime(path)
+                return ref
+            except FileNotFoundError:
+                pass
+
+        path = self._path(ref, self.compression > 0)
+        path.parent.mkdir(exist_ok=True)
+        fd, staging = tempfile.mkstemp(dir=path.parent, prefix=".staging-")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(zlib.compress(data, self.compression) if self.compression > 0 else data)
+        os.replace(staging, path)
+
+        return ref
+
+    def get(self, ref: str) -> str:
+        """
+        Loads the text of a blob.
+
+        Args:
+            ref: Reference of the blob
+
+        Returns:
+            The stored text
+        """
+        try:
+            data = zlib.decompress(self._path(ref, True).read_bytes())
+        except FileNotFoundError:
+            data = self._path(ref, False).read_bytes()
+        return data.decode('utf-8')
+
+    def sweep(self, referenced: Container[str], grace: float) -> int:
+        """
+        Removes blobs no longer referenced. Blobs stored within the grace period are kept, as
+        the rows referencing them may not be committed yet.
+
+        Args:
+            referenced: References of all blobs still in use
+            grace: Time in seconds a blob is kept after it was stored
+
+        Returns:
+            Number of blobs removed
+        """
+        now = time.time()
+        removed = 0
+        for path in self.blob_dir.glob("*/*"):
+            ref = path.name.removesuffix(".z")
+            if not ref.startswith(".staging-") and ref in referenced:
+                continue
+            try:
+                if now - path.stat().st_mtime > grace:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
@@ -5,18 +5,81 @@ This file is part of AMFS, which is distributed under the terms of the GPLv3 Lic
 See the file LICENSE at the top level directory of this distribution for details.
 """
 
+import json
+import os
+import queue
 import sqlite3
+import threading
+from concurrent.futures import Future
+from itertools import groupby
+from pathlib import Path
+from typing import Any, Callable, Iterator, Mapping
 
 from flask import current_app, g
 
+from amfs.database.blobs import BlobStore
+from amfs.execution import Usage
+from amfs.marking import TestCase, Attempt
+
+# Idle connections, writers and blob stores of this process, by database path
+_pools: dict[str, queue.LifoQueue] = dict()
+_writers: dict[str, 'Writer'] = dict()
+_blobs: dict[str, BlobStore] = dict()
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def connect(database: str, timeout: float, pragmas: dict[str, Any]) -> sqlite3.Connection:
+    """
+    Opens a connection to the database with the specified pragmas applied. The connection may
+    be handed over between threads, but must only be used by one thread at a time.
+
+    Args:
+        database: Path to the database
+        timeout: Seconds to wait for a lock held by another connection
+        pragmas: Pragma values applied to the connection, e.g. {'journal_mode': 'WAL'}
+
+    Returns:
+        The database connection
+    """
+    db = sqlite3.connect(
+        database,
+        timeout=timeout,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False
+    )
+    db.row_factory = sqlite3.Row
+    db.execute(f"PRAGMA busy_timeout = {int(timeout * 1000)}")
+    for name, value in pragmas.items():
+        db.execute(f"PRAGMA {name} = {value}")
+
+    return db
+
+
+def _reset_after_fork() -> None:
+    """
+    Drops connections and writers inherited from a parent process, which must not be shared.
+    """
+    global _pools_pid
+    if _pools_pid != os.getpid():
+        _pools.clear()
+        _writers.clear()
+        _blobs.clear()
+        _pools_pid = os.getpid()
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        config = current_app.config
+        with _pools_lock:
+            _reset_after_fork()
+            pool = _pools.setdefault(config['DATABASE'],
+                                     queue.LifoQueue(config['DATABASE_POOL_SIZE']))
+        try:
+            g.db = pool.get_nowait()
+        except queue.Empty:
+            g.db = connect(config['DATABASE'], config['DATABASE_TIMEOUT'],
+                           config['DATABASE_PRAGMAS'])
 
     return g.db
 
@@ -24,13 +87,406 @@ def get_db():
 def close_db(_e=None):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        # Return the connection to the pool of this process for reuse, if there is room
+        db.rollback()
+        with _pools_lock:
+            _reset_after_fork()
+            pool = _pools.get(current_app.config['DATABASE'])
+        try:
+            if pool is None:
+                raise queue.Full
+            pool.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+
+class Writer:
+    """
+    Dedicated writer of a database, which owns the only connection of this process writing
+    marking results. Writes submitted from any thread are run in order in a single background
+    thread, each in its own transaction, so that concurrent workers never contend for the
+    database lock with each other.
+    """
+    def __init__(self, database: str, timeout: float, pragmas: dict[str, Any]):
+        """
+        Initiates a writer and starts its background thread.
+
+        Args:
+            database: Path to the database
+            timeout: Seconds to wait for a lock held by another connection
+            pragmas: Pragma values applied to the connection
+        """
+        self._db = connect(database, timeout, pragmas)
+        self._tasks: queue.SimpleQueue = queue.SimpleQueue()
+        threading.Thread(target=self._run, name="database-writer", daemon=True).start()
+
+    def _run(self) -> None:
+        """
+        Runs submitted writes one by one, committing each on success and rolling back on error.
+
+        Returns:
+            None
+        """
+        while True:
+            future, fn, args = self._tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(self._db, *args)
+                self._db.commit()
+            except BaseException as e:
+                self._db.rollback()
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, fn: Callable[..., Any], *args) -> Future:
+        """
+        Schedules a write to the database.
+
+        Args:
+            fn: Function taking the writer connection followed by the arguments
+            *args: Arguments of the function
+
+        Returns:
+            A future of the return value of the function
+        """
+        future = Future()
+        self._tasks.put((future, fn, args))
+        return future
+
+
+def get_writer() -> Writer:
+    """
+    Gets the dedicated writer of the application database in this process.
+
+    Returns:
+        The database writer
+    """
+    config = current_app.config
+    with _pools_lock:
+        _reset_after_fork()
+        if config['DATABASE'] not in _writers:
+            _writers[config['DATABASE']] = Writer(config['DATABASE'], config['DATABASE_TIMEOUT'],
+                                                  config['DATABASE_PRAGMAS'])
+        return _writers[config['DATABASE']]
+
+
+def get_blobs() -> BlobStore:
+    """
+    Gets the blob store of the application database in this process.
+
+    Returns:
+        The blob store
+    """
+    config = current_app.config
+    with _pools_lock:
+        _reset_after_fork()
+        if config['DATABASE'] not in _blobs:
+            _blobs[config['DATABASE']] = BlobStore(config['BLOB_STORE'],
+                                                   config['BLOB_INLINE_LIMIT'],
+                                                   config['BLOB_COMPRESSION'])
+        return _blobs[config['DATABASE']]
 
 
 def init_db():
+    """
+    Brings the database schema up to date by applying every migration newer than the schema
+    version recorded in the database. Migrations are SQL scripts in database/migrations, named
+    after the version they upgrade to, and each is applied in its own transaction.
+    """
+    migration_dir = Path(current_app.root_path) / 'database' / 'migrations'
+    migrations = sorted((int(path.name.split('_')[0]), path)
+                        for path in migration_dir.glob('[0-9]*_*.sql'))
+
     db = get_db()
-    with current_app.open_resource('database/schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    # Tables are rebuilt by migrations, which foreign keys would otherwise prevent
+    db.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for target, path in migrations:
+            if target <= version:
+                continue
+            try:
+                db.executescript(f"BEGIN;\n{path.read_text()}\n"
+                                 f"PRAGMA user_version = {target};\nCOMMIT;")
+            except sqlite3.Error:
+                db.rollback()
+                raise
+            version = target
+    finally:
+        db.execute(f"PRAGMA foreign_keys = "
+                   f"{current_app.config['DATABASE_PRAGMAS'].get('foreign_keys', 'OFF')}")
+
+
+def insert_test(db: sqlite3.Connection, blobs: BlobStore, jb_id: int, tc_id: int, name: str,
+                mark: float, test_input: str) -> None:
+    """
+    Inserts a test case of a marking job, keeping a large input in the blob store.
+    """
+    db.execute("""
+        INSERT INTO TestCase (jb_id, tc_id, tc_name, tc_mark, tc_input, tc_input_blob)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (jb_id, tc_id, name, mark, *blobs.split(test_input)))
+
+
+def load_tests(db: sqlite3.Connection, blobs: BlobStore, jb_id: int) -> [TestCase]:
+    """
+    Loads all test cases of a marking job ordered by ID, with their inputs.
+    """
+    return [TestCase(id=row['tc_id'], name=row['tc_name'], mark=row['tc_mark'],
+                     input=blobs.join(row['tc_input'], row['tc_input_blob']))
+            for row in db.execute("SELECT * FROM TestCase WHERE jb_id = ? ORDER BY tc_id ASC",
+                                  (jb_id,))]
+
+
+def load_feedbacks(db: sqlite3.Connection,
+                   jb_id: int) -> tuple[list[str], list[frozenset[int]]]:
+    """
+    Loads all feedbacks of a marking job ordered by ID, with the test case combination
+    selecting each feedback, in one grouped query.
+    """
+    feedbacks: list[str] = []
+    feedback_selection: list[frozenset[int]] = []
+    rows = db.execute("""
+        SELECT Feedback.fb_id, fb_content, tc_id
+        FROM Feedback LEFT JOIN FeedbackSelection
+            ON Feedback.jb_id = FeedbackSelection.jb_id AND Feedback.fb_id = FeedbackSelection.fb_id
+        WHERE Feedback.jb_id = ?
+        ORDER BY Feedback.fb_id ASC
+    """, (jb_id,))
+    for _, group in groupby(rows, key=lambda row: row['fb_id']):
+        group = list(group)
+        feedbacks.append(group[0]['fb_content'])
+        feedback_selection.append(frozenset(row['tc_id'] for row in group
+                                            if row['tc_id'] is not None))
+
+    return feedbacks, feedback_selection
+
+
+def _usage(row: sqlite3.Row) -> Usage | None:
+    """
+    Reads the resource usage columns of an attempt.
+    """
+    if row['at_wall_time'] is None:
+        return None
+    return Usage(wall_time=row['at_wall_time'], user_time=row['at_user_time'],
+                 system_time=row['at_system_time'], max_rss=row['at_max_rss'])
+
+
+def _usage_columns(usage: Usage | None) -> tuple:
+    """
+    Writes the resource usage of an attempt as column values.
+    """
+    if usage is None:
+        return None, None, None, None
+    return usage.wall_time, usage.user_time, usage.system_time, usage.max_rss
+
+
+class Records(Mapping[str, tuple[int, str, Usage | None, int | None]]):
+    """
+    Execution results kept for incremental marking, by fingerprint. Outputs kept in the blob
+    store are only loaded when looked up.
+    """
+    def __init__(self, blobs: BlobStore,
+                 rows: dict[str, tuple[int, str | None, str | None, Usage | None, int | None]]):
+        self._blobs = blobs
+        self._rows = rows
+
+    def __getitem__(self, fingerprint: str) -> tuple[int, str, Usage | None, int | None]:
+        code, output, ref, usage, returncode = self._rows[fingerprint]
+        return code, self._blobs.join(output, ref), usage, returncode
+
+    def __contains__(self, fingerprint: object) -> bool:
+        return fingerprint in self._rows
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
+def load_records(db: sqlite3.Connection, blobs: BlobStore, jb_id: int) -> Records:
+    """
+    Loads execution results of a job kept for incremental marking, by fingerprint.
+    """
+    return Records(blobs, {row['ar_fingerprint']: (row['at_code'], row['at_output'],
+                                                   row['at_output_blob'], _usage(row),
+                                                   row['ar_returncode'])
+                           for row in db.execute("SELECT * FROM AttemptRecord WHERE jb_id = ?",
+                                                 (jb_id,))})
+
+
+def prune_records(db: sqlite3.Connection, jb_id: int, fingerprints: set[str]) -> None:
+    """
+    Deletes execution results of a job kept for incremental marking, except those of the
+    specified fingerprints, so that only the results of its latest marking are kept.
+    """
+    with db:
+        db.execute("""
+            DELETE FROM AttemptRecord
+            WHERE jb_id = ? AND ar_fingerprint NOT IN (SELECT value FROM json_each(?))
+        """, (jb_id, json.dumps(sorted(fingerprints))))
+
+
+def sweep_blobs(db: sqlite3.Connection, blobs: BlobStore, grace: float) -> int:
+    """
+    Removes blobs that no test case, attempt or execution record references any more, such as
+    outputs of cleared results.
+    """
+    referenced = {row[0] for row in db.execute("""
+        SELECT tc_input_blob FROM TestCase WHERE tc_input_blob IS NOT NULL
+        UNION SELECT at_output_blob FROM Attempt WHERE at_output_blob IS NOT NULL
+        UNION SELECT at_output_blob FROM AttemptRecord WHERE at_output_blob IS NOT NULL
+    """)}
+    return blobs.sweep(referenced, grace)
+
+
+def clear_results(db: sqlite3.Connection, jb_id: int) -> None:
+    """
+    Deletes all results of the previous marking of a job.
+    """
+    with db:
+        db.execute("DELETE FROM Attempt WHERE jb_id = ?", (jb_id,))
+        db.execute("DELETE FROM Submission WHERE jb_id = ?", (jb_id,))
+
+
+def insert_results(db: sqlite3.Connection, blobs: BlobStore, jb_id: int,
+                   results: [tuple[str, float, [Attempt]]]) -> None:
+    """
+    Inserts a batch of marked submissions of a job with their scores and attempts, along with
+    execution results for incremental marking, using bulk inserts in one transaction. Large
+    outputs are kept in the blob store.
+    """
+    attempts = [(attempt, *blobs.split(attempt.output))
+                for _, _, sm_attempts in results for attempt in sm_attempts]
+    with db:
+        db.executemany("INSERT INTO Submission (jb_id, sm_id, sm_mark) VALUES (?, ?, ?)",
+                       [(jb_id, sm_id, sm_mark) for sm_id, sm_mark, _ in results])
+        db.executemany("""
+            INSERT INTO Attempt (jb_id, sm_id, tc_id, at_code, at_mark, at_output, at_output_blob,
+                                 at_wall_time, at_user_time, at_system_time, at_max_rss)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(jb_id, a.sm_id, a.tc_id, a.code, a.mark, output, ref, *_usage_columns(a.usage))
+              for a, output, ref in attempts])
+        db.executemany("""
+            INSERT OR REPLACE INTO AttemptRecord
+                (jb_id, ar_fingerprint, at_code, at_output, at_output_blob, at_wall_time,
+                 at_user_time, at_system_time, at_max_rss, ar_returncode)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(jb_id, a.fingerprint, a.code, output, ref, *_usage_columns(a.usage), a.returncode)
+              for a, output, ref in attempts if a.fingerprint is not None])
+
+
+# Resource usage statistics kept for each test case result, as (measure, statistic, column)
+_USAGE_COLUMNS = [(measure, statistic, f"tr_{measure}_{statistic}")
+                  for measure in ('wall_time', 'cpu_time', 'max_rss')
+                  for statistic in ('median', 'p90', 'max')]
+
+
+def clear_job_results(db: sqlite3.Connection, jb_id: int) -> None:
+    """
+    Deletes the result statistics and plagiarism results of the previous run of a job.
+    """
+    for table in ("PlagiarismMatch", "PlagiarismResult", "RenderError", "TestCaseResult",
+                  "JobResult"):
+        db.execute(f"DELETE FROM {table} WHERE jb_id = ?", (jb_id,))
+
+
+def insert_job_results(db: sqlite3.Connection, jb_id: int, result: dict,
+                       plagiarism: dict) -> None:
+    """
+    Inserts the result statistics and plagiarism results of a job, replacing those of its
+    previous run, within the transaction of the caller.
+    """
+    clear_job_results(db, jb_id)
+    db.execute("""
+        INSERT INTO JobResult (jb_id, jr_sm_count, jr_avg_mark, jr_full_mark) VALUES (?, ?, ?, ?)
+    """, (jb_id, result['sm_count'], result['avg_mark'], result['full_mark']))
+    db.executemany(f"""
+        INSERT INTO TestCaseResult (jb_id, tc_id, tr_name, tr_mark, tr_pass_count, tr_full_mark,
+                                    tr_avg_mark, tr_pass_rate,
+                                    {", ".join(column for _, _, column in _USAGE_COLUMNS)})
+        VALUES ({", ".join("?" * (8 + len(_USAGE_COLUMNS)))})
+    """, [(jb_id, tc['id'], tc['name'], tc['mark'], tc['pass_count'], tc['full_mark'],
+           tc['avg_mark'], tc['pass_rate'],
+           *(tc[measure][statistic] if tc[measure] else None
+             for measure, statistic, _ in _USAGE_COLUMNS))
+          for tc in result['tc_stats']])
+    db.executemany("INSERT INTO RenderError (jb_id, sm_id, re_message) VALUES (?, ?, ?)",
+                   [(jb_id, sm_id, message)
+                    for sm_id, message in result['render_errors'].items()])
+
+    db.execute("""
+        INSERT INTO PlagiarismResult (jb_id, pr_response, pr_extract, pr_url, pr_date, pr_past)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (jb_id, plagiarism['response'], plagiarism['extract'], plagiarism['url'],
+          plagiarism['date'], 'past_list' in plagiarism))
+    db.executemany("""
+        INSERT INTO PlagiarismMatch (jb_id, pm_past, pm_rank, pm_sm_1, pm_sm_2, pm_score)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(jb_id, past, rank, match['sm_1'], match['sm_2'], match[score])
+          for past, key, score in ((False, 'pg_list', 'line_match'),
+                                   (True, 'past_list', 'similarity'))
+          for rank, match in enumerate(plagiarism.get(key) or [])])
+
+
+def load_job_results(db: sqlite3.Connection, jb_id: int) -> tuple[dict, dict] | None:
+    """
+    Loads the result statistics and plagiarism results of a job in the layout produced by
+    marking and plagiarism detection, otherwise None if the job has no results.
+    """
+    job = db.execute("""
+        SELECT * FROM JobResult JOIN PlagiarismResult USING (jb_id) WHERE jb_id = ?
+    """, (jb_id,)).fetchone()
+    if job is None:
+        return None
+
+    tc_stats = []
+    for row in db.execute("SELECT * FROM TestCaseResult WHERE jb_id = ? ORDER BY tc_id ASC",
+                          (jb_id,)):
+        tc = {'id': row['tc_id'], 'name': row['tr_name'], 'mark': row['tr_mark'],
+              'pass_count': row['tr_pass_count'], 'full_mark': row['tr_full_mark'],
+              'avg_mark': row['tr_avg_mark'], 'pass_rate': row['tr_pass_rate']}
+        for measure, statistic, column in _USAGE_COLUMNS:
+            if row[column] is None:
+                tc[measure] = None
+            else:
+                tc.setdefault(measure, dict())[statistic] = row[column]
+        tc_stats.append(tc)
+    render_errors = {row['sm_id']: row['re_message'] for row in db.execute(
+        "SELECT sm_id, re_message FROM RenderError WHERE jb_id = ? ORDER BY sm_id ASC", (jb_id,)
+    )}
+
+    matches: dict[bool, list[dict]] = {False: [], True: []}
+    for row in db.execute("""
+        SELECT * FROM PlagiarismMatch WHERE jb_id = ? ORDER BY pm_past ASC, pm_rank ASC
+    """, (jb_id,)):
+        matches[bool(row['pm_past'])].append({
+            'sm_1': row['pm_sm_1'],
+            'sm_2': row['pm_sm_2'],
+            'similarity' if row['pm_past'] else 'line_match': row['pm_score']
+        })
+
+    result = {
+        'sm_count': job['jr_sm_count'],
+        'avg_mark': job['jr_avg_mark'],
+        'full_mark': job['jr_full_mark'],
+        'tc_stats': tc_stats,
+        'render_errors': render_errors
+    }
+    plagiarism = {
+        'response': None if job['pr_response'] is None else bool(job['pr_response']),
+        'extract': bool(job['pr_extract']),
+        'url': job['pr_url'],
+        'date': job['pr_date'],
+        'pg_list': matches[False]
+    }
+    if job['pr_past']:
+        plagiarism['past_list'] = matches[True]
+
+    return result, plagiarism
 
 
 def init_app(app):
@@ -0,0 +1,131 @@
+--Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+--
+--This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+--See the file LICENSE at the top level directory of this distribution for details.
+
+-- Schema holding a single marking job, as used before versioned migrations
+
+CREATE TABLE IF NOT EXISTS Submission (
+    sm_id VARCHAR PRIMARY KEY,
+    sm_mark FLOAT
+);
+
+CREATE TABLE IF NOT EXISTS TestCase (
+    tc_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tc_name VARCHAR NOT NULL,
+    tc_mark FLOAT NOT NULL,
+    tc_input VARCHAR NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Attempt (
+    at_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    at_code INTEGER NOT NULL,
+    at_mark FLOAT NOT NULL,
+    at_output VARCHAR NOT NULL,
+    sm_id VARCHAR NOT NULL,
+    tc_id INTEGER NOT NULL,
+    FOREIGN KEY (sm_id) REFERENCES Submission (sm_id),
+    FOREIGN KEY (tc_id) REFERENCES TestCase (tc_id)
+);
+
+CREATE TABLE IF NOT EXISTS Feedback (
+    fb_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fb_content VARCHAR NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS FeedbackSelection (
+    fs_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    fb_id INTEGER NOT NULL,
+    tc_id INTEGER NOT NULL,
+    FOREIGN KEY (fb_id) REFERENCES Feedback (fb_id),
+    FOREIGN KEY (tc_id) REFERENCES TestCase (tc_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_attempt_submission ON Attempt (sm_id, tc_id);
+CREATE INDEX IF NOT EXISTS idx_attempt_test_case ON Attempt (tc_id, at_code);
+CREATE INDEX IF NOT EXISTS idx_selection_feedback ON FeedbackSelection (fb_id, tc_id);
+CREATE INDEX IF NOT EXISTS idx_selection_test_case ON FeedbackSelection (tc_id);
+
+CREATE TABLE IF NOT EXISTS AttemptRecord (
+    ar_fingerprint VARCHAR PRIMARY KEY,
+    at_code INTEGER NOT NULL,
+    at_output VARCHAR NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Job (
+    jb_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    jb_name VARCHAR NOT NULL,
+    jb_status VARCHAR NOT NULL,
+    jb_stage VARCHAR,
+    jb_done INTEGER NOT NULL DEFAULT 0,
+    jb_total INTEGER NOT NULL DEFAULT 0,
+    jb_message VARCHAR,
+    jb_started FLOAT NOT NULL,
+    jb_finished FLOAT
+);
+
+-- Results of each job, keyed by job so that the results page reads the rows it shows through
+-- the primary keys
+CREATE TABLE IF NOT EXISTS JobResult (
+    jb_id INTEGER PRIMARY KEY,
+    jr_sm_count INTEGER NOT NULL,
+    jr_avg_mark VARCHAR NOT NULL,
+    jr_full_mark VARCHAR NOT NULL,
+    FOREIGN KEY (jb_id) REFERENCES Job (jb_id) ON DELETE CASCADE
+);
+
+-- Test case ID 0 is compilation, and usage statistics are NULL without any measurement
+CREATE TABLE IF NOT EXISTS TestCaseResult (
+    jb_id INTEGER NOT NULL,
+    tc_id INTEGER NOT NULL,
+    tr_name VARCHAR NOT NULL,
+    tr_mark FLOAT NOT NULL,
+    tr_pass_count INTEGER NOT NULL,
+    tr_full_mark VARCHAR NOT NULL,
+    tr_avg_mark VARCHAR NOT NULL,
+    tr_pass_rate VARCHAR NOT NULL,
+    tr_wall_time_median VARCHAR,
+    tr_wall_time_p90 VARCHAR,
+    tr_wall_time_max VARCHAR,
+    tr_cpu_time_median VARCHAR,
+    tr_cpu_time_p90 VARCHAR,
+    tr_cpu_time_max VARCHAR,
+    tr_max_rss_median VARCHAR,
+    tr_max_rss_p90 VARCHAR,
+    tr_max_rss_max VARCHAR,
+    PRIMARY KEY (jb_id, tc_id),
+    FOREIGN KEY (jb_id) REFERENCES JobResult (jb_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS RenderError (
+    jb_id INTEGER NOT NULL,
+    sm_id VARCHAR NOT NULL,
+    re_message VARCHAR NOT NULL,
+    PRIMARY KEY (jb_id, sm_id),
+    FOREIGN KEY (jb_id) REFERENCES JobResult (jb_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+-- pr_response is NULL when MOSS could not be reached, and pr_past is whether past cohorts
+-- were checked
+CREATE TABLE IF NOT EXISTS PlagiarismResult (
+    jb_id INTEGER PRIMARY KEY,
+    pr_response INTEGER,
+    pr_extract INTEGER,
+    pr_url VARCHAR,
+    pr_date VARCHAR,
+    pr_past INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (jb_id) REFERENCES Job (jb_id) ON DELETE CASCADE
+);
+
+-- Matches within the cohort have pm_past 0 and lines matched as pm_score, matches with past
+-- cohorts have pm_past 1 and similarity as pm_score, both in report order by pm_rank
+CREATE TABLE IF NOT EXISTS PlagiarismMatch (
+    jb_id INTEGER NOT NULL,
+    pm_past INTEGER NOT NULL,
+    pm_rank INTEGER NOT NULL,
+    pm_sm_1 VARCHAR NOT NULL,
+    pm_sm_2 VARCHAR NOT NULL,
+    pm_score VARCHAR NOT NULL,
+    PRIMARY KEY (jb_id, pm_past, pm_rank),
+    FOREIGN KEY (jb_id) REFERENCES PlagiarismResult (jb_id) ON DELETE CASCADE
+) WITHOUT ROWID;
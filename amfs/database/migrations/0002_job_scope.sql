@@ -0,0 +1,129 @@
+--Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+--
+--This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+--See the file LICENSE at the top level directory of this distribution for details.
+
+-- Scopes test cases, feedbacks and results by marking job, so that many jobs are kept side by
+-- side. Existing test cases, feedbacks and results are moved to the latest job. Execution
+-- results kept for incremental marking are scoped the same way, so that a job only loads its
+-- own and they are deleted along with the job.
+
+CREATE TABLE JobScoped (
+    jb_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    jb_name VARCHAR NOT NULL,
+    jb_status VARCHAR NOT NULL,
+    jb_stage VARCHAR,
+    jb_done INTEGER NOT NULL DEFAULT 0,
+    jb_total INTEGER NOT NULL DEFAULT 0,
+    jb_message VARCHAR,
+    jb_created FLOAT NOT NULL,
+    jb_started FLOAT,
+    jb_finished FLOAT
+);
+
+INSERT INTO JobScoped (jb_id, jb_name, jb_status, jb_stage, jb_done, jb_total, jb_message,
+                       jb_created, jb_started, jb_finished)
+SELECT jb_id, jb_name, jb_status, jb_stage, jb_done, jb_total, jb_message,
+       jb_started, jb_started, jb_finished
+FROM Job;
+
+INSERT INTO JobScoped (jb_name, jb_status, jb_created)
+SELECT 'Untitled job', 'new', CAST(strftime('%s', 'now') AS FLOAT)
+WHERE NOT EXISTS (SELECT 1 FROM JobScoped) AND EXISTS (SELECT 1 FROM TestCase);
+
+CREATE TABLE SubmissionScoped (
+    jb_id INTEGER NOT NULL,
+    sm_id VARCHAR NOT NULL,
+    sm_mark FLOAT,
+    PRIMARY KEY (jb_id, sm_id),
+    FOREIGN KEY (jb_id) REFERENCES Job (jb_id) ON DELETE CASCADE
+);
+
+INSERT INTO SubmissionScoped (jb_id, sm_id, sm_mark)
+SELECT (SELECT MAX(jb_id) FROM JobScoped), sm_id, sm_mark FROM Submission;
+
+CREATE TABLE TestCaseScoped (
+    jb_id INTEGER NOT NULL,
+    tc_id INTEGER NOT NULL,
+    tc_name VARCHAR NOT NULL,
+    tc_mark FLOAT NOT NULL,
+    tc_input VARCHAR NOT NULL,
+    PRIMARY KEY (jb_id, tc_id),
+    FOREIGN KEY (jb_id) REFERENCES Job (jb_id) ON DELETE CASCADE
+);
+
+INSERT INTO TestCaseScoped (jb_id, tc_id, tc_name, tc_mark, tc_input)
+SELECT (SELECT MAX(jb_id) FROM JobScoped), tc_id, tc_name, tc_mark, tc_input FROM TestCase;
+
+-- Attempts of compilation use test case ID 0, which has no test case entry
+CREATE TABLE AttemptScoped (
+    jb_id INTEGER NOT NULL,
+    sm_id VARCHAR NOT NULL,
+    tc_id INTEGER NOT NULL,
+    at_code INTEGER NOT NULL,
+    at_mark FLOAT NOT NULL,
+    at_output VARCHAR NOT NULL,
+    PRIMARY KEY (jb_id, sm_id, tc_id),
+    FOREIGN KEY (jb_id, sm_id) REFERENCES Submission (jb_id, sm_id) ON DELETE CASCADE
+);
+
+INSERT OR IGNORE INTO AttemptScoped (jb_id, sm_id, tc_id, at_code, at_mark, at_output)
+SELECT (SELECT MAX(jb_id) FROM JobScoped), sm_id, tc_id, at_code, at_mark, at_output
+FROM Attempt;
+
+CREATE TABLE FeedbackScoped (
+    jb_id INTEGER NOT NULL,
+    fb_id INTEGER NOT NULL,
+    fb_content VARCHAR NOT NULL,
+    PRIMARY KEY (jb_id, fb_id),
+    FOREIGN KEY (jb_id) REFERENCES Job (jb_id) ON DELETE CASCADE
+);
+
+INSERT INTO FeedbackScoped (jb_id, fb_id, fb_content)
+SELECT (SELECT MAX(jb_id) FROM JobScoped), fb_id, fb_content FROM Feedback;
+
+CREATE TABLE FeedbackSelectionScoped (
+    jb_id INTEGER NOT NULL,
+    fb_id INTEGER NOT NULL,
+    tc_id INTEGER NOT NULL,
+    PRIMARY KEY (jb_id, fb_id, tc_id),
+    FOREIGN KEY (jb_id, fb_id) REFERENCES Feedback (jb_id, fb_id) ON DELETE CASCADE,
+    FOREIGN KEY (jb_id, tc_id) REFERENCES TestCase (jb_id, tc_id) ON DELETE CASCADE
+);
+
+INSERT OR IGNORE INTO FeedbackSelectionScoped (jb_id, fb_id, tc_id)
+SELECT (SELECT MAX(jb_id) FROM JobScoped), fb_id, tc_id FROM FeedbackSelection;
+
+CREATE TABLE AttemptRecordScoped (
+    jb_id INTEGER NOT NULL,
+    ar_fingerprint VARCHAR NOT NULL,
+    at_code INTEGER NOT NULL,
+    at_output VARCHAR NOT NULL,
+    PRIMARY KEY (jb_id, ar_fingerprint),
+    FOREIGN KEY (jb_id) REFERENCES Job (jb_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+INSERT INTO AttemptRecordScoped (jb_id, ar_fingerprint, at_code, at_output)
+SELECT jb_id, ar_fingerprint, at_code, at_output
+FROM AttemptRecord, (SELECT MAX(jb_id) AS jb_id FROM JobScoped)
+WHERE jb_id IS NOT NULL;
+
+DROP TABLE AttemptRecord;
+DROP TABLE FeedbackSelection;
+DROP TABLE Feedback;
+DROP TABLE Attempt;
+DROP TABLE TestCase;
+DROP TABLE Submission;
+DROP TABLE Job;
+
+ALTER TABLE JobScoped RENAME TO Job;
+ALTER TABLE SubmissionScoped RENAME TO Submission;
+ALTER TABLE TestCaseScoped RENAME TO TestCase;
+ALTER TABLE AttemptScoped RENAME TO Attempt;
+ALTER TABLE FeedbackScoped RENAME TO Feedback;
+ALTER TABLE FeedbackSelectionScoped RENAME TO FeedbackSelection;
+ALTER TABLE AttemptRecordScoped RENAME TO AttemptRecord;
+
+CREATE INDEX idx_attempt_test_case ON Attempt (jb_id, tc_id, at_code);
+CREATE INDEX idx_selection_test_case ON FeedbackSelection (jb_id, tc_id);
+CREATE INDEX idx_job_created ON Job (jb_created);
@@ -0,0 +1,63 @@
+--Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+--
+--This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+--See the file LICENSE at the top level directory of this distribution for details.
+
+-- Keeps large test inputs and program outputs in the blob store, with only their references
+-- in the database. Each text is either inline or referenced, so the inline columns become
+-- nullable. Existing texts stay inline.
+
+CREATE TABLE TestCaseBlob (
+    jb_id INTEGER NOT NULL,
+    tc_id INTEGER NOT NULL,
+    tc_name VARCHAR NOT NULL,
+    tc_mark FLOAT NOT NULL,
+    tc_input VARCHAR,
+    tc_input_blob VARCHAR,
+    PRIMARY KEY (jb_id, tc_id),
+    FOREIGN KEY (jb_id) REFERENCES Job (jb_id) ON DELETE CASCADE
+);
+
+INSERT INTO TestCaseBlob (jb_id, tc_id, tc_name, tc_mark, tc_input)
+SELECT jb_id, tc_id, tc_name, tc_mark, tc_input FROM TestCase;
+
+CREATE TABLE AttemptBlob (
+    jb_id INTEGER NOT NULL,
+    sm_id VARCHAR NOT NULL,
+    tc_id INTEGER NOT NULL,
+    at_code INTEGER NOT NULL,
+    at_mark FLOAT NOT NULL,
+    at_output VARCHAR,
+    at_output_blob VARCHAR,
+    PRIMARY KEY (jb_id, sm_id, tc_id),
+    FOREIGN KEY (jb_id, sm_id) REFERENCES Submission (jb_id, sm_id) ON DELETE CASCADE
+);
+
+INSERT INTO AttemptBlob (jb_id, sm_id, tc_id, at_code, at_mark, at_output)
+SELECT jb_id, sm_id, tc_id, at_code, at_mark, at_output FROM Attempt;
+
+-- ar_returncode is the exit code of the execution, which decides whether a runtime error may
+-- be reused, NULL if unknown
+CREATE TABLE AttemptRecordBlob (
+    jb_id INTEGER NOT NULL,
+    ar_fingerprint VARCHAR NOT NULL,
+    at_code INTEGER NOT NULL,
+    at_output VARCHAR,
+    at_output_blob VARCHAR,
+    ar_returncode INTEGER,
+    PRIMARY KEY (jb_id, ar_fingerprint),
+    FOREIGN KEY (jb_id) REFERENCES Job (jb_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+INSERT INTO AttemptRecordBlob (jb_id, ar_fingerprint, at_code, at_output)
+SELECT jb_id, ar_fingerprint, at_code, at_output FROM AttemptRecord;
+
+DROP TABLE TestCase;
+DROP TABLE Attempt;
+DROP TABLE AttemptRecord;
+
+ALTER TABLE TestCaseBlob RENAME TO TestCase;
+ALTER TABLE AttemptBlob RENAME TO Attempt;
+ALTER TABLE AttemptRecordBlob RENAME TO AttemptRecord;
+
+CREATE INDEX idx_attempt_test_case ON Attempt (jb_id, tc_id, at_code);
@@ -0,0 +1,17 @@
+--Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+--
+--This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+--See the file LICENSE at the top level directory of this distribution for details.
+
+-- Resources used by each execution: wall time, user and system CPU time in seconds, and peak
+-- resident set size in bytes
+
+ALTER TABLE Attempt ADD COLUMN at_wall_time FLOAT;
+ALTER TABLE Attempt ADD COLUMN at_user_time FLOAT;
+ALTER TABLE Attempt ADD COLUMN at_system_time FLOAT;
+ALTER TABLE Attempt ADD COLUMN at_max_rss INTEGER;
+
+ALTER TABLE AttemptRecord ADD COLUMN at_wall_time FLOAT;
+ALTER TABLE AttemptRecord ADD COLUMN at_user_time FLOAT;
+ALTER TABLE AttemptRecord ADD COLUMN at_system_time FLOAT;
+ALTER TABLE AttemptRecord ADD COLUMN at_max_rss INTEGER;
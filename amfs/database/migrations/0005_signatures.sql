@@ -0,0 +1,28 @@
+--Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+--
+--This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+--See the file LICENSE at the top level directory of this distribution for details.
+
+-- Persistent similarity index of submissions across cohorts: the MinHash signature of the
+-- fingerprints of each submission, and its bucket in each band for locality-sensitive hashing.
+-- Each job marking a cohort of submissions keeps its signatures, named after the job.
+
+CREATE TABLE Signature (
+    sg_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sg_cohort VARCHAR NOT NULL,
+    sg_submission VARCHAR NOT NULL,
+    sg_minhash BLOB NOT NULL,
+    jb_id INTEGER,
+    UNIQUE (jb_id, sg_submission),
+    FOREIGN KEY (jb_id) REFERENCES Job (jb_id) ON DELETE SET NULL
+);
+
+CREATE TABLE SignatureBand (
+    sb_band INTEGER NOT NULL,
+    sb_bucket INTEGER NOT NULL,
+    sg_id INTEGER NOT NULL,
+    PRIMARY KEY (sb_band, sb_bucket, sg_id),
+    FOREIGN KEY (sg_id) REFERENCES Signature (sg_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX idx_band_signature ON SignatureBand (sg_id);
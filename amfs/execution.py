@@ -0,0 +1,470 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+"""
+
+import codecs
+import dataclasses
+import io
+import os
+import re
+import resource
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import BinaryIO, Callable
+
+from amfs import launcher
+from amfs.comparators import Comparator
+
+# Size of each read from the output pipes of a process
+CHUNK_SIZE = 1 << 16
+
+# Characters with a meaning to the shell beyond quoting and splitting words, such as pipes,
+# redirections, variables, globs and comments
+SHELL_SYNTAX = re.compile(r"[|&;<>()$`\\*?\[\]{}~#!\n]")
+
+# Shell builtins which have no executable to launch directly
+SHELL_BUILTINS = {".", "cd", "eval", "exec", "export", "set", "source", "ulimit", "umask"}
+
+
+def parse_command(command: str) -> list[str] | str:
+    """
+    Parses a command into an argument list to be launched directly, saving a shell process
+    per execution. Commands using shell syntax are kept as a string for the shell.
+    For example: "java -Xmx1g 'Main Class'" -> ["java", "-Xmx1g", "Main Class"]
+
+    Args:
+        command: Command line as typed into the shell
+
+    Returns:
+        The argument list, otherwise the command itself if it needs a shell
+    """
+    if SHELL_SYNTAX.search(command):
+        return command
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return command
+    if not args or args[0] in SHELL_BUILTINS or "=" in args[0]:
+        return command
+
+    return args
+
+
+@dataclass
+class Limits:
+    """
+    Resource limits applied to an execution and every process it starts. None leaves a
+    resource unlimited.
+
+    Attributes:
+        cpu_time: Maximum CPU time in seconds of each process
+        memory: Maximum address space in bytes of each process. A JVM reserves much more
+            address space than its heap, so this should be well above -Xmx
+        processes: Maximum number of processes of the user running the marker, including
+            processes outside the execution
+        file_size: Maximum size in bytes of each file written
+    """
+    cpu_time: int = None
+    memory: int = None
+    processes: int = None
+    file_size: int = None
+
+    def apply(self, pid: int) -> None:
+        """
+        Applies the limits to a running process, which every process it starts afterwards
+        inherits.
+
+        Args:
+            pid: Process ID
+
+        Returns:
+            None
+        """
+        if self.cpu_time is not None:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (self.cpu_time, self.cpu_time + 1))
+        for limit, value in ((resource.RLIMIT_AS, self.memory),
+                             (resource.RLIMIT_NPROC, self.processes),
+                             (resource.RLIMIT_FSIZE, self.file_size)):
+            if value is not None:
+                resource.prlimit(pid, limit, (value, value))
+
+
+@dataclass
+class Usage:
+    """
+    Resources used by an execution, including everything it started and waited for.
+
+    Attributes:
+        wall_time: Elapsed real time in seconds
+        user_time: CPU time spent in user mode in seconds
+        system_time: CPU time spent in kernel mode in seconds
+        max_rss: Peak resident set size in bytes
+    """
+    wall_time: float
+    user_time: float
+    system_time: float
+    max_rss: int
+
+    @property
+    def cpu_time(self) -> float:
+        """
+        Total CPU time in seconds.
+        """
+        return self.user_time + self.system_time
+
+
+@dataclass
+class Execution:
+    """
+    Result of executing a command with bounded output capture.
+
+    Attributes:
+        returncode: Exit code of the process, None if it was killed on timeout
+        stdout: Captured stdout, with the middle replaced by a marker if it exceeded its limit
+        stderr: Captured stderr, with the middle replaced by a marker if it exceeded its limit
+        timed_out: Whether the process was killed on timeout
+        matched: Whether the full stdout matches the expected output, None if not compared
+        stopped: Whether the process was killed early on the first mismatch
+        usage: Resources used by the process
+    """
+    returncode: int | None
+    stdout: str
+    stderr: str
+    timed_out: bool
+    matched: bool | None = None
+    stopped: bool = False
+    usage: Usage = None
+
+
+def _to_text(data: bytes) -> str:
+    """
+    Decodes captured bytes the same way as text mode pipes, with universal newlines.
+    """
+    return data.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+
+
+class BoundedCapture:
+    """
+    Capture of an output stream keeping at most a fixed number of bytes, split between the
+    head and the tail of the stream. Bytes in between are dropped and counted.
+
+    Attributes:
+        limit: Maximum number of bytes kept, or None to keep everything
+        total: Number of bytes written so far
+    """
+    def __init__(self, limit: int | None):
+        """
+        Initiates an empty capture.
+
+        Args:
+            limit: Maximum number of bytes kept, or None to keep everything
+        """
+        self.limit = limit
+        self.total = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+
+    def write(self, data: bytes) -> None:
+        """
+        Appends a chunk of the stream.
+
+        Args:
+            data: Bytes read from the stream
+
+        Returns:
+            None
+        """
+        self.total += len(data)
+        if self.limit is None:
+            self._head += data
+            return
+
+        head_room = self.limit - self.limit // 2 - len(self._head)
+        if head_room > 0:
+            self._head += data[:head_room]
+            data = data[head_room:]
+        self._tail += data
+        if len(self._tail) > self.limit // 2:
+            del self._tail[:len(self._tail) - self.limit // 2]
+
+    def text(self) -> str:
+        """
+        Decodes the captured bytes, marking where bytes were dropped.
+
+        Returns:
+            The captured text
+        """
+        dropped = self.total - len(self._head) - len(self._tail)
+        if dropped == 0:
+            return _to_text(bytes(self._head + self._tail))
+        return (_to_text(bytes(self._head))
+                + f"\n... [{dropped} bytes truncated] ...\n"
+                + _to_text(bytes(self._tail)))
+
+
+class StreamSink:
+    """
+    Destination of an output stream, feeding each chunk to the capture and the comparison,
+    and calling back once on the first mismatch.
+    """
+    def __init__(self, capture: BoundedCapture, comparator: Comparator | None = None,
+                 on_mismatch: Callable[[], None] | None = None):
+        self.capture = capture
+        self.comparator = comparator
+        self.on_mismatch = on_mismatch
+        self._decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder('utf-8')(errors='replace'), translate=True
+        )
+
+    def write(self, chunk: bytes) -> None:
+        """
+        Feeds the next chunk of the stream.
+        """
+        self.capture.write(chunk)
+        if self.comparator is not None and self.comparator.matched:
+            if not self.comparator.feed(self._decoder.decode(chunk)) \
+                    and self.on_mismatch is not None:
+                self.on_mismatch()
+
+    def close(self) -> None:
+        """
+        Feeds the end of the stream.
+        """
+        if self.comparator is not None:
+            self.comparator.feed(self._decoder.decode(b'', final=True))
+
+
+def _pump(stream: BinaryIO, sink: StreamSink) -> None:
+    """
+    Reads an output pipe into a sink until it is closed.
+    """
+    with stream:
+        while chunk := stream.read1(CHUNK_SIZE):
+            sink.write(chunk)
+    sink.close()
+
+
+def _kill(pid: int) -> None:
+    """
+    Kills a process started in its own session along with everything it started.
+    """
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _feed(stream: BinaryIO, data: str | None) -> None:
+    """
+    Writes the input of a process and closes its stdin, ignoring a process that exits early.
+    """
+    try:
+        with stream:
+            if data:
+                stream.write(data.encode('utf-8'))
+    except (BrokenPipeError, OSError):
+        pass
+
+
+class _Launcher:
+    """
+    Launcher process (see amfs/launcher.py) forking the executions of one thread, so that
+    they are not charged with the peak memory of the server.
+    """
+    def __init__(self):
+        """
+        Starts a launcher process connected through a socket.
+        """
+        self._channel, remote = socket.socketpair()
+        with remote:
+            self.process = subprocess.Popen(
+                [sys.executable, "-S", "-I", launcher.__file__, str(remote.fileno())],
+                stdin=subprocess.DEVNULL, pass_fds=[remote.fileno()]
+            )
+        self.pid = os.getpid()
+        weakref.finalize(self, self._channel.close)
+
+    def alive(self) -> bool:
+        """
+        Whether this launcher can still be used by the current process.
+        """
+        return self.pid == os.getpid() and self.process.poll() is None
+
+    def start(self, command: list[str] | str, cwd: str | os.PathLike, limits: Limits | None,
+              stdio: list[int]) -> int:
+        """
+        Starts a command with the specified stdin, stdout and stderr in its own session.
+
+        Args:
+            command: Argument list to be launched directly, or a shell command string
+            cwd: Working directory of the command
+            limits: Resource limits of the command and every process it starts, or None
+            stdio: File descriptors of stdin, stdout and stderr of the command
+
+        Returns:
+            Process ID of the command, which is also its process group ID
+        """
+        launcher.send(self._channel, {
+            'args': command if isinstance(command, str) else [os.fspath(arg) for arg in command],
+            'cwd': os.fspath(cwd),
+            'limits': dataclasses.astuple(limits) if limits is not None else []
+        }, stdio)
+        started = self._receive()
+        if 'error' in started:
+            self._receive()
+            raise OSError(started['error'])
+        return started['pid']
+
+    def wait(self) -> tuple[int, float, float, int]:
+        """
+        Waits for the started command to exit.
+
+        Returns:
+            The wait status, user and system CPU time in seconds and peak memory in bytes
+        """
+        exited = self._receive()
+        return exited['status'], exited['user_time'], exited['system_time'], exited['max_rss']
+
+    def _receive(self) -> dict:
+        received = launcher.receive(self._channel)
+        if received is None:
+            raise RuntimeError(f"Launcher exited with code {self.process.wait()}")
+        return received[0]
+
+
+# Launchers of threads in this process, by thread
+_launchers = threading.local()
+
+
+def _launcher() -> _Launcher:
+    """
+    Gets the launcher of the current thread, starting a new one if it is not running.
+    """
+    if getattr(_launchers, 'launcher', None) is None or not _launchers.launcher.alive():
+        _launchers.launcher = _Launcher()
+    return _launchers.launcher
+
+
+def _reap(forker: _Launcher, start: float, result: list[tuple[int, Usage]]) -> None:
+    """
+    Waits for the command started by a launcher to exit, recording its exit code and the
+    resources it used.
+    """
+    status, user_time, system_time, max_rss = forker.wait()
+    result.append((os.waitstatus_to_exitcode(status),
+                   Usage(wall_time=time.monotonic() - start, user_time=user_time,
+                         system_time=system_time, max_rss=max_rss)))
+
+
+def execute(
+        command: list[str] | str,
+        cwd: str,
+        stdin: str | None,
+        timeout: float,
+        stdout_limit: int | None,
+        stderr_limit: int | None,
+        comparator: Comparator | None = None,
+        fail_fast: bool = False,
+        limits: Limits = None
+) -> Execution:
+    """
+    Executes a command with its stdout and stderr streamed through bounded captures, so that
+    memory used per execution stays bounded whatever the program prints.
+
+    Args:
+        command: Argument list to be launched directly, or a shell command string
+        cwd: Working directory of the command
+        stdin: Input written to the command
+        timeout: Seconds before the command is killed
+        stdout_limit: Maximum number of stdout bytes kept, or None to keep everything
+        stderr_limit: Maximum number of stderr bytes kept, or None to keep everything
+        comparator: Comparison of stdout against the expected output while streaming,
+         or None to skip comparison
+        fail_fast: Whether to kill the command as soon as its stdout mismatches
+        limits: Resource limits of the command and every process it starts, or None
+
+    Returns:
+        An Execution object as the result, where exceeding the CPU time limit counts as
+        a timeout
+    """
+    # The command runs in its own process group, so that everything started by the shell is
+    # killed with it, and nothing keeps running or holding the output pipes afterwards. It is
+    # forked by the launcher of this thread, and only its ends of the pipes are handed over
+    start = time.monotonic()
+    forker = _launcher()
+    stdin_read, stdin_write = os.pipe()
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    try:
+        pid = forker.start(command, cwd, limits, [stdin_read, stdout_write, stderr_write])
+    except BaseException as e:
+        for fd in (stdin_write, stdout_read, stderr_read):
+            os.close(fd)
+        if not isinstance(e, OSError):
+            raise
+        # Reported like the shell does for a program that cannot be run
+        return Execution(returncode=127, stdout="", stderr=f"{e}\n", timed_out=False,
+                         matched=False if comparator is not None else None,
+                         usage=Usage(wall_time=time.monotonic() - start, user_time=0,
+                                     system_time=0, max_rss=0))
+    finally:
+        for fd in (stdin_read, stdout_write, stderr_write):
+            os.close(fd)
+    stdout, stderr = BoundedCapture(stdout_limit), BoundedCapture(stderr_limit)
+    stopped = threading.Event()
+
+    def stop() -> None:
+        stopped.set()
+        _kill(pid)
+
+    threads = [
+        threading.Thread(target=_feed, args=(open(stdin_write, 'wb'), stdin), daemon=True),
+        threading.Thread(target=_pump, args=(open(stdout_read, 'rb'), StreamSink(
+            stdout, comparator, stop if fail_fast else None)), daemon=True),
+        threading.Thread(target=_pump, args=(open(stderr_read, 'rb'), StreamSink(stderr)),
+                         daemon=True)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # The launcher reaps the process with wait4 to collect its resource usage
+    result: list[tuple[int, Usage]] = []
+    reaper = threading.Thread(target=_reap, args=(forker, start, result), daemon=True)
+    reaper.start()
+    reaper.join(timeout)
+    timed_out = reaper.is_alive()
+    _kill(pid)
+    reaper.join()
+    for thread in threads:
+        thread.join()
+    if not result:
+        raise RuntimeError("Launcher exited before the execution was reaped")
+    returncode, usage = result[0]
+
+    # Processes exceeding the CPU time limit get SIGXCPU, then SIGKILL a second later if they
+    # survive, which the shell reports as 128 plus the signal if it did not exec the command
+    if limits is not None and limits.cpu_time is not None:
+        killed_by = returncode - 128 if returncode > 128 else -returncode
+        if killed_by == signal.SIGXCPU or (killed_by == signal.SIGKILL
+                                           and usage.cpu_time >= limits.cpu_time):
+            timed_out = True
+
+    return Execution(
+        returncode=None if timed_out else returncode,
+        stdout=stdout.text(),
+        stderr=stderr.text(),
+        timed_out=timed_out and not stopped.is_set(),
+        matched=comparator.result() if comparator is not None else None,
+        stopped=stopped.is_set(),
+        usage=usage
+    )
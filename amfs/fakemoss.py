@@ -0,0 +1,251 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+
+Local stand-in for MOSS server, for development and testing without network access. It
+speaks the MOSS submission protocol, matches the uploaded files with the local winnowing
+engine, and serves the report in the same HTML layout as MOSS. Delays and failures can be
+injected to exercise timeouts and retries.
+
+Usage (from the top level directory):
+    python -m amfs.fakemoss [--port 7690] [--http-port 8000] [--delay 0] [--failures 0]
+
+Then point AMFS to it in the instance config:
+    MOSS_SERVER = "localhost"
+    MOSS_PORT = 7690
+"""
+
+import argparse
+import html
+import itertools
+import re
+import socketserver
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import PurePosixPath
+
+import mosspy
+
+from amfs import winnowing
+
+
+class _SubmissionHandler(socketserver.StreamRequestHandler):
+    """
+    Handler of one connection sending files for detection.
+    """
+    server: '_SubmissionServer'
+
+    def handle(self) -> None:
+        fake = self.server.fake
+        if fake.fail():
+            return
+
+        options: dict[str, str] = dict()
+        files: list[tuple[str, str]] = []
+        while line := self.rfile.readline():
+            command, _, argument = line.decode().rstrip("\n").partition(" ")
+            if command == "language":
+                fake.wait()
+                accepted = argument in mosspy.Moss.languages
+                self.wfile.write(b"yes\n" if accepted else b"no\n")
+            elif command == "file":
+                _, _, size, name = argument.split(" ", 3)
+                content = self.rfile.read(int(size))
+                files.append((name, content.decode('utf-8', errors='replace')))
+            elif command == "query":
+                fake.wait()
+                url = fake.report(files, int(options.get('maxmatches', 10)))
+                self.wfile.write(f"{url}\n".encode())
+            elif command == "end":
+                break
+            else:
+                options[command] = argument
+
+
+class _SubmissionServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple[str, int], fake: 'FakeMoss'):
+        super().__init__(address, _SubmissionHandler)
+        self.fake = fake
+
+
+class _ReportHandler(BaseHTTPRequestHandler):
+    """
+    Handler of requests for reports.
+    """
+    server: '_ReportServer'
+
+    def do_GET(self) -> None:
+        fake = self.server.fake
+        fake.wait()
+        report = fake.reports.get(self.path.rstrip('/'))
+        if report is None:
+            self.send_error(404)
+            return
+        if fake.fail():
+            self.send_error(503)
+            return
+
+        body = report.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class _ReportServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], fake: 'FakeMoss'):
+        super().__init__(address, _ReportHandler)
+        self.fake = fake
+
+
+class FakeMoss:
+    """
+    Fake MOSS server, running in background threads while used as a context manager.
+
+    Attributes:
+        host: Host name the server listens on
+        port: Port receiving submissions, chosen by the system if 0
+        http_port: Port serving reports, chosen by the system if 0
+        delay: Seconds to wait before answering each step, to exercise timeouts
+        failures: Number of connections and report requests to fail first, to exercise retries
+        reports: HTML contents of all reports, by url path
+    """
+    def __init__(self, host: str = "localhost", port: int = 0, http_port: int = 0,
+                 delay: float = 0, failures: int = 0):
+        """
+        Initiates a fake MOSS server without starting it.
+
+        Args:
+            host: Host name the server listens on
+            port: Port receiving submissions, chosen by the system if 0
+            http_port: Port serving reports, chosen by the system if 0
+            delay: Seconds to wait before answering each step, to exercise timeouts
+            failures: Number of connections and report requests to fail first, to exercise
+                retries
+        """
+        self.host = host
+        self.port = port
+        self.http_port = http_port
+        self.delay = delay
+        self.failures = failures
+        self.reports: dict[str, str] = dict()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._servers: list[socketserver.BaseServer] = []
+
+    def __enter__(self) -> 'FakeMoss':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """
+        Starts serving submissions and reports in background threads. The ports chosen by the
+        system are updated.
+
+        Returns:
+            None
+        """
+        self._servers = [_SubmissionServer((self.host, self.port), self),
+                         _ReportServer((self.host, self.http_port), self)]
+        self.port = self._servers[0].server_address[1]
+        self.http_port = self._servers[1].server_address[1]
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        """
+        Stops serving.
+
+        Returns:
+            None
+        """
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def wait(self) -> None:
+        """
+        Waits for the injected delay.
+        """
+        if self.delay:
+            time.sleep(self.delay)
+
+    def fail(self) -> bool:
+        """
+        Decides whether the current request fails, counting down the injected failures.
+        """
+        with self._lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+            return False
+
+    def report(self, files: list[tuple[str, str]], ignore_limit: int) -> str:
+        """
+        Matches uploaded files with the local winnowing engine, treating the directory of each
+        file as a submission, and keeps the report.
+
+        Args:
+            files: Display names and contents of uploaded files
+            ignore_limit: Maximum number of submissions a passage may appear in
+
+        Returns:
+            The report url
+        """
+        sources: dict[str, list[str]] = defaultdict(list)
+        for name, content in files:
+            sources[str(PurePosixPath(name).parent)].append(content)
+        directories = {PurePosixPath(directory).name: directory for directory in sources}
+        fingerprints = [winnowing.fingerprint_sources(PurePosixPath(directory).name, contents)
+                        for directory, contents in sources.items()]
+
+        def cell(match: str) -> str:
+            sm_id, share = re.fullmatch(r"(.*) \((\d+%)\)", match).groups()
+            return f'<A HREF="#">{html.escape(directories[sm_id])}/ ({share})</A>'
+
+        rows = "".join(f"<TR><TD>{cell(pair['sm_1'])}\n    <TD>{cell(pair['sm_2'])}\n"
+                       f"<TD ALIGN=right>{pair['line_match']}\n"
+                       for pair in winnowing.match(fingerprints, ignore_limit))
+        path = f"/results/{next(self._ids)}"
+        self.reports[path] = (
+            "<HTML><HEAD><TITLE>Moss Results</TITLE></HEAD><BODY>\n"
+            "<TABLE>\n<TR><TH>File 1<TH>File 2<TH>Lines Matched\n"
+            f"{rows}</TABLE>\n</BODY></HTML>\n"
+        )
+        return f"http://{self.host}:{self.http_port}{path}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake MOSS server for development.")
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--port', type=int, default=mosspy.Moss.port)
+    parser.add_argument('--http-port', type=int, default=8000)
+    parser.add_argument('--delay', type=float, default=0)
+    parser.add_argument('--failures', type=int, default=0)
+    args = parser.parse_args()
+
+    with FakeMoss(args.host, args.port, args.http_port, args.delay, args.failures) as fake:
+        print(f"Fake MOSS server receiving on port {fake.port}, "
+              f"serving reports on port {fake.http_port}")
+        threading.Event().wait()
+
+
+if __name__ == '__main__':
+    main()
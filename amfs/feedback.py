@@ -5,14 +5,20 @@ This file is part of AMFS, which is distributed under the terms of the GPLv3 Lic
 See the file LICENSE at the top level directory of this distribution for details.
 """
 
+import math
+import multiprocessing
 import os
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass, field
-from itertools import combinations
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable, Iterable
 
 from jinja2 import Template
 from weasyprint import HTML, CSS
 
+from amfs.execution import Usage
 from amfs.marking import TestCase, Attempt
 
 
@@ -25,15 +31,175 @@ class Submission:
         id: ID of this submission
         mark: Actual mark of this submission
         attempts: A list of all marking attempts of this submission
-        failed_tests: A set of test case IDs failed by this submission
-        passed_tests: A set of test case IDs passed by this submission
+        feedback: A list of feedback messages for this submission
+        failed_mask: Bitmask of test case IDs failed by this submission
+        passed_mask: Bitmask of test case IDs passed by this submission
     """
     id: str
     mark: float
     attempts: [Attempt]
-    failed_tests: set[int] = None
-    passed_tests: set[int] = None
     feedback: [str] = field(default_factory=list)
+    failed_mask: int = 0
+    passed_mask: int = 0
+
+    @property
+    def failed_tests(self) -> set[int]:
+        """
+        A set of test case IDs failed by this submission.
+        """
+        return ResultMatrix.unpack(self.failed_mask)
+
+    @property
+    def passed_tests(self) -> set[int]:
+        """
+        A set of test case IDs passed by this submission.
+        """
+        return ResultMatrix.unpack(self.passed_mask)
+
+
+class ResultMatrix:
+    """
+    Submissions-by-tests matrix of marking results, stored as packed bitsets.
+
+    Each submission is a row, holding its mark, with bitmasks of its failed and passed test
+    cases kept on the submission. Each test case is a column, holding a bitset of the submission
+    rows that passed it, so that counts are calculated by population count instead of walking
+    every attempt.
+
+    Attributes:
+        marks: Mark of each submission row
+        passed_columns: Bitset of submission rows passing each test case
+    """
+    def __init__(self, test_count: int):
+        """
+        Initiates an empty result matrix.
+
+        Args:
+            test_count: Number of test cases, including compilation
+        """
+        self.marks: [float] = []
+        self.passed_columns: [int] = [0] * test_count
+
+    @staticmethod
+    def pack(tests: Iterable[int]) -> int:
+        """
+        Encodes a set of test case IDs as a bitmask, where bit i is set if test case i is included.
+        For example: {0, 2} -> 0b101
+
+        Args:
+            tests: A set of test case IDs
+
+        Returns:
+            The bitmask of the set
+        """
+        result = 0
+        for tc_id in tests:
+            result |= 1 << tc_id
+        return result
+
+    @staticmethod
+    def unpack(mask: int) -> set[int]:
+        """
+        Decodes a bitmask into the set of test case IDs it includes.
+        For example: 0b101 -> {0, 2}
+
+        Args:
+            mask: Bitmask of test case IDs
+
+        Returns:
+            The set of test case IDs
+        """
+        result = set()
+        while mask:
+            low = mask & -mask
+            result.add(low.bit_length() - 1)
+            mask ^= low
+        return result
+
+    def __len__(self) -> int:
+        return len(self.marks)
+
+    def add(self, submission: Submission) -> None:
+        """
+        Adds a submission as a new row, and writes its failed and passed test cases
+        into the submission object.
+
+        Args:
+            submission: Submission object
+
+        Returns:
+            None
+        """
+        row = 1 << len(self.marks)
+        failed, passed = 0, 0
+        for attempt in submission.attempts:
+            if attempt.code == 0:
+                passed |= 1 << attempt.tc_id
+                self.passed_columns[attempt.tc_id] |= row
+            else:
+                failed |= 1 << attempt.tc_id
+
+        self.marks.append(submission.mark)
+        submission.failed_mask = failed
+        submission.passed_mask = passed
+
+    def pass_counts(self) -> [int]:
+        """
+        Counts the submissions passing each test case.
+
+        Returns:
+            A list of pass counts by test case ID
+        """
+        return [column.bit_count() for column in self.passed_columns]
+
+
+@lru_cache(maxsize=8)
+def _load_resources(template_file: str, template_mtime: int,
+                    css_file: str, css_mtime: int) -> tuple[Template, CSS]:
+    """
+    Compiles the html template and parses the css file for rendering feedback reports.
+    Results are cached per process by path and modification time, so that a job only
+    compiles them once while edited files are still picked up.
+
+    Args:
+        template_file: Path string to the html template file
+        template_mtime: Modification time of the html template file in ns
+        css_file: Path string to the css file for the template
+        css_mtime: Modification time of the css file in ns
+
+    Returns:
+        The compiled template and the parsed stylesheet
+    """
+    with open(template_file, 'r') as f:
+        template = Template(f.read())
+
+    return template, CSS(filename=css_file)
+
+
+def render_report(template_file: str, css_file: str, report: dict, submission: dict,
+                  target: str) -> None:
+    """
+    Renders a feedback report into a PDF file. This is a module-level function so that it can
+    be run in worker processes.
+
+    Args:
+        template_file: Path string to the html template file
+        css_file: Path string to the css file for the template
+        report: Template context of the marking job
+        submission: Template context of the submission
+        target: Path string to the PDF file
+
+    Returns:
+        None
+    """
+    template, css = _load_resources(template_file, os.stat(template_file).st_mtime_ns,
+                                    css_file, os.stat(css_file).st_mtime_ns)
+    content = template.render(report=report, submission=submission)
+
+    HTML(string=content).write_pdf(
+        target=target,
+        stylesheets=[css]
+    )
 
 
 # noinspection GrazieInspection
@@ -47,10 +213,13 @@ class FeedbackReport:
         template_file: Path string to the html template file
         css_file: Path string to the css file for the template
         submission_dir: Directory containing subdirectories of student submissions
-        submissions: A list of all submission objects
+        submissions: All submission objects, which may be consumed lazily as a stream
         tests: A list of all test case objects
         feedbacks: A list of all feedback strings
         feedback selection: A list of sets containing test case IDs corresponding to each feedback
+        progress: Function called with the submission ID whenever a report is rendered
+        render_workers: Number of worker processes rendering reports, 1 to render in-process
+        render_errors: Error messages of reports failed to render, by submission ID
     """
     def __init__(
             self,
@@ -59,10 +228,12 @@ class FeedbackReport:
             template_file: str,
             css_file: str,
             submission_dir: str,
-            submissions: [Submission],
+            submissions: Iterable[Submission],
             tests: [TestCase],
             feedbacks: [str],
-            feedback_selection: [frozenset[int]]
+            feedback_selection: [frozenset[int]],
+            progress: Callable[[str], None] = None,
+            render_workers: int = 1
     ):
         """
         Initiates a new feedback generation job.
@@ -73,11 +244,14 @@ class FeedbackReport:
             template_file: Path string to the html template file
             css_file: Path string to the css file for the template
             submission_dir: Directory containing subdirectories of student submissions
-            submissions: A list of all submission objects
+            submissions: All submission objects, which may be consumed lazily as a stream,
+             e.g. a generator yielding each submission once it has been marked
             tests: A list of all test case objects
             feedbacks: A list of all feedback strings
             feedback selection: A list of sets containing test case IDs
              corresponding to each feedback
+            progress: Function called with the submission ID whenever a report is rendered
+            render_workers: Number of worker processes rendering reports, 1 to render in-process
         """
         self.name = name
         self.full_mark = full_mark
@@ -88,47 +262,45 @@ class FeedbackReport:
         self.tests = tests
         self.feedbacks = feedbacks
         self.feedback_selection = feedback_selection
+        self.progress = progress
+        self.render_workers = max(1, render_workers)
+        self.render_errors: dict[str, str] = dict()
+        self._report = {
+            'name': self.name,
+            'full_mark': f"{self.full_mark:.1f}"
+        }
+
+        # Index of feedback selections as bitmasks, keeping the first feedback of duplicates
+        self._selection_index: [tuple[int, int]] = []
+        seen: set[int] = set()
+        for index, combination in enumerate(self.feedback_selection):
+            selection_mask = ResultMatrix.pack(combination)
+            if selection_mask not in seen:
+                seen.add(selection_mask)
+                self._selection_index.append((index, selection_mask))
 
         # Setting up for result stats
-        self.sm_mark_sum = 0.0
-        self.tc_stats = [{
-            'name': f"{tc.name}",
-            'mark': tc.mark,
-            'pass_count': 0
-        } for tc in tests]
-
-        for submission in self.submissions:
-            self.sm_mark_sum += submission.mark
-            submission.mark = round(submission.mark, 1)
-            submission.failed_tests = set()
-            submission.passed_tests = set()
-            for attempt in submission.attempts:
-                if attempt.code == 0:
-                    self.tc_stats[attempt.tc_id]['pass_count'] += 1
-                    submission.passed_tests.add(attempt.tc_id)
-                else:
-                    submission.failed_tests.add(attempt.tc_id)
-
-            print(f"Submission {submission.id}: fail: {submission.failed_tests}, pass: {submission.passed_tests}")
+        self.results = ResultMatrix(len(tests))
+        self.tc_stats: [dict] = []
+        self.usage: dict[int, [Usage]] = {test.id: [] for test in tests}
 
-    @staticmethod
-    def overridden_tests(tests: frozenset[int]) -> set[frozenset[int]]:
+    def _record(self, submission: Submission) -> None:
         """
-        Calculates all possible combinations of test case IDs in the given set.
-        This is used for discarding certain feedbacks already covered by combinatorial ones.
+        Records the attempts of a submission into the result matrix.
 
         Args:
-            tests: A set of test case IDs
+            submission: Submission object
 
         Returns:
-            A set of calculated set combinations
+            None
         """
-        result = set()
-        for r in range(1, len(tests)):
-            for combination in combinations(tests, r):
-                result.add(frozenset(combination))
+        self.results.add(submission)
+        submission.mark = round(submission.mark, 1)
+        for attempt in submission.attempts:
+            if attempt.usage is not None:
+                self.usage[attempt.tc_id].append(attempt.usage)
 
-        return result
+        print(f"Submission {submission.id}: fail: {submission.failed_tests}, pass: {submission.passed_tests}")
 
     @staticmethod
     def render_code(code: int) -> str:
@@ -174,79 +346,133 @@ class FeedbackReport:
         elif tag == "a":
             return f'<a href="#{content}" class="{state}">{content}</a>'
 
-    def _generate_feedback(self) -> None:
+    def _generate_feedback(self, submission: Submission) -> None:
         """
-        Generates feedback for all submissions. The process include comparing failed test cases
-        of a submission with feedback selections, resulting in a list of feedback messages
+        Generates feedback for a submission. The process include comparing failed test cases
+        of the submission with feedback selections, resulting in a list of feedback messages
         written into the submission object.
 
+        Args:
+            submission: Submission object
+
         Returns:
             None
         """
-        for submission in self.submissions:
-            print(f"Generating feedback for submission {submission.id}")
+        print(f"Generating feedback for submission {submission.id}")
+
+        # Skip submissions that pass all tests
+        failed = submission.failed_mask
+        if failed == 0:
+            print("> Pass")
+            return
+
+        # Feedback applies if all of its test cases are failed, unless it is covered by
+        # another applicable combinatorial feedback containing all of its test cases
+        matched = [(index, selection_mask) for index, selection_mask in self._selection_index
+                   if selection_mask & ~failed == 0]
+        feedback = [index for index, selection_mask in matched
+                    if not selection_mask
+                    or not any(other != selection_mask and selection_mask & ~other == 0
+                               for _, other in matched)]
+        print(f"> matched: {[index for index, _ in matched]}")
+        print(f"> feedback: {feedback}")
+        submission.feedback = [self.feedbacks[i] for i in feedback]
+
+    def _render_context(self, submission: Submission) -> dict:
+        """
+        Prepares the template context of the feedback report for a submission.
+
+        Args:
+            submission: Submission object
+
+        Returns:
+            The template context of the submission
+        """
+        return {
+            'id': submission.id,
+            'mark': f"{submission.mark:.1f}",
+            'failed_tests': [FeedbackReport.html_tc(self.tests[i], True, "a")
+                             for i in sorted(submission.failed_tests)],
+            'passed_tests': [FeedbackReport.html_tc(self.tests[i], False, "a")
+                             for i in sorted(submission.passed_tests)],
+            'feedback': submission.feedback,
+            'attempts': [{
+                'name': FeedbackReport.html_tc(self.tests[attempt.tc_id],
+                                               attempt.code != 0,
+                                               "h4"),
+                'code': FeedbackReport.render_code(attempt.code),
+                'output': attempt.output
+            } for attempt in submission.attempts]
+        }
 
-            # Skip submissions that pass all tests
-            if submission.failed_tests == set():
-                print("> Pass")
-                continue
+    def _render_args(self, submission: Submission) -> tuple:
+        """
+        Prepares the arguments of render_report for a submission.
 
-            temp: set[frozenset[int]] = set()
-            discarded: set[frozenset[int]] = set()
-            for combination in self.feedback_selection:
-                if combination <= submission.failed_tests:
-                    temp.add(combination)
-                    if len(combination) > 1:
-                        discarded |= FeedbackReport.overridden_tests(combination)
+        Args:
+            submission: Submission object
 
-            feedback = [self.feedback_selection.index(tests) for tests in temp - discarded]
-            print(f"> temp: {temp}")
-            print(f"> discarded: {discarded}")
-            print(f"> final: {temp - discarded}")
-            print(f"> feedback: {feedback}")
-            submission.feedback = [self.feedbacks[i] for i in feedback]
+        Returns:
+            A tuple of arguments for render_report
+        """
+        return (str(self.template_file), str(self.css_file), self._report,
+                self._render_context(submission),
+                str(self.submission_dir / submission.id / "feedback.pdf"))
 
-    def _render_report(self) -> None:
+    def _rendered(self, sm_id: str, error: BaseException | None) -> None:
         """
-        Renders feedback reports for all submissions and saves them directly into each corresponding
-        submission directories.
+        Records the outcome of rendering the feedback report for a submission.
+
+        Args:
+            sm_id: Submission ID
+            error: Exception raised while rendering, otherwise None
 
         Returns:
             None
         """
-        report = {
-            'name': self.name,
-            'full_mark': f"{self.full_mark:.1f}"
-        }
+        if error is not None:
+            print(f"> Failed to render report for submission {sm_id}: {error!r}")
+            self.render_errors[sm_id] = f"{type(error).__name__}: {error}"
+        if self.progress is not None:
+            self.progress(sm_id)
 
-        for submission in self.submissions:
-            print(f"Rendering report for submission {submission.id}")
-
-            sm_dict = {
-                'id': submission.id,
-                'mark': f"{submission.mark:.1f}",
-                'failed_tests': [FeedbackReport.html_tc(self.tests[i], True, "a")
-                                 for i in submission.failed_tests],
-                'passed_tests': [FeedbackReport.html_tc(self.tests[i], False, "a")
-                                 for i in submission.passed_tests],
-                'feedback': submission.feedback,
-                'attempts': [{
-                    'name': FeedbackReport.html_tc(self.tests[attempt.tc_id],
-                                                   attempt.code != 0,
-                                                   "h4"),
-                    'code': FeedbackReport.render_code(attempt.code),
-                    'output': attempt.output
-                } for attempt in submission.attempts]
-            }
-
-            with open(self.template_file, 'r') as f:
-                template = Template(f.read())
-                content = template.render(report=report, submission=sm_dict)
-
-            HTML(string=content).write_pdf(
-                target=self.submission_dir / submission.id / "feedback.pdf",
-                stylesheets=[CSS(filename=self.css_file)]
-            )
+    def _render_report(self, submission: Submission) -> None:
+        """
+        Renders the feedback report for a submission and saves it directly into the corresponding
+        submission directory. A failure is recorded without affecting other submissions.
+
+        Args:
+            submission: Submission object
+
+        Returns:
+            None
+        """
+        print(f"Rendering report for submission {submission.id}")
+        try:
+            render_report(*self._render_args(submission))
+            self._rendered(submission.id, None)
+        except Exception as e:
+            self._rendered(submission.id, e)
+
+    @staticmethod
+    def _distribution(values: [float], unit: str, scale: float = 1) -> dict[str, str] | None:
+        """
+        Summarizes a distribution of measurements by its median, 90th percentile and maximum,
+        using the nearest rank.
+
+        Args:
+            values: All measurements
+            unit: Unit appended to each statistic
+            scale: Factor converting measurements into the unit
+
+        Returns:
+            A dictionary of formatted statistics, otherwise None if there is no measurement
+        """
+        if not values:
+            return None
+        values = sorted(values)
+        return {name: f"{values[math.ceil(len(values) * q / 100) - 1] * scale:.2f} {unit}"
+                for name, q in (('median', 50), ('p90', 90), ('max', 100))}
 
     def _statistics(self) -> dict:
         """
@@ -255,13 +481,22 @@ class FeedbackReport:
         Returns:
             A dictionary of the results data.
         """
-        sm_count = len(self.submissions)
+        sm_count = len(self.results)
         full_mark = f"{self.full_mark:.2f}"
-        avg_mark = f"{self.sm_mark_sum / sm_count:.2f}"
-        for tc in self.tc_stats:
-            tc['full_mark'] = f"{tc['mark']:.2f}"
-            tc['avg_mark'] = f"{tc['mark'] * tc['pass_count'] / sm_count:.2f}"
-            tc['pass_rate'] = f"{tc['pass_count'] / sm_count:.0%}"
+        avg_mark = f"{sum(self.results.marks) / sm_count:.2f}"
+        self.tc_stats = [{
+            'id': tc.id,
+            'name': f"{tc.name}",
+            'mark': tc.mark,
+            'pass_count': pass_count,
+            'full_mark': f"{tc.mark:.2f}",
+            'avg_mark': f"{tc.mark * pass_count / sm_count:.2f}",
+            'pass_rate': f"{pass_count / sm_count:.0%}",
+            'wall_time': self._distribution([u.wall_time for u in self.usage[tc.id]], "s"),
+            'cpu_time': self._distribution([u.cpu_time for u in self.usage[tc.id]], "s"),
+            'max_rss': self._distribution([u.max_rss for u in self.usage[tc.id]], "MB",
+                                          1 / (1024 * 1024))
+        } for tc, pass_count in zip(self.tests, self.results.pass_counts())]
 
         print("Result statistics:")
         print("> sm_count:", sm_count)
@@ -273,18 +508,108 @@ class FeedbackReport:
             'sm_count': sm_count,
             'avg_mark': avg_mark,
             'full_mark': full_mark,
-            'tc_stats': self.tc_stats
+            'tc_stats': self.tc_stats,
+            'render_errors': self.render_errors
         }
 
+    def _executor(self) -> ProcessPoolExecutor:
+        """
+        Creates a process pool of render workers.
+        """
+        return ProcessPoolExecutor(max_workers=self.render_workers,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def _collect(self, pending: dict[Future, tuple[str, tuple]],
+                 return_when: str = 'ALL_COMPLETED') -> list[tuple[str, tuple]]:
+        """
+        Waits for reports rendering in worker processes, and records their outcomes. Reports
+        lost because a worker process died are returned instead, as every report in flight
+        fails once the pool is broken, not only the one that crashed the worker.
+
+        Args:
+            pending: Submission IDs and render arguments by futures of reports in flight
+            return_when: When to stop waiting, as in concurrent.futures.wait
+
+        Returns:
+            Submission IDs and render arguments of the reports lost to a broken pool
+        """
+        done, _ = wait(pending, return_when=return_when)
+        lost = []
+        for future in done:
+            sm_id, args = pending.pop(future)
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                lost.append((sm_id, args))
+            else:
+                self._rendered(sm_id, error)
+        if lost:
+            # The rest of the reports in flight are failing with the pool as well
+            lost += self._collect(pending)
+        return lost
+
+    def _recover(self, executor: ProcessPoolExecutor,
+                 lost: list[tuple[str, tuple]]) -> ProcessPoolExecutor:
+        """
+        Replaces a broken process pool, rendering the reports lost with it again one at a time,
+        so that only the report crashing its worker fails.
+
+        Args:
+            executor: The broken process pool
+            lost: Submission IDs and render arguments of the reports lost
+
+        Returns:
+            A new process pool
+        """
+        executor.shutdown()
+        executor = self._executor()
+        for sm_id, args in lost:
+            error = executor.submit(render_report, *args).exception()
+            if isinstance(error, BrokenProcessPool):
+                executor.shutdown()
+                executor = self._executor()
+            self._rendered(sm_id, error)
+        return executor
+
     def run(self) -> dict:
         """
-        Generates feedback, render and writes feedback reports.
+        Generates feedback, render and writes feedback reports. Submissions are processed one by
+        one as they are consumed, so only the submissions in process are kept in memory.
+        With more than one render worker, reports are rendered in a process pool while the next
+        submissions are being prepared. A worker process dying only fails its own report.
 
         Returns:
             The marking result statistics
         """
-        self._generate_feedback()
-        self._render_report()
+        if self.render_workers == 1:
+            for submission in self.submissions:
+                self._record(submission)
+                self._generate_feedback(submission)
+                self._render_report(submission)
+
+            return self._statistics()
+
+        # Render reports in worker processes, bounding the number of reports in flight
+        pending: dict[Future, tuple[str, tuple]] = dict()
+        executor = self._executor()
+        try:
+            for submission in self.submissions:
+                self._record(submission)
+                self._generate_feedback(submission)
+                args = self._render_args(submission)
+                try:
+                    pending[executor.submit(render_report, *args)] = (submission.id, args)
+                except BrokenProcessPool:
+                    # A worker died since the reports were last collected
+                    executor = self._recover(executor,
+                                             self._collect(pending) + [(submission.id, args)])
+                while len(pending) >= 2 * self.render_workers:
+                    if lost := self._collect(pending, FIRST_COMPLETED):
+                        executor = self._recover(executor, lost)
+            if lost := self._collect(pending):
+                executor = self._recover(executor, lost)
+        finally:
+            executor.shutdown()
+
         return self._statistics()
 
 
@@ -0,0 +1,404 @@
+/*
+ * Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+ *
+ * This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+ * See the file LICENSE at the top level directory of this distribution for details.
+ */
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.BufferedReader;
+import java.io.ByteArrayInputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.FileDescriptor;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.FileReader;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.management.ManagementFactory;
+import java.lang.management.MemoryMXBean;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.lang.reflect.Modifier;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Paths;
+import java.util.HashSet;
+import java.util.Locale;
+import java.util.Properties;
+import java.util.Set;
+import java.util.TimeZone;
+
+/**
+ * Runner executing Java programs one after another in a warm JVM, so that JVM startup is paid
+ * once per worker instead of once per execution. The JVM is started in the directory of the
+ * submission, which is the working directory of every program it runs.
+ *
+ * <p>Each program is loaded by its own class loader from its class path, so that no static
+ * state is shared between executions, and its main method is called with stdin, stdout and
+ * stderr redirected. Like the java launcher, the runner then waits for every non-daemon thread
+ * started by the program. System properties, the default locale, time zone and uncaught
+ * exception handler are restored afterwards, and output written by threads outliving the
+ * execution is dropped. Requests are read from stdin, and responses are written to stdout:
+ *
+ * <pre>
+ * ready:    'R'
+ * request:  class path (UTF), main class (UTF), number of arguments (int),
+ *           arguments (UTF each), CPU time limit in ns or 0 (long), length of input (int),
+ *           input (bytes)
+ * output:   'O' for stdout or 'E' for stderr, length (int), bytes
+ * exit:     'X', exit code (int), CPU time of the JVM in ns (long), peak resident set size
+ *           of the JVM in bytes (long), whether the JVM can run another program (boolean)
+ * </pre>
+ *
+ * <p>A program calling System.exit ends the runner. A program exceeding its CPU time limit,
+ * exhausting the JVM, leaving threads running or growing the JVM well beyond its size at
+ * startup ends it after its exit response. Either way a new runner takes over.
+ */
+public final class WarmRunner {
+    private static final int CHUNK_SIZE = 1 << 16;
+
+    private static final long WATCHDOG_INTERVAL_MS = 10;
+
+    // Growth of the resident set size beyond its size at startup after which the JVM is
+    // replaced, since the memory it keeps would count towards the peak of the next program
+    private static final long MAX_MEMORY_GROWTH = 64L << 20;
+
+    private static DataOutputStream channel;
+
+    private static com.sun.management.OperatingSystemMXBean system;
+
+    private static long startMemory;
+
+    // Execution watched for its CPU time limit, guarded by the class
+    private static long cpuStart;
+    private static long cpuLimit;
+    private static boolean running;
+
+    private WarmRunner() {
+    }
+
+    /**
+     * Output stream sending everything written to it as output frames of one type, until the
+     * execution it belongs to ends.
+     */
+    private static final class Frames extends OutputStream {
+        private final byte type;
+        private volatile boolean closed;
+
+        Frames(char type) {
+            this.type = (byte) type;
+        }
+
+        @Override
+        public void write(int b) throws IOException {
+            write(new byte[] {(byte) b}, 0, 1);
+        }
+
+        @Override
+        public void write(byte[] b, int off, int len) throws IOException {
+            if (len == 0) {
+                return;
+            }
+            synchronized (channel) {
+                if (closed) {
+                    return;
+                }
+                channel.writeByte(type);
+                channel.writeInt(len);
+                channel.write(b, off, len);
+                channel.flush();
+            }
+        }
+
+        @Override
+        public void close() {
+            closed = true;
+        }
+    }
+
+    /**
+     * Thread ending the JVM once the execution exceeds its CPU time limit, which counts every
+     * thread of the JVM, as the limit of a process would.
+     */
+    private static final class Watchdog extends Thread {
+        Watchdog() {
+            super("watchdog");
+            setDaemon(true);
+        }
+
+        @Override
+        public void run() {
+            while (true) {
+                try {
+                    Thread.sleep(WATCHDOG_INTERVAL_MS);
+                } catch (InterruptedException e) {
+                    return;
+                }
+                synchronized (WarmRunner.class) {
+                    long cpuTime = system.getProcessCpuTime() - cpuStart;
+                    if (running && cpuLimit > 0 && cpuTime >= cpuLimit) {
+                        try {
+                            sendExit(137, cpuTime, false);
+                        } catch (IOException e) {
+                            // The exit response is lost along with the JVM either way
+                        }
+                        Runtime.getRuntime().halt(137);
+                    }
+                }
+            }
+        }
+    }
+
+    public static void main(String[] args) throws IOException {
+        DataInputStream requests = new DataInputStream(
+                new BufferedInputStream(new FileInputStream(FileDescriptor.in)));
+        channel = new DataOutputStream(
+                new BufferedOutputStream(new FileOutputStream(FileDescriptor.out), CHUNK_SIZE));
+        system = (com.sun.management.OperatingSystemMXBean)
+                ManagementFactory.getOperatingSystemMXBean();
+        // Anything printed outside of an execution is dropped rather than corrupting responses
+        PrintStream idle = new PrintStream(OutputStream.nullOutputStream());
+        System.setOut(idle);
+        System.setErr(idle);
+        new Watchdog().start();
+        startMemory = memoryStatus("VmRSS:");
+
+        synchronized (channel) {
+            channel.writeByte('R');
+            channel.flush();
+        }
+        while (true) {
+            String classPath;
+            try {
+                classPath = requests.readUTF();
+            } catch (EOFException e) {
+                return;
+            }
+            String mainClass = requests.readUTF();
+            String[] programArgs = new String[requests.readInt()];
+            for (int i = 0; i < programArgs.length; i++) {
+                programArgs[i] = requests.readUTF();
+            }
+            long limit = requests.readLong();
+            byte[] input = new byte[requests.readInt()];
+            requests.readFully(input);
+
+            boolean reusable = run(classPath, mainClass, programArgs, limit, input);
+            System.setIn(InputStream.nullInputStream());
+            System.setOut(idle);
+            System.setErr(idle);
+            if (!reusable) {
+                Runtime.getRuntime().halt(0);
+            }
+        }
+    }
+
+    /**
+     * Runs the main method of a program, waits for its non-daemon threads and writes its exit
+     * response.
+     *
+     * @return Whether the JVM can run another program
+     */
+    private static boolean run(String classPath, String mainClass, String[] programArgs,
+                               long limit, byte[] input) throws IOException {
+        Frames outFrames = new Frames('O');
+        Frames errFrames = new Frames('E');
+        PrintStream out = new PrintStream(new BufferedOutputStream(outFrames, CHUNK_SIZE),
+                                          false, StandardCharsets.UTF_8);
+        PrintStream err = new PrintStream(new BufferedOutputStream(errFrames, CHUNK_SIZE),
+                                          true, StandardCharsets.UTF_8);
+        Properties properties = (Properties) System.getProperties().clone();
+        Locale locale = Locale.getDefault();
+        Locale displayLocale = Locale.getDefault(Locale.Category.DISPLAY);
+        Locale formatLocale = Locale.getDefault(Locale.Category.FORMAT);
+        TimeZone timeZone = TimeZone.getDefault();
+        Thread.UncaughtExceptionHandler handler = Thread.getDefaultUncaughtExceptionHandler();
+        Set<Thread> threads = new HashSet<Thread>(Thread.getAllStackTraces().keySet());
+
+        System.setIn(new ByteArrayInputStream(input));
+        System.setOut(out);
+        System.setErr(err);
+        resetPeakMemory();
+        synchronized (WarmRunner.class) {
+            cpuStart = system.getProcessCpuTime();
+            cpuLimit = limit;
+            running = true;
+        }
+
+        int code = 0;
+        boolean reusable = true;
+        Thread thread = Thread.currentThread();
+        ClassLoader context = thread.getContextClassLoader();
+        URLClassLoader loader = new URLClassLoader(urls(classPath),
+                                                   ClassLoader.getPlatformClassLoader());
+        try {
+            Method main = Class.forName(mainClass, true, loader).getMethod("main", String[].class);
+            if (!Modifier.isStatic(main.getModifiers())) {
+                throw new NoSuchMethodException(mainClass + ".main(String[]) is not static");
+            }
+            main.setAccessible(true);
+            thread.setContextClassLoader(loader);
+            main.invoke(null, new Object[] {programArgs});
+        } catch (InvocationTargetException e) {
+            err.print("Exception in thread \"main\" ");
+            e.getCause().printStackTrace(err);
+            code = 1;
+            reusable = !(e.getCause() instanceof VirtualMachineError);
+        } catch (ReflectiveOperationException e) {
+            notFound(err, mainClass, e);
+            code = 1;
+        } catch (LinkageError e) {
+            notFound(err, mainClass, e);
+            code = 1;
+        } finally {
+            thread.setContextClassLoader(context);
+        }
+        joinThreads(threads);
+        out.flush();
+        err.flush();
+        outFrames.close();
+        errFrames.close();
+        loader.close();
+
+        System.setProperties(properties);
+        Locale.setDefault(locale);
+        Locale.setDefault(Locale.Category.DISPLAY, displayLocale);
+        Locale.setDefault(Locale.Category.FORMAT, formatLocale);
+        TimeZone.setDefault(timeZone);
+        Thread.setDefaultUncaughtExceptionHandler(handler);
+        // Daemon threads still running would keep using the JVM of the next program
+        for (Thread started : Thread.getAllStackTraces().keySet()) {
+            if (!threads.contains(started) && started.isAlive()) {
+                reusable = false;
+            }
+        }
+        long memory = memoryStatus("VmRSS:");
+        if (startMemory >= 0 && memory - startMemory > MAX_MEMORY_GROWTH) {
+            reusable = false;
+        }
+
+        synchronized (WarmRunner.class) {
+            running = false;
+            sendExit(code, system.getProcessCpuTime() - cpuStart, reusable);
+        }
+        return reusable;
+    }
+
+    /**
+     * Waits for every non-daemon thread started since the snapshot of threads to end,
+     * including threads started by those threads.
+     */
+    private static void joinThreads(Set<Thread> before) {
+        boolean waited = true;
+        while (waited) {
+            waited = false;
+            for (Thread started : Thread.getAllStackTraces().keySet()) {
+                if (!before.contains(started) && !started.isDaemon() && started.isAlive()) {
+                    try {
+                        started.join();
+                    } catch (InterruptedException e) {
+                        Thread.currentThread().interrupt();
+                        return;
+                    }
+                    waited = true;
+                }
+            }
+        }
+    }
+
+    /**
+     * Writes the exit response of the current execution.
+     */
+    private static void sendExit(int code, long cpuTime, boolean reusable) throws IOException {
+        long peak = peakMemory();
+        synchronized (channel) {
+            channel.writeByte('X');
+            channel.writeInt(code);
+            channel.writeLong(cpuTime);
+            channel.writeLong(peak);
+            channel.writeBoolean(reusable);
+            channel.flush();
+        }
+    }
+
+    /**
+     * Reports a main class which cannot be loaded, like the java launcher.
+     */
+    private static void notFound(PrintStream err, String mainClass, Throwable e) {
+        err.println("Error: Could not find or load main class " + mainClass);
+        err.println("Caused by: " + e);
+    }
+
+    /**
+     * Resets the peak resident set size of the JVM to its current size, on Linux.
+     */
+    private static void resetPeakMemory() {
+        try {
+            FileOutputStream clearRefs = new FileOutputStream("/proc/self/clear_refs");
+            try {
+                clearRefs.write('5');
+            } finally {
+                clearRefs.close();
+            }
+        } catch (IOException e) {
+            // Not supported, the peak since the JVM started is reported instead
+        }
+    }
+
+    /**
+     * Reads the peak resident set size of the JVM, otherwise the memory committed by the JVM
+     * where it is not available.
+     */
+    private static long peakMemory() {
+        long peak = memoryStatus("VmHWM:");
+        if (peak >= 0) {
+            return peak;
+        }
+        MemoryMXBean memory = ManagementFactory.getMemoryMXBean();
+        return memory.getHeapMemoryUsage().getCommitted()
+                + memory.getNonHeapMemoryUsage().getCommitted();
+    }
+
+    /**
+     * Reads a memory size of the JVM from its status on Linux, e.g. "VmRSS:".
+     *
+     * @return The size in bytes, otherwise -1 if it is not available
+     */
+    private static long memoryStatus(String field) {
+        try {
+            BufferedReader status = new BufferedReader(new FileReader("/proc/self/status"));
+            try {
+                String line;
+                while ((line = status.readLine()) != null) {
+                    if (line.startsWith(field)) {
+                        return Long.parseLong(line.replaceAll("[^0-9]", "")) * 1024;
+                    }
+                }
+            } finally {
+                status.close();
+            }
+        } catch (IOException e) {
+            // Not on Linux
+        }
+        return -1;
+    }
+
+    /**
+     * Converts a class path of absolute paths into URLs for a class loader.
+     */
+    private static URL[] urls(String classPath) throws IOException {
+        String[] entries = classPath.split(java.io.File.pathSeparator);
+        URL[] urls = new URL[entries.length];
+        for (int i = 0; i < entries.length; i++) {
+            urls[i] = Paths.get(entries[i]).toUri().toURL();
+        }
+        return urls;
+    }
+}
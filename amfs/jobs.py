@@ -0,0 +1,272 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+"""
+
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from typing import Callable, Iterator
+
+from flask import Flask, current_app
+
+from amfs.database.db import Writer, clear_job_results, get_writer, insert_job_results
+
+# Jobs started by this process, by job ID
+_jobs: dict[int, 'Job'] = dict()
+_jobs_lock = threading.Lock()
+
+
+class Job:
+    """
+    Background job whose state is persisted in the Job table, and whose progress events are
+    kept in memory for streaming.
+
+    Attributes:
+        id: ID of this job
+        name: Name of this job
+        status: One of "new", "queued", "running", "done" and "failed"
+        stage: Name of the stage currently running
+        done: Number of items completed in the current stage
+        total: Number of items in the current stage
+        events: A list of all progress events of this job
+    """
+    def __init__(self, writer: Writer, jb_id: int, name: str):
+        """
+        Initiates a job record already inserted into the Job table.
+
+        Args:
+            writer: Writer of the database holding the Job table
+            jb_id: ID of this job
+            name: Name of this job
+        """
+        self.id = jb_id
+        self.name = name
+        self.status = "queued"
+        self.stage = None
+        self.done = 0
+        self.total = 0
+        self.events: [dict] = []
+        self._condition = threading.Condition()
+        self._writer = writer
+
+    def _persist(self, **columns) -> Future:
+        """
+        Schedules writing the specified columns of this job into the Job table.
+
+        Args:
+            **columns: Column values to be written
+
+        Returns:
+            A future completed once the columns are written
+        """
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        return self._writer.submit(
+            lambda db: db.execute(f"UPDATE Job SET {assignments} WHERE jb_id = ?",
+                                  (*columns.values(), self.id))
+        )
+
+    def _emit(self, **event) -> None:
+        """
+        Records a progress event and wakes up all streams waiting on this job.
+
+        Args:
+            **event: Extra fields of the event
+
+        Returns:
+            None
+        """
+        event.update(status=self.status, stage=self.stage, done=self.done, total=self.total)
+        self.events.append(event)
+        self._condition.notify_all()
+
+    def begin_stage(self, stage: str, total: int = 0) -> None:
+        """
+        Starts a new stage of this job.
+
+        Args:
+            stage: Name of the stage
+            total: Number of items in the stage
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self.status, self.stage, self.done, self.total = "running", stage, 0, total
+            self._persist(jb_status=self.status, jb_stage=stage, jb_done=0, jb_total=total)
+            self._emit()
+
+    def progress(self, item: str) -> None:
+        """
+        Marks one item of the current stage as completed. This may be called from any thread.
+
+        Args:
+            item: Name of the completed item, e.g. a submission ID
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self.done += 1
+            self._persist(jb_done=self.done)
+            self._emit(item=item)
+
+    def finish(self, result: dict, plagiarism: dict) -> None:
+        """
+        Completes this job with its results.
+
+        Args:
+            result: The marking result statistics
+            plagiarism: The extracted plagiarism information
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self._writer.submit(insert_job_results, self.id, result, plagiarism).result()
+            self.status = "done"
+            self._persist(jb_status=self.status, jb_finished=time.time()).result()
+            self._emit()
+
+    def fail(self, message: str) -> None:
+        """
+        Completes this job with an error.
+
+        Args:
+            message: Error message
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self.status = "failed"
+            self._persist(jb_status=self.status, jb_message=message,
+                          jb_finished=time.time()).result()
+            self._emit(message=message)
+
+    def stream(self, timeout: float = 15) -> Iterator[dict | None]:
+        """
+        Iterates over all progress events of this job until it completes. None is yielded
+        whenever no event arrives within the timeout, which can be used for keep-alive.
+
+        Args:
+            timeout: Seconds to wait for the next event
+
+        Returns:
+            An iterator of progress events
+        """
+        index = 0
+        while True:
+            with self._condition:
+                if index == len(self.events):
+                    self._condition.wait(timeout)
+                events = self.events[index:]
+                index = len(self.events)
+
+            if not events:
+                yield None
+            for event in events:
+                yield event
+                if event['status'] in ("done", "failed"):
+                    return
+
+
+def _work(app: Flask, job: Job, target: Callable[[Job, dict], None], config: dict) -> None:
+    """
+    Runs the target of a job within an application context, recording failures in the job.
+
+    Args:
+        app: Flask application
+        job: Job object
+        target: Function running the job
+        config: Configurations of the job
+
+    Returns:
+        None
+    """
+    with app.app_context():
+        try:
+            target(job, config)
+        except Exception as e:
+            traceback.print_exc()
+            job.fail(f"{type(e).__name__}: {e}")
+        finally:
+            with _jobs_lock:
+                _jobs.pop(job.id, None)
+
+
+def create(name: str) -> int:
+    """
+    Creates a new marking job that has not been started.
+
+    Args:
+        name: Name of the job
+
+    Returns:
+        ID of the new job
+    """
+    return get_writer().submit(lambda db: db.execute("""
+        INSERT INTO Job (jb_name, jb_status, jb_created) VALUES (?, ?, ?)
+    """, (name, "new", time.time())).lastrowid).result()
+
+
+def start(jb_id: int, name: str, target: Callable[[Job, dict], None], config: dict) -> bool:
+    """
+    Starts a created job in a separate thread, discarding the state of its previous run,
+    unless the job is already running in this process.
+
+    Args:
+        jb_id: ID of the job
+        name: Name of the job
+        target: Function running the job, taking the job object and its configurations
+        config: Configurations of the job
+
+    Returns:
+        Whether the job is started, False if it is already running
+    """
+    def reset(db: sqlite3.Connection) -> None:
+        clear_job_results(db, jb_id)
+        db.execute("""
+            UPDATE Job
+            SET jb_status = ?, jb_stage = NULL, jb_done = 0, jb_total = 0, jb_message = NULL,
+                jb_started = ?, jb_finished = NULL
+            WHERE jb_id = ?
+        """, ("queued", time.time(), jb_id))
+
+    writer = get_writer()
+    job = Job(writer, jb_id, name)
+    # Checked and registered at once, so that concurrent requests start the job only once
+    with _jobs_lock:
+        if jb_id in _jobs:
+            return False
+        _jobs[jb_id] = job
+    try:
+        writer.submit(reset).result()
+    except BaseException:
+        with _jobs_lock:
+            _jobs.pop(jb_id, None)
+        raise
+
+    threading.Thread(target=_work,
+                     args=(current_app._get_current_object(), job, target, config),
+                     name=f"job-{jb_id}",
+                     daemon=True).start()
+    return True
+
+
+def get(jb_id: int) -> Job | None:
+    """
+    Gets a job running in this process.
+
+    Args:
+        jb_id: ID of the job
+
+    Returns:
+        The job object, otherwise None if it is not running in this process
+    """
+    with _jobs_lock:
+        return _jobs.get(jb_id)
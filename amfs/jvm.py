@@ -0,0 +1,533 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+"""
+
+import glob
+import hashlib
+import os
+import select
+import shutil
+import signal
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+from amfs.comparators import Comparator
+from amfs.execution import BoundedCapture, Execution, Limits, StreamSink, Usage
+
+# Source of the runner executing programs in a warm JVM
+RUNNER_SOURCE = Path(__file__).parent / 'java' / 'WarmRunner.java'
+
+# Seconds to wait for a new JVM to be ready
+STARTUP_TIMEOUT = 30
+
+# Options of the java launcher taking the next argument as their value
+VALUE_OPTIONS = {"--add-exports", "--add-modules", "--add-opens", "--add-reads",
+                 "--enable-native-access", "--limit-modules", "--patch-module",
+                 "--upgrade-module-path"}
+# Options of the java launcher not running a main class from the class path
+UNSUPPORTED_OPTIONS = {"-jar", "-m", "--module", "--source", "--dry-run", "-version",
+                       "--version", "-h", "-help", "--help", "-p", "--module-path"}
+
+
+@dataclass
+class JavaCommand:
+    """
+    Execution command running a main class with the java launcher.
+    For example: "java -Xmx1g -cp . IdSum 1" -> JavaCommand("java", ["-Xmx1g"], ".", "IdSum", ["1"])
+
+    Attributes:
+        java: Path or name of the java launcher
+        options: Options of the JVM
+        class_path: Class path, relative to the submission directory
+        main_class: Fully qualified name of the main class
+        args: Arguments of the main method
+    """
+    java: str
+    options: list[str]
+    class_path: str
+    main_class: str
+    args: list[str]
+
+
+def parse_java(args: list[str] | str) -> JavaCommand | None:
+    """
+    Parses an execution command running a main class with the java launcher.
+
+    Args:
+        args: Argument list of the command, or a command string needing a shell
+
+    Returns:
+        The parsed command, otherwise None if it does anything else
+    """
+    if isinstance(args, str) or not args or Path(args[0]).name != "java":
+        return None
+
+    options, class_path = [], "."
+    index = 1
+    while index < len(args) and args[index].startswith("-"):
+        option = args[index]
+        if option in UNSUPPORTED_OPTIONS or option.startswith(("--module=", "--module-path=")):
+            return None
+        if option in ("-cp", "-classpath", "--class-path"):
+            if index + 1 == len(args):
+                return None
+            class_path = args[index + 1]
+            index += 2
+        elif option.startswith("--class-path="):
+            class_path = option.split("=", 1)[1]
+            index += 1
+        elif option in VALUE_OPTIONS:
+            options += args[index:index + 2]
+            index += 2
+        else:
+            options.append(option)
+            index += 1
+
+    if index >= len(args):
+        return None
+    return JavaCommand(java=args[0], options=options, class_path=class_path,
+                       main_class=args[index], args=args[index + 1:])
+
+
+@dataclass
+class WarmJvm:
+    """
+    Settings of executing Java programs in warm JVMs.
+
+    Attributes:
+        cache_dir: Directory keeping the compiled runner and its class data archive
+        cds: Whether JVMs share a dynamic class data archive of the runner and JDK classes,
+            created by the first JVM when it exits, which needs JDK 13 or later
+    """
+    cache_dir: str
+    cds: bool = True
+
+
+def compile_runner(java: str, cache_dir: Path) -> Path:
+    """
+    Compiles the runner with the javac next to the java launcher, unless compiled already.
+    Runners are kept by the digest of their source, so that an updated runner is compiled
+    again.
+
+    Args:
+        java: Path or name of the java launcher
+        cache_dir: Directory keeping compiled runners
+
+    Returns:
+        The directory containing the compiled runner
+    """
+    digest = hashlib.sha256(RUNNER_SOURCE.read_bytes()).hexdigest()[:16]
+    runner_dir = cache_dir / digest
+    if (runner_dir / 'WarmRunner.class').exists():
+        return runner_dir
+
+    launcher = shutil.which(java)
+    javac = Path(launcher).resolve().with_name('javac') if launcher else None
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        subprocess.run([str(javac) if javac and javac.exists() else "javac", "-d", tmp,
+                        str(RUNNER_SOURCE)], check=True, capture_output=True, timeout=120)
+        os.rename(tmp, runner_dir)
+    except OSError:
+        # Compiled by another process in the meantime
+        if not (runner_dir / 'WarmRunner.class').exists():
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return runner_dir
+
+
+def _read_exactly(stream: BinaryIO, size: int) -> bytes:
+    """
+    Reads the specified number of bytes, raising EOFError if the stream ends first.
+    """
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+
+class JvmWorker:
+    """
+    A warm JVM running the runner in a submission directory, executing one program at a time.
+
+    Attributes:
+        cwd: Working directory of the JVM and every program it executes
+        process: The JVM process
+        archiving: Whether the JVM writes the class data archive when it exits
+    """
+    def __init__(self, command: list[str], cwd: str, limits: Limits | None):
+        """
+        Starts a JVM and waits for it to be ready.
+
+        Args:
+            command: Command starting the runner
+            cwd: Working directory of the JVM and every program it executes
+            limits: Resource limits of the JVM as a whole, or None
+
+        Raises:
+            OSError: If the JVM fails to start in time
+        """
+        self.cwd = cwd
+        self.archiving = any(option.startswith("-XX:ArchiveClassesAtExit=") for option in command)
+        self.process = subprocess.Popen(
+            command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        try:
+            # Limits are set on the started JVM, well before it runs any program
+            if limits is not None:
+                limits.apply(self.process.pid)
+        except OSError:
+            self.kill()
+            raise
+        ready, _, _ = select.select([self.process.stdout], [], [], STARTUP_TIMEOUT)
+        if not ready or self.process.stdout.read(1) != b'R':
+            self.kill()
+            raise OSError(f"JVM failed to start: {' '.join(command)}")
+
+    def kill(self) -> None:
+        """
+        Kills the JVM along with everything it started.
+        """
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+    def close(self) -> None:
+        """
+        Asks the JVM to stop by closing its requests, letting it exit normally so that a class
+        data archive is written if requested.
+        """
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def join(self) -> None:
+        """
+        Waits for the JVM to exit after closing, killing it if it does not.
+        """
+        try:
+            self.process.wait(timeout=STARTUP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+    def _receive(self, stdout: StreamSink, stderr: StreamSink, result: list) -> None:
+        """
+        Reads output frames until the exit response, which is appended to the result.
+        """
+        stream = self.process.stdout
+        try:
+            while True:
+                frame = _read_exactly(stream, 1)
+                if frame == b'X':
+                    result.append(struct.unpack('>iqq?', _read_exactly(stream, 21)))
+                    return
+                size, = struct.unpack('>i', _read_exactly(stream, 4))
+                (stdout if frame == b'O' else stderr).write(_read_exactly(stream, size))
+        except (EOFError, OSError, ValueError):
+            pass
+
+    def run(self, command: JavaCommand, class_path: str, stdin: str | None, timeout: float,
+            cpu_time: float | None, stdout: StreamSink,
+            stderr: StreamSink) -> tuple[int, int, int, bool] | bool | None:
+        """
+        Executes a program in this JVM.
+
+        Args:
+            command: Execution command
+            class_path: Class path of absolute paths
+            stdin: Input written to the program
+            timeout: Seconds before the JVM is killed
+            cpu_time: Seconds of CPU time of the whole JVM before it is ended, or None
+            stdout: Destination of stdout
+            stderr: Destination of stderr
+
+        Returns:
+            The exit code, CPU time of the JVM in ns, peak resident set size of the JVM in
+            bytes and whether the JVM can run another program, otherwise False if the JVM was
+            killed on timeout, or None if the JVM exited
+        """
+        def utf(text: str) -> bytes:
+            data = text.encode('utf-8')
+            return struct.pack('>H', len(data)) + data
+
+        data = (stdin or "").encode('utf-8')
+        request = b''.join([utf(class_path), utf(command.main_class),
+                            struct.pack('>i', len(command.args)), *map(utf, command.args),
+                            struct.pack('>q', int(cpu_time * 1e9) if cpu_time else 0),
+                            struct.pack('>i', len(data)), data])
+        try:
+            self.process.stdin.write(request)
+            self.process.stdin.flush()
+        except OSError:
+            return None
+
+        result: list[tuple[int, int, int, bool]] = []
+        receiver = threading.Thread(target=self._receive, args=(stdout, stderr, result),
+                                    daemon=True)
+        receiver.start()
+        receiver.join(timeout)
+        if receiver.is_alive():
+            self.kill()
+            receiver.join()
+            return False
+        return result[0] if result else None
+
+
+class JvmPool:
+    """
+    Pool of warm JVMs executing Java programs, started as they are needed. Java cannot change
+    its working directory, so each JVM is started in a submission directory and only executes
+    programs of that submission, with idle JVMs of other submissions making room for it. A JVM
+    is replaced once it exits, is killed or is left unusable by a program.
+
+    Attributes:
+        command: Execution command
+        size: Maximum number of JVMs
+        limits: Resource limits, where memory, processes and file size apply to each JVM as a
+            whole, and CPU time is enforced by the JVM for each execution
+    """
+    def __init__(self, command: JavaCommand, size: int, settings: WarmJvm, limits: Limits = None):
+        """
+        Initiates an empty pool, compiling the runner if needed.
+
+        Args:
+            command: Execution command
+            size: Maximum number of JVMs
+            settings: Settings of warm JVMs
+            limits: Resource limits of executions, or None
+        """
+        self.command = command
+        self.size = size
+        self.limits = limits
+        cache_dir = Path(settings.cache_dir)
+        self._runner_dir = compile_runner(command.java, cache_dir)
+        self._archive = (self._runner_dir / 'runner.jsa') if settings.cds else None
+        self._jvm_limits = (Limits(memory=limits.memory, processes=limits.processes,
+                                   file_size=limits.file_size) if limits is not None else None)
+        self._idle: dict[str, list[JvmWorker]] = dict()
+        self._workers: set[JvmWorker] = set()
+        self._lock = threading.Lock()
+        self._archiving = False
+        self._disabled = False
+
+    @staticmethod
+    def create(args: list[str] | str, size: int, settings: WarmJvm,
+               limits: Limits = None) -> 'JvmPool | None':
+        """
+        Creates a pool for an execution command if it runs a main class with java.
+
+        Args:
+            args: Argument list of the execution command, or a command string needing a shell
+            size: Maximum number of JVMs
+            settings: Settings of warm JVMs
+            limits: Resource limits of executions, or None
+
+        Returns:
+            The pool, otherwise None if the command is not supported or the runner fails to
+            compile
+        """
+        command = parse_java(args)
+        if command is None:
+            print("> Execute command is not a plain java command, warm JVMs are not used.")
+            return None
+        try:
+            return JvmPool(command, size, settings, limits)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"> Failed to compile the warm JVM runner, warm JVMs are not used: {e}")
+            return None
+
+    def __enter__(self) -> 'JvmPool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _cds_options(self) -> list[str]:
+        """
+        Options sharing the class data archive, or creating it at exit by the first JVM.
+        """
+        if self._archive is None:
+            return []
+        if self._archive.exists():
+            return [f"-XX:SharedArchiveFile={self._archive}"]
+        with self._lock:
+            if self._archiving:
+                return []
+            self._archiving = True
+        return [f"-XX:ArchiveClassesAtExit={self._archive}"]
+
+    def _start(self, cwd: str) -> JvmWorker | None:
+        """
+        Starts a new JVM, retrying without the class data archive if the JVM does not support
+        it. Warm JVMs are disabled if none can be started.
+        """
+        # Warnings of the JVM are logged to stdout by default, where they would corrupt the frames
+        base = [self.command.java, *self.command.options, "-Xlog:disable",
+                "-Xlog:all=warning:stderr", "-cp", str(self._runner_dir)]
+        cds = self._cds_options()
+        for options in ([cds, []] if cds else [[]]):
+            try:
+                return JvmWorker([*base, *options, "WarmRunner"], cwd, self._jvm_limits)
+            except OSError as e:
+                error = e
+        print(f"> {error}, warm JVMs are not used.")
+        self._disabled = True
+        return None
+
+    def _acquire(self, cwd: str) -> JvmWorker | None:
+        """
+        Takes an idle JVM started in the directory, or starts a new one, stopping an idle JVM
+        of another directory if the pool is full.
+        """
+        evicted = None
+        with self._lock:
+            if cwd in self._idle:
+                return self._take_idle(cwd)
+            if len(self._workers) >= self.size and self._idle:
+                # The directory which has had idle JVMs the longest goes first
+                evicted = self._take_idle(next(iter(self._idle)))
+                self._workers.discard(evicted)
+        if evicted is not None:
+            evicted.close()
+            evicted.join()
+
+        worker = self._start(cwd)
+        if worker is not None:
+            with self._lock:
+                self._workers.add(worker)
+        return worker
+
+    def _take_idle(self, cwd: str) -> JvmWorker:
+        """
+        Takes an idle JVM of a directory, while holding the lock.
+        """
+        worker = self._idle[cwd].pop()
+        if not self._idle[cwd]:
+            del self._idle[cwd]
+        return worker
+
+    def _release(self, worker: JvmWorker) -> None:
+        """
+        Makes a JVM which executed a program available to the next program of its directory.
+        """
+        with self._lock:
+            if worker in self._workers:
+                self._idle.setdefault(worker.cwd, []).append(worker)
+
+    def _discard(self, worker: JvmWorker) -> None:
+        """
+        Removes a JVM which has exited, been killed or been left unusable by a program.
+        """
+        worker.kill()
+        with self._lock:
+            self._workers.discard(worker)
+            # A JVM killed before writing the class data archive leaves it to the next one
+            if worker.archiving:
+                self._archiving = False
+
+    def execute(
+            self,
+            cwd: str | Path,
+            stdin: str | None,
+            timeout: float,
+            stdout_limit: int | None,
+            stderr_limit: int | None,
+            comparator: Comparator | None = None
+    ) -> Execution | None:
+        """
+        Executes the command in a warm JVM, with the same result as execution.execute, except
+        that an execution is never stopped early on a mismatch, since killing a warm JVM
+        costs more than letting the program finish.
+
+        Args:
+            cwd: Submission directory, which is the working directory of the program and
+                against which the class path is resolved
+            stdin: Input written to the program
+            timeout: Seconds before the program is killed, along with its JVM
+            stdout_limit: Maximum number of stdout bytes kept, or None to keep everything
+            stderr_limit: Maximum number of stderr bytes kept, or None to keep everything
+            comparator: Comparison of stdout against the expected output while streaming,
+             or None to skip comparison
+
+        Returns:
+            An Execution object as the result, otherwise None if the program has to be
+            executed in its own JVM, e.g. as it called System.exit
+        """
+        if self._disabled:
+            return None
+        cwd = os.path.abspath(cwd)
+        worker = self._acquire(cwd)
+        if worker is None:
+            return None
+
+        class_path = os.pathsep.join(
+            path for entry in self.command.class_path.split(os.pathsep)
+            for path in (sorted(glob.glob(os.path.join(cwd, entry[:-1] + "*.jar")))
+                         if entry.endswith("*") else [os.path.abspath(os.path.join(cwd, entry))])
+        )
+        stdout, stderr = BoundedCapture(stdout_limit), BoundedCapture(stderr_limit)
+        stdout_sink, stderr_sink = StreamSink(stdout, comparator), StreamSink(stderr)
+        start = time.monotonic()
+        cpu_limit = self.limits.cpu_time if self.limits is not None else None
+        result = worker.run(self.command, class_path, stdin, timeout, cpu_limit, stdout_sink,
+                            stderr_sink)
+        wall_time = time.monotonic() - start
+        if result is None:
+            self._discard(worker)
+            return None
+        if result is False:
+            self._discard(worker)
+            returncode, cpu_time, max_rss = None, 0, 0
+        else:
+            returncode, cpu_time, max_rss, reusable = result
+            if reusable and worker.process.poll() is None:
+                self._release(worker)
+            else:
+                self._discard(worker)
+        stdout_sink.close()
+        stderr_sink.close()
+
+        # The JVM measures its CPU time as a whole, without telling user and system time apart
+        usage = Usage(wall_time=wall_time, user_time=cpu_time / 1e9, system_time=0,
+                      max_rss=max_rss)
+        timed_out = result is False or (self.limits is not None
+                                        and self.limits.cpu_time is not None
+                                        and usage.cpu_time >= self.limits.cpu_time)
+        return Execution(
+            returncode=None if timed_out else returncode,
+            stdout=stdout.text(),
+            stderr=stderr.text(),
+            timed_out=timed_out,
+            matched=comparator.result() if comparator is not None else None,
+            usage=usage
+        )
+
+    def close(self) -> None:
+        """
+        Stops all JVMs.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            workers, self._workers = self._workers, set()
+            self._idle.clear()
+        for worker in workers:
+            worker.close()
+        for worker in workers:
+            worker.join()
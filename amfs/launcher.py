@@ -0,0 +1,143 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+
+Launcher forking executions on behalf of the server. A forked process inherits the peak
+resident set size of its parent, which the kernel then reports as its own, so processes
+forked by the server would be charged with the memory of the server. Executions are forked
+from this small process instead, which is run apart from the amfs package with site packages
+disabled, so that only the standard library is loaded.
+
+The launcher serves the stream socket passed as its only argument, running one execution at
+a time. Each message is a JSON document prefixed with its length as 4 bytes:
+
+    request:  {"args", "cwd", "limits"}, with stdin, stdout and stderr of the execution
+              attached as file descriptors
+    started:  {"pid"} once the command is executed, otherwise {"error"}
+    exited:   {"status", "user_time", "system_time", "max_rss"} once it is reaped
+"""
+
+import json
+import os
+import resource
+import socket
+import struct
+import sys
+
+HEADER = struct.Struct(">I")
+
+# Resources limited by the request, in the order of its limits
+LIMITS = (resource.RLIMIT_CPU, resource.RLIMIT_AS, resource.RLIMIT_NPROC, resource.RLIMIT_FSIZE)
+
+
+def _read(channel: socket.socket, size: int, fds: list[int]) -> bytes | None:
+    """
+    Reads exactly the specified number of bytes, collecting the file descriptors attached.
+    """
+    data = b""
+    while len(data) < size:
+        chunk, received, _, _ = socket.recv_fds(channel, size - len(data), 3)
+        fds += received
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def receive(channel: socket.socket) -> tuple[dict, list[int]] | None:
+    """
+    Receives a message along with the file descriptors attached to it.
+
+    Args:
+        channel: Socket to receive from
+
+    Returns:
+        The message and the file descriptors, otherwise None if the socket is closed
+    """
+    fds: list[int] = []
+    header = _read(channel, HEADER.size, fds)
+    data = _read(channel, HEADER.unpack(header)[0], fds) if header is not None else None
+    if data is None:
+        for fd in fds:
+            os.close(fd)
+        return None
+    return json.loads(data), fds
+
+
+def send(channel: socket.socket, message: dict, fds: list[int] = ()) -> None:
+    """
+    Sends a message, attaching the file descriptors to it.
+
+    Args:
+        channel: Socket to send to
+        message: JSON serializable message
+        fds: File descriptors to attach
+
+    Returns:
+        None
+    """
+    data = json.dumps(message).encode()
+    data = HEADER.pack(len(data)) + data
+    sent = socket.send_fds(channel, [data], list(fds)) if fds else 0
+    channel.sendall(data[sent:])
+
+
+def child(args: list[str], cwd: str, limits: list[int | None], stdio: list[int],
+          error_pipe: int) -> None:
+    """
+    Runs in the forked child: starts a new session, applies the limits and executes the
+    command. Any failure is written to the error pipe, which is otherwise closed by exec.
+    """
+    try:
+        os.setsid()
+        os.chdir(cwd)
+        for limit, value in zip(LIMITS, limits):
+            if value is not None:
+                # The CPU time limit sends SIGXCPU first, then SIGKILL a second later
+                resource.setrlimit(limit, (value, value + 1 if limit == LIMITS[0] else value))
+        for target, fd in enumerate(stdio):
+            os.dup2(fd, target)
+        os.execvp(args[0], args)
+    except BaseException as e:
+        message = str(e) if getattr(e, 'filename', None) else f"{e}: {args[0]!r}"
+        os.write(error_pipe, message.encode())
+    finally:
+        os._exit(127)
+
+
+def main():
+    channel = socket.socket(fileno=int(sys.argv[1]))
+    os.set_inheritable(channel.fileno(), False)
+    while (received := receive(channel)) is not None:
+        request, stdio = received
+        for fd in stdio:
+            os.set_inheritable(fd, False)
+        args = request['args']
+        if isinstance(args, str):
+            args = ["/bin/sh", "-c", args]
+
+        error_read, error_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            child(args, request['cwd'], request['limits'], stdio, error_write)
+        os.close(error_write)
+        for fd in stdio:
+            os.close(fd)
+        with open(error_read, 'rb') as errors:
+            error = errors.read().decode(errors='replace')
+        send(channel, {'error': error} if error else {'pid': pid})
+
+        _, status, usage = os.wait4(pid, 0)
+        send(channel, {
+            'status': status,
+            'user_time': usage.ru_utime,
+            'system_time': usage.ru_stime,
+            # Peak memory is reported in kilobytes, except on macOS where it is in bytes
+            'max_rss': usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+        })
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,23 @@ This file is part of AMFS, which is distributed under the terms of the GPLv3 Lic
 See the file LICENSE at the top level directory of this distribution for details.
 """
 
+import hashlib
 import os
+import re
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Iterator, Mapping
+
+from amfs.cache import CompileCache, SolutionCache, snapshot, source_digest
+from amfs import comparators
+from amfs.execution import Limits, Usage, execute, parse_command
+from amfs.jvm import JvmPool, WarmJvm
+
+# JVM heap options reserving memory for each execution, e.g. -Xms1920m
+HEAP_OPTION = re.compile(r"-Xm[sx](\d+)([kKmMgG]?)(?!\S)")
 
 
 @dataclass
@@ -42,12 +55,20 @@ class Attempt:
               0 (PASS), 1 (COMPILE_ERROR), 2 (RUN_ERROR), 3 (TIME_LIMIT), 4 (WRONG_ANSWER)
         mark: Actual mark in this attempt
         output: stdout captured in this attempt, with stderr if applicable
+        fingerprint: Digest of all inputs deciding the result of an execution attempt, None if
+            the result may change without them, so it is not kept for reuse
+        usage: Resources used by the execution in this attempt, None for compilation
+        returncode: Exit code of the execution in this attempt, None for compilation and
+            timeouts
     """
     sm_id: str
     tc_id: int
     code: int   # 0: PASS, 1: COMPILE_ERROR, 2: RUN_ERROR, 3: TIME_LIMIT, 4: WRONG_ANSWER
     mark: float
     output: str
+    fingerprint: str = None
+    usage: Usage = None
+    returncode: int = None
 
 
 class AutoMarking:
@@ -61,6 +82,20 @@ class AutoMarking:
         tests: List of all test cases
         solution_dir: Directory containing the sample solution
         submission_dir: Directory containing subdirectories of student submissions
+        workers: Maximum number of submissions marked concurrently
+        process_slots: Maximum number of compile and execute processes running at the same time
+        source_patterns: Wildcard patterns matching source files of a submission
+        compile_cache: Cache of compilation results, or None to always compile
+        solution_cache: Cache of sample solution outputs, or None to always generate them
+        records: Previous execution results by fingerprint, or None to execute every attempt
+        output_limit: Maximum number of stdout bytes kept for each execution, or None
+        error_limit: Maximum number of stderr bytes kept for each execution, or None
+        comparison: Mode comparing outputs with sample solutions, one of comparators.MODES
+        tolerance: Maximum absolute or relative difference between numbers in "float" mode
+        fail_fast: Whether an execution is killed as soon as its output mismatches
+        limits: Resource limits of each execution, or None
+        warm_jvm: Settings of executing Java programs in warm JVMs, or None to start a JVM for
+            each execution
     """
     def __init__(
             self,
@@ -70,6 +105,20 @@ class AutoMarking:
             tests: [TestCase],
             solution_dir: str,
             submission_dir: str,
+            workers: int = 1,
+            max_processes: int = None,
+            memory_limit: int = None,
+            source_patterns: [str] = ("*.java",),
+            compile_cache: CompileCache = None,
+            solution_cache: SolutionCache = None,
+            records: Mapping[str, tuple[int, str, Usage | None, int | None]] = None,
+            output_limit: int = None,
+            error_limit: int = None,
+            comparison: str = "exact",
+            tolerance: float = 1e-6,
+            fail_fast: bool = True,
+            limits: Limits = None,
+            warm_jvm: WarmJvm = None
     ):
         """
         Initiates a new automated marking job.
@@ -81,22 +130,94 @@ class AutoMarking:
             tests: List of all test cases
             solution_dir: Directory containing the sample solution
             submission_dir: Directory containing subdirectories of student submissions
+            workers: Maximum number of submissions marked concurrently
+            max_processes: Maximum number of processes running at the same time,
+             defaults to the number of CPUs
+            memory_limit: Memory budget in MB shared by all running executions,
+             each execution is assumed to reserve the heap size in the execute command
+            source_patterns: Wildcard patterns matching source files of a submission
+            compile_cache: Cache of compilation results, or None to always compile
+            solution_cache: Cache of sample solution outputs, or None to always generate them
+            records: Previous execution results (code, output, usage, exit code) by
+             fingerprint, attempts with an unchanged fingerprint reuse these results instead of
+             being executed again
+            output_limit: Maximum number of stdout bytes kept for each execution, the head and
+             tail are kept when exceeded, while the whole stdout is still compared
+            error_limit: Maximum number of stderr bytes kept for each execution
+            comparison: Mode comparing outputs with sample solutions: "exact", "whitespace"
+             ignoring whitespace between tokens, or "float" with numbers within a tolerance
+            tolerance: Maximum absolute or relative difference between numbers in "float" mode
+            fail_fast: Whether an execution is killed as soon as its output mismatches, instead
+             of running until it exits
+            limits: Resource limits of each execution and every process it starts, which are
+             killed together on timeout
+            warm_jvm: Settings of executing submissions in a pool of warm JVMs, one per
+             process slot, if the execute command runs a main class with java. Programs which
+             call System.exit are executed again in their own JVM
         """
         self.compile_command = compile_command
         self.execute_command = execute_command
+        # Commands parsed once, launched without a shell unless they use shell syntax
+        self._compile_args = parse_command(compile_command)
+        self._execute_args = parse_command(execute_command)
         self.timeout = timeout
         self.tests = tests
         self.solution_dir = Path(solution_dir)
         self.submission_dir = Path(submission_dir)
-        self.submissions = [d for d in os.listdir(self.submission_dir)
-                            if os.path.isdir(self.submission_dir / d)]
+        self.submissions = sorted(d for d in os.listdir(self.submission_dir)
+                                  if os.path.isdir(self.submission_dir / d))
+        self.workers = max(1, workers)
+
+        # Global process budget, further bounded by memory if both sizes are known
+        self.process_slots = max(1, max_processes or os.cpu_count() or 1)
+        process_memory = AutoMarking.estimate_memory(execute_command)
+        if memory_limit and process_memory:
+            self.process_slots = max(1, min(self.process_slots, memory_limit // process_memory))
+        self._slots = threading.BoundedSemaphore(self.process_slots)
+        self._test_pool: ThreadPoolExecutor | None = None
+
+        self.source_patterns = source_patterns
+        self.compile_cache = compile_cache
+        self.solution_cache = solution_cache
+        self.records = records
+        self.output_limit = output_limit
+        self.error_limit = error_limit
+        self.comparison = comparison
+        self.tolerance = tolerance
+        self.fail_fast = fail_fast
+        self.limits = limits
+        self.warm_jvm = warm_jvm
+        self._jvm_pool: JvmPool | None = None
+        self._source_digests: dict[str, str] = dict()
+        self._test_digests: dict[int, str] = dict()
+
+    @staticmethod
+    def estimate_memory(command: str) -> int | None:
+        """
+        Estimates the memory reserved by one execution from the JVM heap options in the command.
+        For example: "java -Xms1920m -Xmx1920m IdSum" -> 1920
+
+        Args:
+            command: Execution command for marking
+
+        Returns:
+            The larger of the initial and maximum heap sizes in MB, otherwise None
+        """
+        units = {'': 1 / (1024 * 1024), 'k': 1 / 1024, 'm': 1, 'g': 1024}
+        sizes = [int(size) * units[unit.lower()] for size, unit in HEAP_OPTION.findall(command)]
+        return max(1, int(max(sizes))) if sizes else None
 
     @staticmethod
     def check_configs(
             compile_command: str,
             timeout: str,
             solution_dir: str,
-            submission_dir: str
+            submission_dir: str,
+            workers: str = "1",
+            max_processes: str = "",
+            memory_limit: str = "",
+            comparison: str = "exact",
+            tolerance: str = "0"
     ) -> str | None:
         """
         Checks if the configurations submitted is valid for marking.
@@ -106,6 +227,11 @@ class AutoMarking:
             timeout: Timeout limit
             solution_dir: Directory containing the sample solution
             submission_dir: Directory containing subdirectories of student submissions
+            workers: Maximum number of submissions marked concurrently
+            max_processes: Maximum number of processes running at the same time, optional
+            memory_limit: Memory budget in MB shared by all running executions, optional
+            comparison: Mode comparing outputs with sample solutions
+            tolerance: Maximum difference between numbers in "float" mode
 
         Returns:
             An error message explaining invalid config, otherwise None
@@ -118,6 +244,29 @@ class AutoMarking:
         except ValueError:
             error.append("Timeout should be an integer.")
 
+        try:
+            if int(workers) <= 0:
+                error.append("Number of workers should be greater than 0.")
+        except ValueError:
+            error.append("Number of workers should be an integer.")
+
+        if comparison not in comparators.MODES:
+            error.append(f"Output comparison should be one of: {', '.join(comparators.MODES)}.")
+
+        try:
+            if float(tolerance) < 0:
+                error.append("Tolerance should not be negative.")
+        except ValueError:
+            error.append("Tolerance should be a number.")
+
+        for value, name in ((max_processes, "Process limit"), (memory_limit, "Memory budget")):
+            if value:
+                try:
+                    if int(value) <= 0:
+                        error.append(f"{name} should be greater than 0.")
+                except ValueError:
+                    error.append(f"{name} should be an integer.")
+
         solution_dir = Path(solution_dir)
         submission_dir = Path(submission_dir)
         if not solution_dir.is_dir():
@@ -126,17 +275,18 @@ class AutoMarking:
             error.append(f"No such directory {submission_dir}.")
 
         if solution_dir.is_dir():
+            compile_args = parse_command(compile_command)
             try:
-                result = subprocess.run(compile_command,
+                result = subprocess.run(compile_args,
                                         stdout=subprocess.PIPE,
                                         stderr=subprocess.STDOUT,
-                                        shell=True,
+                                        shell=isinstance(compile_args, str),
                                         cwd=solution_dir)
                 if result.stdout:
                     if "error" in result.stdout.decode() or "error" in result.stdout.decode():
                         error.append("Failed to compile solution.")
 
-            except subprocess.CalledProcessError:
+            except (subprocess.CalledProcessError, OSError):
                 error.append("Failed to compile solution.")
 
         if submission_dir.is_dir():
@@ -146,39 +296,118 @@ class AutoMarking:
 
         return error if len(error) > 0 else None
 
-    def _get_solutions(self) -> str | None:
+    def _source_digest(self, submission: str) -> str:
+        """
+        Gets the digest of the source files of a specific submission, calculated once per job.
+
+        Args:
+            submission: Submission ID
+
+        Returns:
+            Hexadecimal digest of the submission sources
+        """
+        if submission not in self._source_digests:
+            self._source_digests[submission] = source_digest(self.submission_dir / submission,
+                                                             self.source_patterns)
+        return self._source_digests[submission]
+
+    def _fingerprint(self, submission: str, test: TestCase) -> str:
+        """
+        Calculates the fingerprint of executing a specific submission against a specific test
+        case, covering the submission sources, test input, sample solution, commands, timeout,
+        output and resource limits, comparison and whether JVMs are kept warm.
+
+        Args:
+            submission: Submission ID
+            test: Test case object
+
+        Returns:
+            Hexadecimal digest identifying the execution
+        """
+        if test.id not in self._test_digests:
+            self._test_digests[test.id] = hashlib.sha256(
+                f"{test.input or ''}\0{test.solution or ''}".encode()
+            ).hexdigest()
+
+        h = hashlib.sha256()
+        for part in (self._source_digest(submission), self._test_digests[test.id],
+                     self.compile_command, self.execute_command, str(self.timeout),
+                     str(self.output_limit), str(self.error_limit), self.comparison,
+                     str(self.tolerance), str(self.fail_fast), str(self.limits),
+                     str(self.warm_jvm is not None)):
+            h.update(part.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _generate_solution(self, test: TestCase) -> str | None:
         """
-        Generating sample solutions for all test cases.
+        Generating the sample solution for a specific test case.
+
+        Args:
+            test: Test case object
 
         Returns:
             An error message, otherwise None
         """
         try:
-            subprocess.run(self.compile_command, shell=True, cwd=self.solution_dir)
-        except subprocess.CalledProcessError:
-            return "Failed to compile solution."
-
-        for test in self.tests:
-            try:
+            with self._slots:
                 p = subprocess.run(
-                    self.execute_command,
-                    shell=True,
+                    self._execute_args,
+                    shell=isinstance(self._execute_args, str),
                     cwd=self.solution_dir,
                     capture_output=True,
                     check=True,
                     input=test.input,
                     text=True
                 )
-                test.solution = p.stdout
-            except subprocess.CalledProcessError:
-                return f"Error occurred when generating solution for test case: {test.name}."
+            test.solution = p.stdout
+        except (subprocess.CalledProcessError, OSError):
+            return f"Error occurred when generating solution for test case: {test.name}."
+
+        return None
+
+    def _get_solutions(self) -> str | None:
+        """
+        Generating sample solutions for all test cases. Outputs found in the solution cache are
+        loaded directly, the rest are generated concurrently after compiling the solution once.
+
+        Returns:
+            An error message, otherwise None
+        """
+        keys: dict[int, str] = dict()
+        missing = self.tests
+        if self.solution_cache is not None:
+            digest = source_digest(self.solution_dir, self.source_patterns)
+            for test in self.tests:
+                keys[test.id] = SolutionCache.key(digest, self.compile_command,
+                                                  self.execute_command, test.input)
+                test.solution = self.solution_cache.get(keys[test.id])
+            missing = [test for test in self.tests if test.solution is None]
+            print(f"Sample solutions loaded from cache: {len(self.tests) - len(missing)}.")
+
+        if missing:
+            try:
+                subprocess.run(self._compile_args, shell=isinstance(self._compile_args, str),
+                               cwd=self.solution_dir)
+            except (subprocess.CalledProcessError, OSError):
+                return "Failed to compile solution."
+
+            with ThreadPoolExecutor(max_workers=self.process_slots) as executor:
+                errors = [e for e in executor.map(self._generate_solution, missing) if e]
+            if errors:
+                return errors[0]
+
+            if self.solution_cache is not None:
+                for test in missing:
+                    self.solution_cache.put(keys[test.id], test.solution)
 
         print("Sample solutions generated.")
         return None
 
     def _compile_submission(self, submission: str) -> Attempt:
         """
-        Compiling a specific submission.
+        Compiling a specific submission. If a compile cache is configured, unchanged sources
+        get their build artifacts and result restored from the cache instead.
 
         Args:
             submission: Submission ID
@@ -186,32 +415,74 @@ class AutoMarking:
         Returns:
             An Attempt object as the result of the compilation
         """
+        directory = self.submission_dir / submission
+        key, before = None, None
+        if self.compile_cache is not None:
+            key = CompileCache.key(self._source_digest(submission), self.compile_command)
+            cached = self.compile_cache.restore(key, directory)
+            if cached is not None:
+                print("> Compile result restored from cache.")
+                return Attempt(sm_id=submission, tc_id=0, code=cached['code'], mark=0,
+                               output=cached['output'])
+            before = snapshot(directory)
+
         try:
-            subprocess.run(
-                self.compile_command,
-                shell=True,
-                cwd=self.submission_dir / submission,
-                capture_output=True,
-                check=True,
-                text=True
-            )
+            with self._slots:
+                subprocess.run(
+                    self._compile_args,
+                    shell=isinstance(self._compile_args, str),
+                    cwd=self.submission_dir / submission,
+                    capture_output=True,
+                    check=True,
+                    text=True
+                )
             print("> Compile success.")
             error = None
         except subprocess.CalledProcessError as e:
             print("> Compile failed.")
             error = e.stderr
+        except OSError as e:
+            # The compiler could not be run, which is not a result of the sources to cache
+            print("> Compile failed.")
+            error = f"{e}\n"
+            key = None
 
-        return Attempt(
+        attempt = Attempt(
             sm_id=submission,
             tc_id=0,
             code=0 if error is None else 1,
             mark=0,
             output="Compile success." if error is None else "Compile failed.\n" + error
         )
+        if key is not None:
+            self.compile_cache.store(key, directory, before, attempt.code, attempt.output)
+
+        return attempt
+
+    @staticmethod
+    def _reusable(code: int, returncode: int | None) -> bool:
+        """
+        Decides whether the result of an execution may be reused. Timeouts and processes killed
+        by a signal, which is how the kernel enforces resource limits, depend on the load of the
+        machine as much as on the submission. A shell that did not exec the command reports the
+        signal as 128 plus its number.
+
+        Args:
+            code: Result code of the execution
+            returncode: Exit code of the execution, None if unknown
+
+        Returns:
+            Whether the result only depends on the inputs of the execution
+        """
+        if code == 3:
+            return False
+        return code != 2 or (returncode is not None and 0 < returncode <= 128)
 
     def _execute_submission(self, submission: str, test: TestCase) -> Attempt:
         """
-        Executing a specific submission against a specific test case.
+        Executing a specific submission against a specific test case. If the fingerprint of
+        the execution is found in previous records, the recorded result is reused instead,
+        except for timeouts and executions killed by a signal, which are always run again.
 
         Args:
             submission: Submission ID
@@ -220,56 +491,131 @@ class AutoMarking:
         Returns:
             An Attempt object as the result of the execution
         """
-        print(f"> Running test case {test.id}.")
-        try:
-            result = subprocess.run(
-                self.execute_command,
-                shell=True,
-                cwd=self.submission_dir / submission,
-                capture_output=True,
-                check=True,
-                input=test.input,
-                text=True,
-                timeout=self.timeout
+        fingerprint = self._fingerprint(submission, test)
+        record = self.records.get(fingerprint) if self.records is not None else None
+        # Results kept before they were checked for reuse are checked here as well
+        if record is not None and self._reusable(record[0], record[3]):
+            print(f"> Reusing result of test case {test.id}.")
+            code, output, usage, returncode = record
+            return Attempt(
+                sm_id=submission,
+                tc_id=test.id,
+                code=code,
+                mark=test.mark if code == 0 else 0,
+                output=output,
+                fingerprint=fingerprint,
+                usage=usage,
+                returncode=returncode
             )
-            code = 0 if result.stdout == test.solution else 4
-            output = result.stdout
-        except subprocess.CalledProcessError as e:
-            code = 2
-            output = e.output + "\nRuntime error.\n" + e.stderr
-        except subprocess.TimeoutExpired as e:
+
+        def comparator() -> comparators.Comparator | None:
+            return (comparators.create(self.comparison, test.solution, self.tolerance)
+                    if test.solution is not None else None)
+
+        print(f"> Running test case {test.id}.")
+        with self._slots:
+            result = None
+            if self._jvm_pool is not None:
+                result = self._jvm_pool.execute(
+                    cwd=self.submission_dir / submission,
+                    stdin=test.input,
+                    timeout=self.timeout,
+                    stdout_limit=self.output_limit,
+                    stderr_limit=self.error_limit,
+                    comparator=comparator()
+                )
+            if result is None:
+                result = execute(
+                    self._execute_args,
+                    cwd=self.submission_dir / submission,
+                    stdin=test.input,
+                    timeout=self.timeout,
+                    stdout_limit=self.output_limit,
+                    stderr_limit=self.error_limit,
+                    comparator=comparator(),
+                    fail_fast=self.fail_fast,
+                    limits=self.limits
+                )
+        if result.timed_out:
             code = 3
-            output = e.output.decode('utf-8') + "\nTimeout expired."
+            output = result.stdout + "\nTimeout expired."
+        elif result.stopped:
+            code = 4
+            output = result.stdout + "\nExecution stopped at the first mismatch."
+        elif result.returncode != 0:
+            code = 2
+            output = result.stdout + "\nRuntime error.\n" + result.stderr
+        else:
+            code = 0 if result.matched else 4
+            output = result.stdout
+
+        if not self._reusable(code, result.returncode):
+            fingerprint = None
 
         return Attempt(
             sm_id=submission,
             tc_id=test.id,
             code=code,
             mark=test.mark if code == 0 else 0,
-            output=output
+            output=output,
+            fingerprint=fingerprint,
+            usage=result.usage,
+            returncode=result.returncode
         )
 
-    def run(self) -> [Attempt]:
+    def _mark_submission(self, submission: str) -> [Attempt]:
+        """
+        Marks a specific submission against compilation and all test cases.
+        The submission will not be executed if compilation fails, otherwise all test cases
+        are executed concurrently within the process budget.
+
+        Args:
+            submission: Submission ID
+
+        Returns:
+            A list of attempts of this submission, compilation first
+        """
+        print(f"Marking student submission: [{submission}].")
+        compile_attempt = self._compile_submission(submission)
+        attempts = [compile_attempt]
+        if compile_attempt.code == 0:
+            futures = [self._test_pool.submit(self._execute_submission, submission, test)
+                       for test in self.tests]
+            attempts.extend(future.result() for future in futures)
+
+        return attempts
+
+    def run(self) -> Iterator[Attempt]:
         """
         Runs the automated marking module:
         1. Getting sample solutions;
         2. Running all submissions against compilation and test cases;
-        The submission will not be executed if compilation fails.
+        The submission will not be executed if compilation fails. Java submissions are executed
+        in warm JVMs if configured.
+        Submissions are marked by a pool of workers, while the attempts are yielded as soon as
+        each submission is marked, grouped by submission in the order of submission IDs.
 
         Returns:
-            A list of attempts while marking
+            An iterator of attempts while marking
         """
         self._get_solutions()
-        attempts = []
-        for submission in self.submissions:
-            print(f"Marking student submission: [{submission}].")
-            compile_attempt = self._compile_submission(submission)
-            attempts.append(compile_attempt)
-            if compile_attempt.code == 0:
-                for test in self.tests:
-                    attempts.append(self._execute_submission(submission, test))
+        if self.compile_cache is not None:
+            self.compile_cache.evict()
+        if self.solution_cache is not None:
+            self.solution_cache.evict()
+        if self.warm_jvm is not None:
+            self._jvm_pool = JvmPool.create(self._execute_args, self.process_slots,
+                                            self.warm_jvm, self.limits)
 
-        return attempts
+        try:
+            with (ThreadPoolExecutor(max_workers=self.process_slots) as self._test_pool,
+                  ThreadPoolExecutor(max_workers=self.workers) as executor):
+                for submission_attempts in executor.map(self._mark_submission, self.submissions):
+                    yield from submission_attempts
+        finally:
+            if self._jvm_pool is not None:
+                self._jvm_pool.close()
+                self._jvm_pool = None
 
 
 # Test the marking process is working
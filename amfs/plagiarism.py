@@ -5,18 +5,79 @@ This file is part of AMFS, which is distributed under the terms of the GPLv3 Lic
 See the file LICENSE at the top level directory of this distribution for details.
 """
 
+import multiprocessing
 import os
+import socket
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, timedelta
+from functools import partial
+from pathlib import Path
+from typing import Callable, TypeVar
 from urllib.error import HTTPError, URLError
 from urllib.request import urlopen
 
 import mosspy
 from bs4 import BeautifulSoup
 
+from amfs import similarity, winnowing
+
 # MOSS registered user id
 # https://theory.stanford.edu/~aiken/moss/
 USER_ID = 569350584
 
+T = TypeVar('T')
+
+
+class MossClient(mosspy.Moss):
+    """
+    MOSS client talking to a configurable server over a socket with a timeout, where mosspy
+    always connects to the Stanford server and waits on it indefinitely.
+
+    Attributes:
+        server: Host name of MOSS server
+        port: Port of MOSS server
+        timeout: Seconds to wait for connecting, and for each read or write on the socket
+    """
+    def __init__(self, user_id: int, language: str, server: str, port: int, timeout: float):
+        super().__init__(user_id, language)
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+
+    def uploadFile(self, s: socket.socket, file_path: str, display_name: str | None,
+                   file_id: int, on_send: Callable[[str, str], None]) -> None:
+        if display_name is None:
+            display_name = file_path.replace(" ", "_").replace("\\", "/")
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        s.sendall(f"file {file_id} {self.options['l']} {len(content)} {display_name}\n".encode())
+        s.sendall(content)
+        on_send(file_path, display_name)
+
+    def send(self, on_send=lambda file_path, display_name: None) -> str:
+        options = self.options
+        with socket.create_connection((self.server, self.port), timeout=self.timeout) as s:
+            for line in (f"moss {self.user_id}", f"directory {options['d']}", f"X {options['x']}",
+                         f"maxmatches {options['m']}", f"show {options['n']}",
+                         f"language {options['l']}"):
+                s.sendall(f"{line}\n".encode())
+            if s.recv(1024).strip() == b"no":
+                s.sendall(b"end\n")
+                raise ValueError(f"Language not accepted by MOSS server: {options['l']}")
+
+            for file_path, display_name in self.base_files:
+                self.uploadFile(s, file_path, display_name, 0, on_send)
+            for index, (file_path, display_name) in enumerate(self.files, start=1):
+                self.uploadFile(s, file_path, display_name, index, on_send)
+
+            s.sendall(f"query 0 {options['c']}\n".encode())
+            response = s.recv(1024)
+            s.sendall(b"end\n")
+
+        return response.decode().replace("\n", "")
+
 
 class PlagDetection:
     """
@@ -26,12 +87,24 @@ class PlagDetection:
         language: Programming language for detection
         submission_dir: Directory containing subdirectories of student submissions
         ignore_limit: Maximum number of times a given passage may appear before it is ignored
+        backend: "moss" to detect on MOSS server, or "local" to detect offline by winnowing
+        workers: Number of worker processes fingerprinting submissions in the local backend
+        timeout: Seconds to wait on MOSS server for each step of sending and loading
+        retries: Number of times sending to MOSS and loading its report are retried
+        backoff: Seconds before the first retry, doubled for each retry after
     """
     def __init__(
             self,
             language: str,
             submission_dir: str,
-            ignore_limit: int
+            ignore_limit: int,
+            backend: str = "moss",
+            workers: int = 1,
+            server: str = mosspy.Moss.server,
+            port: int = mosspy.Moss.port,
+            timeout: float = 60,
+            retries: int = 3,
+            backoff: float = 2
     ):
         """
         Initiates a new plagiarism detection job.
@@ -40,13 +113,28 @@ class PlagDetection:
             language: Programming language for detection
             submission_dir: Directory containing subdirectories of student submissions
             ignore_limit: Maximum number of times a given passage may appear before it is ignored
+            backend: "moss" to detect on MOSS server, or "local" to detect offline by winnowing
+            workers: Number of worker processes fingerprinting submissions in the local backend
+            server: Host name of MOSS server
+            port: Port of MOSS server
+            timeout: Seconds to wait on MOSS server for each step of sending and loading
+            retries: Number of times sending to MOSS and loading its report are retried
+            backoff: Seconds before the first retry, doubled for each retry after
         """
         self.language = language
         self.submission_dir = submission_dir
         self.ignore_limit = ignore_limit
+        self.backend = backend
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._fingerprints: list[winnowing.Fingerprints] | None = None
+        if backend == "local":
+            return
 
         # Set up MOSS config
-        self.moss = mosspy.Moss(USER_ID, self.language)
+        self.moss = MossClient(USER_ID, self.language, server, port, timeout)
         self.moss.setIgnoreLimit(self.ignore_limit)
         self.moss.setDirectoryMode(1)
         self.moss.addFilesByWildcard(os.path.join(self.submission_dir,
@@ -97,36 +185,164 @@ class PlagDetection:
 
     def run(self) -> dict:
         """
-        Sends all detecting files to MOSS server, retrieves the report url, and extracts the
-        information within.
+        Detects plagiarism with the configured backend.
 
         Returns:
             A dictionary containing the extracted plagiarism information
         """
-        print(f"Detecting plagiarism over directory {self.submission_dir}")
-        url = None
+        if self.backend == "local":
+            return self.run_local()
+        return self.run_moss()
 
-        # Send files and get report url
-        while url is None:
-            print("> ", end='')
+    def fingerprints(self) -> list[winnowing.Fingerprints]:
+        """
+        Fingerprints all submissions by winnowing their tokens, in worker processes if more
+        than one is configured. Fingerprints are calculated once and kept.
+
+        Returns:
+            The fingerprints of all submissions, in the order of their IDs
+        """
+        if self._fingerprints is not None:
+            return self._fingerprints
+
+        pattern = self.wildcard_ext(self.language).split('/')[-1]
+        submissions = sorted(path for path in Path(self.submission_dir).iterdir()
+                             if path.is_dir())
+        fingerprint = partial(winnowing.fingerprint, pattern=pattern)
+
+        # Tokenizing dominates, matching through the index is linear in shared fingerprints
+        if self.workers > 1 and len(submissions) > self.workers:
+            chunk_size = max(1, len(submissions) // (4 * self.workers))
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                self._fingerprints = list(executor.map(fingerprint, submissions,
+                                                       chunksize=chunk_size))
+        else:
+            self._fingerprints = [fingerprint(submission) for submission in submissions]
+        return self._fingerprints
+
+    def signatures(self) -> dict[str, list[int]]:
+        """
+        Calculates MinHash signatures of all submissions for the cross-cohort similarity
+        index. Fingerprints found in more than ignore_limit submissions are left out, the same
+        as in detection. Submissions without any fingerprint are skipped.
+
+        Returns:
+            A dictionary mapping submission IDs to their signatures
+        """
+        fingerprints = self.fingerprints()
+        counts = Counter(h for submission in fingerprints for h in submission.locations)
+        kept = {submission.id: [h for h in submission.locations if counts[h] <= self.ignore_limit]
+                for submission in fingerprints}
+        return {sm_id: similarity.minhash(hashes) for sm_id, hashes in kept.items() if hashes}
+
+    def run_local(self) -> dict:
+        """
+        Fingerprints all submissions offline by winnowing their tokens, and matches them
+        through an inverted index of fingerprints. The report has the same shape as MOSS,
+        without a url.
+
+        Returns:
+            A dictionary containing the extracted plagiarism information
+        """
+        print(f"Detecting plagiarism locally over directory {self.submission_dir}")
+        fingerprints = self.fingerprints()
+        pg_list = winnowing.match(fingerprints, self.ignore_limit)
+        print(f"> {len(pg_list)} pairs of {len(fingerprints)} submissions matched.")
+        return {
+            'response': True,
+            'extract': True,
+            'url': None,
+            'date': None,
+            'pg_list': pg_list
+        }
+
+    def _retry(self, action: Callable[[], T], description: str) -> T:
+        """
+        Calls an action talking to MOSS, retrying on connection failures and timeouts with
+        exponential backoff. Other errors, such as the language being rejected, are permanent
+        and raised at once.
+
+        Args:
+            action: Function to be called
+            description: Description of the action for logging
+
+        Returns:
+            The return value of the action, otherwise the error of the last attempt is raised
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return action()
+            except OSError as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                print(f"> {description} failed: {e}, retrying in {delay:g} seconds.")
+                time.sleep(delay)
+
+    def _send(self) -> str:
+        """
+        Sends all detecting files to MOSS server.
+
+        Returns:
+            The report url
+        """
+        print("> ", end='')
+        try:
             url = self.moss.send(lambda file_path, display_name: print('#', end='', flush=True))
-            print("\n> MOSS Report Url: " + url)
+        finally:
+            print()
+        if not url.startswith("http"):
+            # The server closed the connection or answered garbage, which is worth a retry
+            raise ConnectionError(f"unexpected response {url!r}")
+        return url
+
+    def _load(self, url: str) -> str:
+        """
+        Loads the report from MOSS server.
+
+        Args:
+            url: The report url
 
+        Returns:
+            The HTML contents of the report
+        """
+        with urlopen(url, timeout=self.timeout) as response:
+            charset = response.headers.get_content_charset() or 'utf-8'
+            return response.read().decode(charset)
+
+    def run_moss(self) -> dict:
+        """
+        Sends all detecting files to MOSS server, retrieves the report url, and extracts the
+        information within. Each step times out and is retried with backoff.
+
+        Returns:
+            A dictionary containing the extracted plagiarism information
+        """
+        print(f"Detecting plagiarism over directory {self.submission_dir}")
         plagiarism: dict = {
             'response': None,
             'extract': None,
-            'url': url,
-            'date': (date.today() + timedelta(days=13)).strftime("%b %d, %Y"),
+            'url': None,
+            'date': None,
             'pg_list': []
         }
 
+        # Send files and get report url
+        try:
+            url = self._retry(self._send, "Sending files to MOSS server")
+        except (OSError, ValueError) as e:
+            print(f"> MOSS server unavailable: {e}")
+            return plagiarism
+        print("> MOSS Report Url: " + url)
+        plagiarism['url'] = url
+        plagiarism['date'] = (date.today() + timedelta(days=13)).strftime("%b %d, %Y")
+
         # Load contents from the url
         try:
-            response = urlopen(url)
+            content = self._retry(lambda: self._load(url), "Loading MOSS report")
             plagiarism['response'] = True
             plagiarism['extract'] = True
-            charset = response.headers.get_content_charset()
-            content = response.read().decode(charset)
             print("> Contents loaded from url, extracting plag details.")
 
             # Extract plagiarism rows
@@ -138,7 +354,7 @@ class PlagDetection:
             plagiarism['response'] = True
             print("> Failed to load contents from url.")
 
-        except (URLError, ValueError):
+        except (URLError, OSError, ValueError):
             print("> Url error.")
 
         return plagiarism
@@ -5,142 +5,266 @@ This file is part of AMFS, which is distributed under the terms of the GPLv3 Lic
 See the file LICENSE at the top level directory of this distribution for details.
 """
 
+import dataclasses
+import json
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import groupby
+from typing import Iterator
 
 from flask import (
-    Blueprint, redirect, render_template, request, session, url_for, current_app
+    Blueprint, redirect, render_template, request, session, url_for, current_app, flash, abort,
+    Response
 )
 from flask_weasyprint import render_pdf
 
-from amfs.database.db import get_db
+from amfs import jobs
+from amfs.cache import CompileCache, SolutionCache
+from amfs.database.db import (
+    get_db, get_writer, get_blobs, load_tests, load_feedbacks, load_records, prune_records,
+    sweep_blobs, clear_results, insert_results, load_job_results
+)
+from amfs.execution import Limits
 from amfs.feedback import Submission, FeedbackReport
+from amfs.jvm import WarmJvm
 from amfs.marking import AutoMarking, TestCase, Attempt
 from amfs.plagiarism import PlagDetection
+from amfs.similarity import find_similar, index_cohort
 
 bp = Blueprint('run', __name__)
 
 
+def _mark_job(job: jobs.Job, config: dict) -> None:
+    """
+    Runs a marking job in the background: marking all submissions, generating feedback reports
+    and detecting plagiarism, with the results stored in the job.
+
+    Args:
+        job: Background job object
+        config: Marking configurations copied from the session
+
+    Returns:
+        None
+    """
+    db = get_db()
+    writer = get_writer()
+    blobs = get_blobs()
+    start_time = time.time()
+
+    # Plagiarism detection only needs the source files, so it runs alongside marking and
+    # rendering from the start, and the job takes as long as the slower of them
+    pd = PlagDetection(
+        language="java",
+        submission_dir=config['submission_dir'],
+        ignore_limit=200,
+        backend=current_app.config['PLAGIARISM_BACKEND'],
+        workers=current_app.config['PLAGIARISM_WORKERS'],
+        server=current_app.config['MOSS_SERVER'],
+        port=current_app.config['MOSS_PORT'],
+        timeout=current_app.config['PLAGIARISM_TIMEOUT'],
+        retries=current_app.config['PLAGIARISM_RETRIES'],
+        backoff=current_app.config['PLAGIARISM_BACKOFF']
+    )
+    index = current_app.config['SIMILARITY_INDEX']
+    detector = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"plagiarism-{job.id}")
+    detection = detector.submit(lambda: (pd.run(), pd.signatures() if index else None))
+    detector.shutdown(wait=False)
+
+    # List of all test cases
+    tests = load_tests(db, blobs, job.id)
+
+    # Previous execution results for incremental marking
+    records = load_records(db, blobs, job.id) if config['incremental'] else None
+
+    # Resource limits of executions, None if nothing is limited
+    limits = Limits(
+        cpu_time=current_app.config['LIMIT_CPU_TIME'],
+        memory=current_app.config['LIMIT_MEMORY'],
+        processes=current_app.config['LIMIT_PROCESSES'],
+        file_size=current_app.config['LIMIT_FILE_SIZE']
+    )
+    if all(value is None for value in dataclasses.astuple(limits)):
+        limits = None
+
+    # Marking instance
+    am = AutoMarking(
+        compile_command=config['compile_command'],
+        execute_command=config['execute_command'],
+        timeout=int(config['timeout']),
+        tests=tests,
+        solution_dir=config['solution_dir'],
+        submission_dir=config['submission_dir'],
+        workers=int(config['workers'] or 1),
+        max_processes=int(config['max_processes']) if config['max_processes'] else None,
+        memory_limit=int(config['memory_limit']) if config['memory_limit'] else None,
+        source_patterns=current_app.config['SOURCE_PATTERNS'],
+        compile_cache=(CompileCache(cache_dir=current_app.config['COMPILE_CACHE'],
+                                    max_size=current_app.config['COMPILE_CACHE_SIZE'],
+                                    max_age=current_app.config['COMPILE_CACHE_AGE'])
+                       if current_app.config['COMPILE_CACHE'] else None),
+        solution_cache=(SolutionCache(cache_dir=current_app.config['SOLUTION_CACHE'],
+                                      max_size=current_app.config['SOLUTION_CACHE_SIZE'],
+                                      max_age=current_app.config['SOLUTION_CACHE_AGE'])
+                        if current_app.config['SOLUTION_CACHE'] else None),
+        records=records,
+        output_limit=current_app.config['OUTPUT_LIMIT'],
+        error_limit=current_app.config['ERROR_LIMIT'],
+        comparison=config['comparison'] or "exact",
+        tolerance=float(config['tolerance'] or 1e-6),
+        fail_fast=current_app.config['FAIL_FAST'],
+        limits=limits,
+        warm_jvm=(WarmJvm(cache_dir=current_app.config['JVM_CACHE'],
+                          cds=current_app.config['JVM_CDS'])
+                  if current_app.config['JVM_WARM'] else None)
+    )
+
+    # Clear results of the previous marking, keeping execution results of this job
+    # for the next incremental marking
+    writer.submit(clear_results, job.id).result()
+
+    def marked_submissions() -> Iterator[Submission]:
+        """
+        Persists each submission in batches as soon as it is marked, and passes it on to
+        feedback generation.
+        """
+        batch: list[tuple[str, float, list[Attempt]]] = []
+        writes: list[Future] = []
+        fingerprints: set[str] = set()
+        for sm_id, group in groupby(am.run(), key=lambda a: a.sm_id):
+            attempts: list[Attempt] = list(group)
+            fingerprints.update(a.fingerprint for a in attempts if a.fingerprint is not None)
+            sm_mark = sum(attempt.mark for attempt in attempts)
+            batch.append((sm_id, sm_mark, attempts))
+            if len(batch) >= current_app.config['DATABASE_BATCH_SIZE']:
+                writes.append(writer.submit(insert_results, blobs, job.id, batch))
+                batch = []
+
+            yield Submission(id=sm_id, mark=sm_mark, attempts=attempts)
+
+        writes.append(writer.submit(insert_results, blobs, job.id, batch))
+        # Surface any failed write before the job completes
+        for write in writes:
+            write.result()
+        # Execution results of submissions or tests that changed are not needed any more
+        writer.submit(prune_records, job.id, fingerprints).result()
+        # Nor are the outputs of the previous marking and of the records pruned
+        writer.submit(sweep_blobs, blobs, current_app.config['BLOB_SWEEP_GRACE']).result()
+
+    # Full mark of the marking job
+    full_mark = db.execute("SELECT SUM(tc_mark) FROM TestCase WHERE jb_id = ?",
+                           (job.id,)).fetchone()[0]
+
+    # List of all feedbacks with corresponding test case selection
+    feedbacks, feedback_selection = load_feedbacks(db, job.id)
+    feedbacks.insert(0, "Test cases not run due to failure of compilation.")
+    feedback_selection.insert(0, frozenset({0}))
+
+    # Feedback instance, with compilation added to the front of all test cases
+    fr = FeedbackReport(
+        name=job.name,
+        full_mark=full_mark,
+        template_file=f"{current_app.name}/{current_app.template_folder}/feedback.html",
+        css_file=f"{current_app.static_folder}/feedback.css",
+        submission_dir=config['submission_dir'],
+        submissions=marked_submissions(),
+        tests=[TestCase(id=0, name="Compilation", mark=0)] + tests,
+        feedbacks=feedbacks,
+        feedback_selection=feedback_selection,
+        progress=job.progress,
+        render_workers=current_app.config['RENDER_WORKERS']
+    )
+    job.begin_stage("marking", len(am.submissions))
+    result = fr.run()
+
+    job.begin_stage("plagiarism")
+    plagiarism, signatures = detection.result()
+
+    # Check against past cohorts in the similarity index, then add this cohort to it
+    if signatures is not None:
+        plagiarism['past_list'] = find_similar(db, job.id, signatures,
+                                               current_app.config['SIMILARITY_THRESHOLD'])
+        writer.submit(index_cohort, job.id, job.name, signatures).result()
+
+    print("--- %s seconds ---" % (time.time() - start_time))
+    job.finish(result, plagiarism)
+
+
 @bp.route('/marking', methods=['GET', 'POST'])
 def marking():
     db = get_db()
+    jb_id = session.get('job_id')
     overview: dict[str, int] = dict()
-    overview['tc_count'] = db.execute("SELECT COUNT(tc_id) FROM TestCase").fetchone()[0]
-    overview['fb_count'] = db.execute("SELECT COUNT(fb_id) FROM Feedback").fetchone()[0]
+    overview['tc_count'] = db.execute("SELECT COUNT(tc_id) FROM TestCase WHERE jb_id = ?",
+                                      (jb_id,)).fetchone()[0]
+    overview['fb_count'] = db.execute("SELECT COUNT(fb_id) FROM Feedback WHERE jb_id = ?",
+                                      (jb_id,)).fetchone()[0]
 
     if request.method == 'POST':
-        start_time = time.time()
-
-        # List of all test cases
-        tests: list[TestCase] = []
-        for tc_row in db.execute("SELECT * FROM TestCase ORDER BY tc_id ASC").fetchall():
-            tests.append(TestCase(
-                id=tc_row['tc_id'],
-                name=tc_row['tc_name'],
-                mark=tc_row['tc_mark'],
-                input=tc_row['tc_input']
-            ))
-
-        # Marking instance
-        am = AutoMarking(
-            compile_command=session['compile_command'],
-            execute_command=session['execute_command'],
-            timeout=int(session['timeout']),
-            tests=tests,
-            solution_dir=session['solution_dir'],
-            submission_dir=session['submission_dir']
-        )
-
-        # Calculate scores of each submission and insert all attempts
-        sm_dict: dict[str, float] = dict()
-        for attempt in am.run():
-            temp_mark = sm_dict.get(attempt.sm_id)
-            sm_dict[attempt.sm_id] = attempt.mark if temp_mark is None else temp_mark + attempt.mark
-            db.execute("""
-                INSERT INTO Attempt (sm_id, tc_id, at_code, at_mark, at_output)
-                VALUES (?, ?, ?, ?, ?)
-            """, (attempt.sm_id, attempt.tc_id, attempt.code, attempt.mark, attempt.output))
-
-        # Insert submissions with corresponding scores
-        for sm_id in sm_dict:
-            db.execute("INSERT INTO Submission (sm_id, sm_mark) VALUES (?, ?)",
-                       (sm_id, sm_dict[sm_id]))
-        db.commit()
-
-        # Full mark of the marking job
-        full_mark = db.execute("SELECT SUM(tc_mark) FROM TestCase").fetchone()[0]
-
-        # List of all submissions
-        submissions: list[Submission] = []
-        for sm_id in sm_dict:
-            attempts: list[Attempt] = []
-            for attempt in db.execute("""
-                SELECT sm_id, tc_id, at_code, at_mark, at_output FROM Attempt
-                WHERE sm_id = ?
-                ORDER BY tc_id ASC
-            """, (sm_id,)).fetchall():
-                attempts.append(Attempt(
-                    sm_id=attempt['sm_id'],
-                    tc_id=attempt['tc_id'],
-                    code=attempt['at_code'],
-                    mark=attempt['at_mark'],
-                    output=attempt['at_output']
-                ))
-
-            submissions.append(
-                Submission(id=sm_id, mark=sm_dict[sm_id], attempts=attempts)
-            )
-
-        # Add compilation to the front of all test cases
-        tests.insert(0, TestCase(id=0, name="Compilation", mark=0))
-
-        # List of all feedbacks with corresponding test case selection
-        feedback_selection: [frozenset[int]] = [frozenset({0})]
-        feedbacks: list[str] = ["Test cases not run due to failure of compilation."]
-        for fb_row in db.execute("SELECT * FROM Feedback ORDER BY fb_id ASC").fetchall():
-            tc_combination: [int] = []
-            for fs_row in db.execute("SELECT tc_id FROM FeedbackSelection WHERE fb_id = ?",
-                                     (fb_row['fb_id'],)).fetchall():
-                tc_combination.append(fs_row['tc_id'])
-
-            print(tc_combination)
-            feedback_selection.append(frozenset(tc_combination))
-            feedbacks.append(fb_row['fb_content'])
-
-        # Feedback instance
-        fr = FeedbackReport(
-            name=session['job'],
-            full_mark=full_mark,
-            template_file=f"{current_app.name}/{current_app.template_folder}/feedback.html",
-            css_file=f"{current_app.static_folder}/feedback.css",
-            submission_dir=session['submission_dir'],
-            submissions=submissions,
-            tests=tests,
-            feedbacks=feedbacks,
-            feedback_selection=feedback_selection
-        )
-        session['result'] = fr.run()
-
-        # Plagiarism instance
-        pd = PlagDetection(
-            language="java",
-            submission_dir=session['submission_dir'],
-            ignore_limit=200
-        )
-        session['plagiarism'] = pd.run()
-
-        print("--- %s seconds ---" % (time.time() - start_time))
-
-        return redirect(url_for('run.results'))
-
-    return render_template('run/marking.html', overview=overview)
+        if jb_id is None:
+            flash("Please design test cases of the marking job first.")
+        else:
+            config = {key: session.get(key) for key in (
+                'compile_command', 'execute_command', 'timeout', 'solution_dir',
+                'submission_dir', 'workers', 'max_processes', 'memory_limit', 'comparison',
+                'tolerance'
+            )}
+            config['incremental'] = 'incremental' in request.form
+            if jobs.start(jb_id, session['job'], _mark_job, config):
+                return redirect(url_for('run.marking'))
+            flash("This marking job is already running, please wait for it to finish.")
+
+    job = db.execute("SELECT * FROM Job WHERE jb_id = ?", (jb_id,)).fetchone()
+
+    return render_template('run/marking.html', overview=overview, job=job)
+
+
+@bp.route('/marking/<int:jb_id>/progress')
+def progress(jb_id: int):
+    """
+    Streams progress events of a marking job as server-sent events.
+    """
+    job = jobs.get(jb_id)
+    if job is None:
+        # The job is not running in this process, report its persisted state instead, which
+        # the client polls again by reconnecting while the job is queued or running
+        row = get_db().execute("SELECT * FROM Job WHERE jb_id = ?", (jb_id,)).fetchone()
+        if row is None:
+            abort(404)
+        events = iter([{
+            'status': row['jb_status'],
+            'stage': row['jb_stage'],
+            'done': row['jb_done'],
+            'total': row['jb_total'],
+            'message': row['jb_message']
+        }])
+    else:
+        events = job.stream()
+
+    def generate():
+        for event in events:
+            # Comment lines keep the connection alive while no progress is made
+            yield ": keep-alive\n\n" if event is None else f"data: {json.dumps(event)}\n\n"
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @bp.route('/results', methods=['GET', 'POST'])
 def results():
+    db = get_db()
+    job = None
+    if 'job_id' in session:
+        job = db.execute("SELECT jb_id, jb_name, jb_status FROM Job WHERE jb_id = ?",
+                         (session['job_id'],)).fetchone()
+    if job is None or job['jb_status'] != "done":
+        return redirect(url_for('run.marking'))
+
     if request.method == 'POST':
         return render_pdf(html=url_for('run.results'),
-                          download_filename=f"{session['job']} results.pdf")
+                          download_filename=f"{job['jb_name']} results.pdf")
 
-    return render_template('run/results.html',
-                           result=session['result'],
-                           plagiarism=session['plagiarism'])
+    stored = load_job_results(db, job['jb_id'])
+    if stored is None:
+        return redirect(url_for('run.marking'))
+    result, plagiarism = stored
+    return render_template('run/results.html', result=result, plagiarism=plagiarism)
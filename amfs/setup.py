@@ -9,10 +9,11 @@ import tempfile
 from pathlib import Path
 
 from flask import (
-    Blueprint, redirect, render_template, request, session, url_for, flash, current_app
+    Blueprint, redirect, render_template, request, session, url_for, flash
 )
 
-from amfs.database.db import get_db, init_db
+from amfs import jobs
+from amfs.database.db import get_db, get_blobs, insert_test
 from amfs.marking import AutoMarking
 
 bp = Blueprint('setup', __name__, url_prefix='/setup')
@@ -26,8 +27,15 @@ def basics():
         timeout = request.form['timeout']
         solution_dir = request.form['solutionDir']
         submission_dir = request.form['submissionDir']
+        workers = request.form['workers']
+        max_processes = request.form.get('maxProcesses', '')
+        memory_limit = request.form.get('memoryLimit', '')
+        comparison = request.form.get('comparison', 'exact')
+        tolerance = request.form.get('tolerance') or '1e-6'
 
-        error = AutoMarking.check_configs(compile_command, timeout, solution_dir, submission_dir)
+        error = AutoMarking.check_configs(compile_command, timeout, solution_dir, submission_dir,
+                                          workers, max_processes, memory_limit, comparison,
+                                          tolerance)
 
         if error is None:
             session['compile_command'] = compile_command
@@ -35,6 +43,11 @@ def basics():
             session['timeout'] = timeout
             session['solution_dir'] = solution_dir
             session['submission_dir'] = submission_dir
+            session['workers'] = workers
+            session['max_processes'] = max_processes
+            session['memory_limit'] = memory_limit
+            session['comparison'] = comparison
+            session['tolerance'] = tolerance
             return redirect(url_for('setup.test_case_design'))
 
         for e in error:
@@ -57,9 +70,11 @@ def test_case_design():
 
         elif 'total_tests' in request.form:
             total_tests = int(request.form['total_tests'])
-            with current_app.app_context():
-                init_db()
+            # Every test case design starts a new marking job, keeping previous jobs
+            jb_id = jobs.create(session['job'])
+            session['job_id'] = jb_id
             db = get_db()
+            blobs = get_blobs()
 
             for i in range(1, total_tests + 1):
                 filename = request.form.get(f"tc_file_{i}")
@@ -68,16 +83,14 @@ def test_case_design():
 
                 with open(temp_file_dir / filename) as f:
                     # Insert test case entries
-                    db.execute("""
-                        INSERT INTO TestCase (tc_id, tc_name, tc_mark, tc_input)
-                        VALUES (?, ?, ?, ?)
-                    """, (i, filename, mark, f.read()))
+                    insert_test(db, blobs, jb_id, i, filename, mark, f.read())
                     # Insert feedback entries
-                    db.execute("INSERT INTO Feedback (fb_id, fb_content) VALUES (?, ?)",
-                               (i, feedback))
+                    db.execute("INSERT INTO Feedback (jb_id, fb_id, fb_content) VALUES (?, ?, ?)",
+                               (jb_id, i, feedback))
                     # Update 1-1 feedback selection
-                    db.execute("INSERT INTO FeedbackSelection (fb_id, tc_id) VALUES (?, ?)",
-                               (i, i))
+                    db.execute("""
+                        INSERT INTO FeedbackSelection (jb_id, fb_id, tc_id) VALUES (?, ?, ?)
+                    """, (jb_id, i, i))
 
             # Batch commit all changes
             db.commit()
@@ -88,8 +101,12 @@ def test_case_design():
 
 @bp.route('/additional-settings', methods=['GET', 'POST'])
 def additional_settings():
+    if 'job_id' not in session:
+        return redirect(url_for('setup.test_case_design'))
+
+    jb_id = session['job_id']
     db = get_db()
-    tests = db.execute("SELECT * FROM TestCase").fetchall()
+    tests = db.execute("SELECT * FROM TestCase WHERE jb_id = ?", (jb_id,)).fetchall()
 
     if request.method == 'POST':
         selected_tests = request.form.getlist('tests')
@@ -106,8 +123,9 @@ def additional_settings():
             feedbacks = db.execute("""
                 SELECT GROUP_CONCAT(tc_id) AS tc_group
                 FROM FeedbackSelection
+                WHERE jb_id = ?
                 GROUP BY fb_id
-            """).fetchall()
+            """, (jb_id,)).fetchall()
             for feedback in feedbacks:
                 old_combination = set(feedback['tc_group'].split(','))
                 if old_combination == new_combination:
@@ -117,16 +135,18 @@ def additional_settings():
             if error is not None:
                 flash(error)
             else:
-                # Insert additional feedback at the end of Feedback and get its id
-                db.execute("INSERT INTO Feedback (fb_content) VALUES (?)",
-                           (request.form['feedback'],))
-                db.commit()
-                fb_id = db.execute("SELECT fb_id FROM Feedback ORDER BY fb_id DESC").fetchone()[0]
+                # Insert additional feedback at the end of Feedback of this job
+                fb_id = db.execute("""
+                    SELECT COALESCE(MAX(fb_id), 0) + 1 FROM Feedback WHERE jb_id = ?
+                """, (jb_id,)).fetchone()[0]
+                db.execute("INSERT INTO Feedback (jb_id, fb_id, fb_content) VALUES (?, ?, ?)",
+                           (jb_id, fb_id, request.form['feedback']))
 
                 # Connecting the feedback with the new combination
                 for tc_id in selected_tests:
-                    db.execute("INSERT INTO FeedbackSelection (fb_id, tc_id) VALUES (?, ?)",
-                               (fb_id, tc_id))
+                    db.execute("""
+                        INSERT INTO FeedbackSelection (jb_id, fb_id, tc_id) VALUES (?, ?, ?)
+                    """, (jb_id, fb_id, tc_id))
                 db.commit()
 
     return render_template('setup/additional-settings.html', tests=tests)
@@ -0,0 +1,138 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+"""
+
+import hashlib
+import random
+import sqlite3
+import struct
+from array import array
+from typing import Iterable
+
+# Number of hash functions in each MinHash signature
+NUM_HASHES = 128
+# Number of bands for locality-sensitive hashing, each of NUM_HASHES // BANDS hash values.
+# Pairs with Jaccard similarity s become candidates with probability 1 - (1 - s^r)^b for
+# r rows and b bands, which is about 1/2 at s = 0.42 and above 0.99 at s = 0.7
+BANDS = 32
+ROWS = NUM_HASHES // BANDS
+
+_PRIME = (1 << 61) - 1
+# Coefficients of the hash functions, seeded so that signatures stay comparable across runs
+_random = random.Random(0x414D4653)
+_COEFFICIENTS = [(_random.randrange(1, _PRIME), _random.randrange(_PRIME))
+                 for _ in range(NUM_HASHES)]
+
+
+def minhash(fingerprints: Iterable[int]) -> list[int]:
+    """
+    Calculates the MinHash signature of a set of fingerprints, where the share of equal values
+    of two signatures estimates the Jaccard similarity of their sets.
+
+    Args:
+        fingerprints: Fingerprint hashes of a submission
+
+    Returns:
+        The signature of NUM_HASHES values
+    """
+    values = {fingerprint % _PRIME for fingerprint in fingerprints}
+    return [min((a * value + b) % _PRIME for value in values) for a, b in _COEFFICIENTS]
+
+
+def bands(signature: list[int]) -> list[tuple[int, int]]:
+    """
+    Splits a signature into bands, each hashed into a bucket. Signatures sharing the bucket of
+    any band are candidates for comparison.
+
+    Args:
+        signature: MinHash signature
+
+    Returns:
+        A list of (band, bucket)
+    """
+    result = []
+    for band in range(BANDS):
+        rows = struct.pack(f">{ROWS}Q", *signature[band * ROWS:(band + 1) * ROWS])
+        # Buckets are kept in the index, so they are hashed with a fixed function, signed to
+        # fit an SQLite integer
+        bucket = hashlib.blake2b(rows, digest_size=8).digest()
+        result.append((band, int.from_bytes(bucket, signed=True)))
+    return result
+
+
+def similarity(signature_1: list[int], signature_2: list[int]) -> float:
+    """
+    Estimates the Jaccard similarity of the fingerprints of two signatures.
+    """
+    return sum(a == b for a, b in zip(signature_1, signature_2)) / NUM_HASHES
+
+
+def index_cohort(db: sqlite3.Connection, jb_id: int, cohort: str,
+                 signatures: dict[str, list[int]]) -> None:
+    """
+    Replaces the signatures of the cohort marked by a job in the index, so that marking the
+    same job again keeps the index up to date.
+    """
+    with db:
+        db.execute("DELETE FROM Signature WHERE jb_id = ?", (jb_id,))
+        for submission, signature in signatures.items():
+            sg_id = db.execute("""
+                INSERT INTO Signature (sg_cohort, sg_submission, sg_minhash, jb_id)
+                VALUES (?, ?, ?, ?)
+            """, (cohort, submission, array('Q', signature).tobytes(), jb_id)).lastrowid
+            db.executemany("INSERT INTO SignatureBand (sb_band, sb_bucket, sg_id) VALUES (?, ?, ?)",
+                           [(band, bucket, sg_id) for band, bucket in bands(signature)])
+
+
+def find_similar(db: sqlite3.Connection, jb_id: int, signatures: dict[str, list[int]],
+                 threshold: float, max_matches: int = 250) -> list[dict[str, str]]:
+    """
+    Finds submissions of other cohorts in the index similar to the specified submissions.
+    Candidates are looked up by band buckets, so the cost grows with the number of similar
+    submissions rather than the size of the index.
+
+    Args:
+        db: Database connection
+        jb_id: ID of the job marking the submissions, whose own cohort is skipped
+        signatures: MinHash signatures of the submissions, by submission ID
+        threshold: Minimum estimated similarity of a match
+        max_matches: Maximum number of pairs reported
+
+    Returns:
+        Pairs of a submission and a past submission with their estimated similarity, in
+        descending order of similarity
+    """
+    candidates: dict[str, set[int]] = dict()
+    for submission, signature in signatures.items():
+        candidates[submission] = {
+            row[0] for band, bucket in bands(signature)
+            for row in db.execute("""
+                SELECT sg_id FROM SignatureBand WHERE sb_band = ? AND sb_bucket = ?
+            """, (band, bucket))
+        }
+
+    sg_ids = sorted(set().union(*candidates.values()))
+    past = {row['sg_id']: (f"{row['sg_cohort']}/{row['sg_submission']}",
+                           array('Q', row['sg_minhash']).tolist())
+            for row in db.execute("""
+                SELECT sg_id, sg_cohort, sg_submission, sg_minhash FROM Signature
+                WHERE sg_id IN (SELECT value FROM json_each(?)) AND jb_id IS NOT ?
+            """, (str(sg_ids), jb_id))}
+
+    pairs = []
+    for submission, sg_ids in candidates.items():
+        for sg_id in sg_ids & past.keys():
+            name, signature = past[sg_id]
+            score = similarity(signatures[submission], signature)
+            if score >= threshold:
+                pairs.append((score, submission, name))
+
+    pairs.sort(key=lambda pair: pair[0], reverse=True)
+    return [{
+        'sm_1': submission,
+        'sm_2': name,
+        'similarity': f"{score:.0%}"
+    } for score, submission, name in pairs[:max_matches]]
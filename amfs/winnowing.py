@@ -0,0 +1,214 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+"""
+
+import bisect
+import hashlib
+import re
+import struct
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass, field
+from itertools import combinations
+from pathlib import Path
+from typing import Iterable
+
+# Tokens of Java and similar languages, with comments skipped
+JAVA_TOKEN = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<number>\b0[xX][\da-fA-F_]+[lL]?\b|\b\d[\d_]*(?:\.\d*)?(?:[eE][+-]?\d+)?[fFdDlL]?\b)
+  | (?P<word>[A-Za-z_$][\w$]*)
+  | (?P<symbol>>>>=?|<<=?|>>=?|[-+*/%&|^!=<>]=|&&|\|\||\+\+|--|->|::|[^\s\w])
+""", re.S | re.X)
+
+JAVA_KEYWORDS = frozenset("""
+    abstract assert boolean break byte case catch char class const continue default do double
+    else enum extends final finally float for goto if implements import instanceof int
+    interface long native new package private protected public return short static strictfp
+    super switch synchronized this throw throws transient try void volatile while var record
+    yield true false null
+""".split())
+
+# Number of tokens in each fingerprinted k-gram
+K = 15
+# Number of consecutive k-grams each selected fingerprint represents at least
+WINDOW = 8
+# Minimum number of consecutive shared fingerprints forming a matched passage, so that short
+# idioms common to unrelated programs do not count as matches
+MIN_RUN = 3
+
+
+@dataclass
+class Fingerprints:
+    """
+    Winnowed fingerprints of all source files of a submission.
+
+    Attributes:
+        id: Submission ID
+        lines: Number of lines containing tokens
+        locations: Occurrences of each fingerprint, as (file index, position in the file,
+            first line, last line)
+    """
+    id: str
+    lines: int = 0
+    locations: dict[int, list[tuple[int, int, int, int]]] = field(default_factory=dict)
+
+
+def tokenize(source: str) -> list[tuple[int, int]]:
+    """
+    Tokenizes Java source code into normalized tokens, where identifiers, numbers and string
+    literals are replaced by their kind, so that renaming and changing constants makes no
+    difference. Comments and whitespace are dropped.
+
+    Args:
+        source: Source code
+
+    Returns:
+        A list of token codes with their line numbers
+    """
+    newlines = [m.start() for m in re.finditer("\n", source)]
+    tokens = []
+    for m in JAVA_TOKEN.finditer(source):
+        kind, text = m.lastgroup, m.group()
+        if kind == 'comment':
+            continue
+        if kind == 'word' and text not in JAVA_KEYWORDS:
+            text = "V"
+        elif kind in ('number', 'string'):
+            text = kind
+        tokens.append((zlib.crc32(text.encode()), bisect.bisect(newlines, m.start()) + 1))
+    return tokens
+
+
+def winnow(tokens: list[tuple[int, int]]) -> list[tuple[int, int, int]]:
+    """
+    Selects fingerprints of the k-grams of tokens by winnowing: the rightmost minimal hash of
+    every window of consecutive k-grams, so that any match of at least K + WINDOW - 1 tokens
+    shares a fingerprint.
+
+    Args:
+        tokens: Token codes with their line numbers
+
+    Returns:
+        A list of selected fingerprints with the first and last lines of their k-grams
+    """
+    if len(tokens) < K:
+        return []
+    codes = struct.pack(f">{len(tokens)}I", *(code for code, _ in tokens))
+    # Fingerprints are kept in the similarity index, so they are hashed with a fixed function
+    hashes = [int.from_bytes(hashlib.blake2b(codes[i * 4:(i + K) * 4], digest_size=8).digest())
+              for i in range(len(tokens) - K + 1)]
+    selected = []
+    last = -1
+    for start in range(max(1, len(hashes) - WINDOW + 1)):
+        window = hashes[start:start + WINDOW]
+        index = start + len(window) - 1 - window[::-1].index(min(window))
+        if index != last:
+            selected.append((hashes[index], tokens[index][1], tokens[index + K - 1][1]))
+            last = index
+    return selected
+
+
+def fingerprint_sources(sm_id: str, sources: Iterable[str]) -> Fingerprints:
+    """
+    Fingerprints source files of a submission.
+
+    Args:
+        sm_id: Submission ID
+        sources: Contents of the source files
+
+    Returns:
+        The fingerprints of the submission
+    """
+    result = Fingerprints(id=sm_id)
+    for file_index, source in enumerate(sources):
+        tokens = tokenize(source)
+        result.lines += len({line for _, line in tokens})
+        for position, (h, first, last) in enumerate(winnow(tokens)):
+            result.locations.setdefault(h, []).append((file_index, position, first, last))
+    return result
+
+
+def fingerprint(submission: Path, pattern: str) -> Fingerprints:
+    """
+    Fingerprints all source files of a submission.
+
+    Args:
+        submission: Directory of the submission
+        pattern: Wildcard pattern matching source files, e.g. "*.java"
+
+    Returns:
+        The fingerprints of the submission
+    """
+    return fingerprint_sources(submission.name, (
+        path.read_text(encoding='utf-8', errors='replace')
+        for path in sorted(submission.glob(pattern))
+    ))
+
+
+def _covered(submission: Fingerprints, hashes: list[int]) -> int:
+    """
+    Counts the source lines of a submission covered by passages of shared fingerprints.
+    """
+    occurrences = sorted(location for h in hashes for location in submission.locations[h])
+    lines = set()
+    run = []
+    for occurrence in occurrences + [None]:
+        if occurrence is not None and run and occurrence[:2] == (run[-1][0], run[-1][1] + 1):
+            run.append(occurrence)
+            continue
+        if len(run) >= MIN_RUN:
+            lines.update((file_index, line) for file_index, _, first, last in run
+                         for line in range(first, last + 1))
+        run = [occurrence]
+    return len(lines)
+
+
+def match(submissions: list[Fingerprints], ignore_limit: int,
+          max_matches: int = 250) -> list[dict[str, str]]:
+    """
+    Finds pairs of submissions sharing fingerprints through an inverted index, and scores each
+    pair by the source lines covered by passages of at least MIN_RUN consecutive shared
+    fingerprints. Fingerprints found in more than ignore_limit submissions are ignored as
+    common code, e.g. from a provided skeleton.
+
+    Args:
+        submissions: Fingerprints of all submissions
+        ignore_limit: Maximum number of submissions a fingerprint may appear in
+        max_matches: Maximum number of pairs reported
+
+    Returns:
+        Pairs with the percentage of each submission matched, and the number of lines matched,
+        in descending order of lines matched
+    """
+    index: dict[int, list[int]] = defaultdict(list)
+    for i, submission in enumerate(submissions):
+        for h in submission.locations:
+            index[h].append(i)
+
+    shared: dict[tuple[int, int], list[int]] = defaultdict(list)
+    for h, postings in index.items():
+        if 2 <= len(postings) <= ignore_limit:
+            for pair in combinations(postings, 2):
+                shared[pair].append(h)
+
+    pairs = []
+    for (i, j), hashes in shared.items():
+        if len(hashes) < MIN_RUN:
+            continue
+        a, b = submissions[i], submissions[j]
+        lines_a, lines_b = _covered(a, hashes), _covered(b, hashes)
+        if lines_a and lines_b:
+            pairs.append((max(lines_a, lines_b), a.id, lines_a / max(1, a.lines),
+                          b.id, lines_b / max(1, b.lines)))
+
+    pairs.sort(key=lambda pair: pair[0], reverse=True)
+    return [{
+        'sm_1': f"{id_a} ({share_a:.0%})",
+        'sm_2': f"{id_b} ({share_b:.0%})",
+        'line_match': str(line_match)
+    } for line_match, id_a, share_a, id_b, share_b in pairs[:max_matches]]
@@ -0,0 +1,96 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+
+Benchmark of rendering feedback reports, comparing compiling the html template and parsing
+the css file for every report against compiling them once per process.
+
+Usage (from the top level directory):
+    python -m bench.render_reports [number of reports]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from jinja2 import Template
+from weasyprint import HTML, CSS
+
+from amfs.feedback import render_report
+
+TEMPLATE_FILE = str(Path(__file__).parent.parent / "amfs" / "templates" / "feedback.html")
+CSS_FILE = str(Path(__file__).parent.parent / "amfs" / "static" / "feedback.css")
+
+
+def render_report_uncached(template_file: str, css_file: str, report: dict, submission: dict,
+                           target: str) -> None:
+    """
+    Renders a feedback report the way it was done before resources were cached.
+    """
+    with open(template_file, 'r') as f:
+        template = Template(f.read())
+        content = template.render(report=report, submission=submission)
+
+    HTML(string=content).write_pdf(
+        target=target,
+        stylesheets=[CSS(filename=css_file)]
+    )
+
+
+def sample_submission(index: int) -> dict:
+    """
+    Generates a template context similar to a submission with a few test cases.
+    """
+    return {
+        'id': f"Submission_{index:03d}",
+        'mark': "1.0",
+        'failed_tests': ['<a href="#Test 2 (0.0/2.0)" class="fail">Test 2 (0.0/2.0)</a>'],
+        'passed_tests': ['<a href="#Test 1 (1.0/1.0)" class="pass">Test 1 (1.0/1.0)</a>'],
+        'feedback': ["This is feedback 2"],
+        'attempts': [
+            {'name': '<h4 id="Compilation (0.0/0.0)" class="pass">Compilation (0.0/0.0)</h4>',
+             'code': "PASS", 'output': "Compile success."},
+            {'name': '<h4 id="Test 1 (1.0/1.0)" class="pass">Test 1 (1.0/1.0)</h4>',
+             'code': "PASS", 'output': "10\n"},
+            {'name': '<h4 id="Test 2 (0.0/2.0)" class="fail">Test 2 (0.0/2.0)</h4>',
+             'code': "WRONG_ANSWER", 'output': "16\n"},
+        ]
+    }
+
+
+def measure(render, count: int, target_dir: Path) -> float:
+    """
+    Renders the specified number of reports and returns the average seconds per report.
+    """
+    report = {'name': "Benchmark", 'full_mark': "3.0"}
+    start = time.perf_counter()
+    for i in range(count):
+        render(TEMPLATE_FILE, CSS_FILE, report, sample_submission(i),
+               str(target_dir / f"feedback_{i}.pdf"))
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+    with tempfile.TemporaryDirectory() as target_dir:
+        target_dir = Path(target_dir)
+        # Warm up imports and font configuration before measuring
+        measure(render_report_uncached, 1, target_dir)
+
+        uncached = measure(render_report_uncached, count, target_dir)
+        cached = measure(render_report, count, target_dir)
+
+    print(f"Reports rendered: {count} (pid {os.getpid()})")
+    print(f"> Per report, template and css loaded each time: {uncached * 1000:.2f} ms")
+    print(f"> Per report, template and css loaded once: {cached * 1000:.2f} ms")
+    print(f"> Saving per report: {(uncached - cached) * 1000:.2f} ms "
+          f"({(uncached - cached) / uncached:.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+
+Benchmark of launching an execution, comparing going through /bin/sh against launching the
+pre-tokenized argument list directly. The command does no work, so the difference is the
+spawn overhead per attempt.
+
+Usage (from the top level directory):
+    python -m bench.spawn [number of executions] [command]
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+
+from amfs.execution import execute, parse_command
+
+
+def measure(command: list[str] | str, count: int, cwd: str) -> float:
+    """
+    Executes the command the specified number of times and returns the average seconds per
+    execution.
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        execute(command, cwd=cwd, stdin="", timeout=10, stdout_limit=None, stderr_limit=None)
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    # The path of true is given, since "true" alone is a builtin the shell runs without exec
+    command = (sys.argv[2] if len(sys.argv) > 2
+               else f"{shutil.which('true') or '/bin/true'} --ignored-argument")
+    args = parse_command(command)
+    if isinstance(args, str):
+        sys.exit(f"Command needs a shell, nothing to compare: {command}")
+
+    with tempfile.TemporaryDirectory() as cwd:
+        # Warm up the page cache and the reader threads before measuring
+        measure(command, 10, cwd)
+        measure(args, 10, cwd)
+
+        shell = measure(command, count, cwd)
+        direct = measure(args, count, cwd)
+
+    print(f"Executions: {count} of {args}")
+    print(f"> Per execution, through the shell: {shell * 1000:.3f} ms")
+    print(f"> Per execution, launched directly: {direct * 1000:.3f} ms")
+    print(f"> Saving per execution: {(shell - direct) * 1000:.3f} ms "
+          f"({(shell - direct) / shell:.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+
+Check of the peak memory reported for an execution. The server holds a large allocation
+while executing true, which must still be reported with only a few megabytes, otherwise the
+memory of the server is charged to every execution.
+
+Usage (from the top level directory):
+    python -m bench.usage [megabytes held by the server]
+"""
+
+import shutil
+import sys
+import tempfile
+
+from amfs.execution import execute
+
+# Peak memory in megabytes above which true is taken to be charged with the server memory
+MAX_RSS_LIMIT = 16
+
+
+def main():
+    held = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    # Touch every page, so that the allocation is resident
+    allocation = bytearray(held * 1024 * 1024)
+    allocation[::4096] = b"\1" * len(range(0, len(allocation), 4096))
+
+    with tempfile.TemporaryDirectory() as cwd:
+        result = execute([shutil.which('true') or '/bin/true'], cwd=cwd, stdin="", timeout=10,
+                         stdout_limit=None, stderr_limit=None)
+    max_rss = result.usage.max_rss / (1024 * 1024)
+
+    print(f"Peak memory of true while the server holds {held} MB: {max_rss:.2f} MB")
+    if max_rss > MAX_RSS_LIMIT:
+        sys.exit(f"Peak memory is above {MAX_RSS_LIMIT} MB, "
+                 f"the execution is charged with the memory of the server")
+
+
+if __name__ == '__main__':
+    main()
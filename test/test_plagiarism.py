@@ -0,0 +1,101 @@
+"""
+Copyright (C) 2024 Yuhan Zhang - All Rights Reserved
+
+This file is part of AMFS, which is distributed under the terms of the GPLv3 License.
+See the file LICENSE at the top level directory of this distribution for details.
+
+Tests of timeouts and retries of plagiarism detection against the fake MOSS server.
+
+Usage (from the top level directory):
+    python -m pytest test
+"""
+
+import time
+from pathlib import Path
+
+import pytest
+
+from amfs.fakemoss import FakeMoss
+from amfs.plagiarism import PlagDetection
+
+SUBMISSION_DIR = Path(__file__).parent / "submission"
+
+
+def detection(fake: FakeMoss, timeout: float = 5, retries: int = 2) -> PlagDetection:
+    """
+    Creates a detection of the sample submissions on the fake server, retrying without delay.
+    """
+    return PlagDetection(language="java", submission_dir=str(SUBMISSION_DIR), ignore_limit=200,
+                         server=fake.host, port=fake.port, timeout=timeout, retries=retries,
+                         backoff=0)
+
+
+def counted(pd: PlagDetection) -> list[int]:
+    """
+    Counts the attempts sending files to the server.
+    """
+    calls = [0]
+    send = pd.moss.send
+
+    def counting_send(*args, **kwargs) -> str:
+        calls[0] += 1
+        return send(*args, **kwargs)
+
+    pd.moss.send = counting_send
+    return calls
+
+
+def test_timeout():
+    with FakeMoss(delay=1) as fake:
+        pd = detection(fake, timeout=0.2, retries=0)
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            pd._retry(pd._send, "Sending files to MOSS server")
+        assert time.monotonic() - start < 1
+
+        plagiarism = pd.run_moss()
+    assert plagiarism['response'] is None
+    assert plagiarism['url'] is None
+
+
+def test_retry_succeeds():
+    with FakeMoss(failures=1) as fake:
+        pd = detection(fake)
+        calls = counted(pd)
+        plagiarism = pd.run_moss()
+    assert calls[0] == 2
+    assert plagiarism['response'] is True
+    assert plagiarism['url'].startswith(f"http://{fake.host}:{fake.http_port}/results/")
+    assert plagiarism['pg_list']
+
+
+def test_report_retry_succeeds():
+    with FakeMoss() as fake:
+        pd = detection(fake)
+        url = pd._send()
+        # The next report request fails once
+        fake.failures = 1
+        content = pd._retry(lambda: pd._load(url), "Loading MOSS report")
+    assert fake.failures == 0
+    assert "Moss Results" in content
+
+
+def test_retries_run_out():
+    with FakeMoss(failures=10) as fake:
+        pd = detection(fake, retries=2)
+        calls = counted(pd)
+        plagiarism = pd.run_moss()
+    assert calls[0] == 3
+    assert fake.failures == 7
+    assert plagiarism['response'] is None
+    assert plagiarism['pg_list'] == []
+
+
+def test_language_not_accepted_is_not_retried():
+    with FakeMoss() as fake:
+        pd = detection(fake)
+        pd.moss.options['l'] = "cobol"
+        calls = counted(pd)
+        with pytest.raises(ValueError, match="Language not accepted"):
+            pd._retry(pd._send, "Sending files to MOSS server")
+    assert calls[0] == 1